@@ -0,0 +1,232 @@
+"""
+Admission control for calls to rate-limited upstreams (Gemini, ElevenLabs).
+
+Each Upstream caps how many calls this process has in flight. Callers
+beyond the cap wait in a bounded queue, but only until a deadline. Each
+user also draws from a token bucket per upstream. A call that can't get
+in raises Rejected, which the app turns into 429 with Retry-After. So a
+class ending 60 sessions at once gets quick "try again in a few seconds"
+answers instead of 60 requests slowing down together and tripping the
+quota.
+
+    with llm.admit(user_id):     # rate limit + slot
+        reply = call_gemini()
+    llm.charge(user_id)          # rate limit only
+    with llm.slot(wait=0):       # slot only; background work that can be skipped
+        ...
+"""
+import math
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, Optional
+
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUED, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+# Buckets kept before idle, full ones are dropped
+MAX_BUCKETS = 10000
+
+
+class Rejected(Exception):
+    """A call was not admitted. retry_after is a whole number of seconds worth waiting."""
+
+    def __init__(self, upstream: str, reason: str, retry_after: int):
+        super().__init__(f"{upstream} {reason.replace('_', ' ')}, retry in {retry_after}s")
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token: 0 if granted, else the seconds until one is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Upstream:
+    """
+    Admission for one upstream: at most `concurrency` calls in flight, at most
+    `max_queue` more waiting up to `max_wait` seconds each, and per user
+    `per_minute` calls a minute with bursts of `burst` (default a quarter
+    minute's worth, at least 2). per_minute=0 turns the per-user limit off.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int = 32, max_wait: float = 10.0,
+                 per_minute: float = 0, burst: Optional[float] = None):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self.rate = per_minute / 60
+        self.burst = burst if burst is not None else max(2.0, per_minute / 4)
+        self._cond = threading.Condition()  # over an RLock, so _reject can be called while holding it
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._buckets_lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+        self._hold = 1.0  # moving average of seconds a slot is held, for Retry-After
+
+    # --- per-user rate ---
+    def charge(self, user_id: Optional[str]):
+        """Take one call from user_id's bucket, or raise Rejected."""
+        if not self.rate or not user_id:
+            return
+        now = time.monotonic()
+        with self._buckets_lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                if len(self._buckets) >= MAX_BUCKETS:
+                    self._buckets = {u: b for u, b in self._buckets.items() if not b.full(now)}
+                bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            wait = bucket.take(now)
+        if wait:
+            self._reject("rate_limited", wait)
+
+    # --- concurrency ---
+    def _reject(self, reason: str, retry_after: float):
+        with self._cond:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        ADMISSION_REJECTED.inc(upstream=self.name, reason=reason)
+        raise Rejected(self.name, reason, max(1, math.ceil(retry_after)))
+
+    def _busy_for(self) -> float:
+        """Rough seconds until a newcomer would get a slot."""
+        return self._hold * (self.waiting + 1) / self.concurrency
+
+    def _gauges(self):
+        ADMISSION_IN_FLIGHT.set(self.active, upstream=self.name)
+        ADMISSION_QUEUED.set(self.waiting, upstream=self.name)
+
+    def _try_acquire(self) -> bool:
+        # Caller holds self._cond
+        if self.active < self.concurrency:
+            self.active += 1
+            self.admitted += 1
+            self._gauges()
+            return True
+        return False
+
+    def _enqueue(self, wait: float) -> float:
+        """Join the queue; returns its deadline. Raises Rejected if the queue is full or wait is 0."""
+        if wait <= 0 or self.waiting >= self.max_queue:
+            self._reject("queue_full", self._busy_for())
+        self.waiting += 1
+        self._gauges()
+        return time.monotonic() + wait
+
+    def _dequeue(self):
+        self.waiting -= 1
+        self._gauges()
+
+    def acquire(self, wait: Optional[float] = None) -> Callable[[], None]:
+        """
+        Take a slot, queueing up to `wait` seconds (default max_wait). Returns
+        the function that gives it back; calling it more than once is harmless.
+        """
+        wait = self.max_wait if wait is None else wait
+        started = time.monotonic()
+        with self._cond:
+            if not (self.waiting == 0 and self._try_acquire()):
+                deadline = self._enqueue(wait)
+                try:
+                    while not self._try_acquire():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("queue_timeout", self._busy_for())
+                        self._cond.wait(remaining)
+                finally:
+                    self._dequeue()
+        return self._releaser(started)
+
+    async def acquire_async(self, wait: Optional[float] = None) -> Callable[[], None]:
+        """acquire() for the event loop: polls for a slot instead of blocking the loop's thread."""
+        wait = self.max_wait if wait is None else wait
+        started = time.monotonic()
+        with self._cond:
+            if self.waiting == 0 and self._try_acquire():
+                return self._releaser(started)
+            deadline = self._enqueue(wait)
+        try:
+            while True:
+                await asyncio.sleep(0.05)
+                with self._cond:
+                    if self._try_acquire():
+                        return self._releaser(started)
+                    if time.monotonic() >= deadline:
+                        self._reject("queue_timeout", self._busy_for())
+        finally:
+            with self._cond:
+                self._dequeue()
+
+    def _releaser(self, started: float) -> Callable[[], None]:
+        admitted_at = time.monotonic()
+        ADMISSION_WAIT_SECONDS.observe(admitted_at - started, upstream=self.name)
+        released = []
+
+        def release():
+            with self._cond:
+                if released:
+                    return
+                released.append(True)
+                self.active -= 1
+                self._hold = 0.8 * self._hold + 0.2 * (time.monotonic() - admitted_at)
+                self._gauges()
+                self._cond.notify()
+
+        return release
+
+    @contextmanager
+    def slot(self, wait: Optional[float] = None):
+        release = self.acquire(wait)
+        try:
+            yield
+        finally:
+            release()
+
+    @contextmanager
+    def admit(self, user_id: Optional[str] = None, wait: Optional[float] = None):
+        self.charge(user_id)
+        with self.slot(wait):
+            yield
+
+    @asynccontextmanager
+    async def admit_async(self, user_id: Optional[str] = None, wait: Optional[float] = None):
+        self.charge(user_id)
+        release = await self.acquire_async(wait)
+        try:
+            yield
+        finally:
+            release()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "in_flight": self.active,
+                "concurrency": self.concurrency,
+                "queued": self.waiting,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "per_minute": round(self.rate * 60, 2),
+            }
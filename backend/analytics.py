@@ -0,0 +1,157 @@
+import json
+import datetime as dt
+from typing import Optional
+
+CATEGORIES = ["history", "red_flags", "meds_allergies", "differential", "plan", "communication"]
+
+# Sessions kept verbatim in the rollup: enough for the trend chart (10) and recent list (5)
+RECENT_LIMIT = 10
+
+
+def empty_rollup() -> dict:
+    return {
+        "total_sessions": 0,
+        "overall_sum": 0,
+        "category_sums": {cat: 0 for cat in CATEGORIES},
+        "category_counts": {cat: 0 for cat in CATEGORIES},
+        "recent": [],
+    }
+
+
+def _as_utc(value):
+    if isinstance(value, dt.datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=dt.timezone.utc)
+    return value
+
+
+def section_scores(rubric) -> dict:
+    """Category -> score for the categories present in a stored rubric_json."""
+    if isinstance(rubric, str):
+        rubric = json.loads(rubric)
+    sections = (rubric or {}).get("sections", rubric or {})
+    return {
+        cat: (sections[cat] or {}).get("score", 0)
+        for cat in CATEGORIES if cat in sections
+    }
+
+
+def session_entry(thread_id: str, title: str, ended_at, overall_score, rubric) -> dict:
+    scores = section_scores(rubric)
+    return {
+        "id": thread_id,
+        "title": title,
+        "ended_at": _as_utc(ended_at),
+        "overall_score": overall_score or 0,
+        "scores": scores,
+    }
+
+
+def _apply(rollup: dict, entry: dict, sign: int):
+    rollup["total_sessions"] += sign
+    rollup["overall_sum"] += sign * entry["overall_score"]
+    for cat, score in entry["scores"].items():
+        rollup["category_sums"][cat] = rollup["category_sums"].get(cat, 0) + sign * score
+        rollup["category_counts"][cat] = rollup["category_counts"].get(cat, 0) + sign
+
+
+def add_session(rollup: dict, entry: dict, previous: Optional[dict] = None) -> dict:
+    """
+    Fold a scored session into the rollup. If the thread was already counted
+    (re-ended or re-scored), pass its previous entry so it is replaced rather
+    than counted twice.
+    """
+    if previous is not None:
+        _apply(rollup, previous, -1)
+    _apply(rollup, entry, +1)
+
+    recent = [s for s in rollup["recent"] if s["id"] != entry["id"]]
+    recent.append(entry)
+    recent.sort(key=lambda s: _as_utc(s.get("ended_at")) or dt.datetime.min.replace(tzinfo=dt.timezone.utc), reverse=True)
+    rollup["recent"] = recent[:RECENT_LIMIT]
+    return rollup
+
+
+def rollup_to_response(rollup: dict, iso) -> dict:
+    """Render a rollup as the /api/analytics payload. iso formats datetimes."""
+    total_sessions = rollup.get("total_sessions", 0)
+    if total_sessions <= 0:
+        return {
+            "total_sessions": 0,
+            "overall_avg": 0,
+            "category_avg": {},
+            "trend_data": [],
+            "recent_sessions": [],
+            "insights": {"strongest": None, "weakest": None, "improvement_areas": []}
+        }
+
+    sessions_data = [
+        {
+            "id": s["id"],
+            "title": s["title"],
+            "ended_at": iso(s.get("ended_at")),
+            "overall_score": s["overall_score"],
+            "categories": {cat: s["scores"].get(cat, 0) for cat in CATEGORIES},
+        }
+        for s in rollup.get("recent", [])
+    ]
+
+    overall_avg = rollup["overall_sum"] / total_sessions
+
+    # Calculate category averages (convert 0-5 scale to 0-100)
+    category_avg = {}
+    for cat in CATEGORIES:
+        count = rollup["category_counts"].get(cat, 0)
+        category_avg[cat] = (rollup["category_sums"].get(cat, 0) / count * 20) if count else 0
+
+    strongest = max(category_avg.items(), key=lambda x: x[1])
+    weakest = min(category_avg.items(), key=lambda x: x[1])
+
+    # Improvement areas (categories below 60%)
+    improvement_areas = [
+        {"category": cat, "score": score}
+        for cat, score in category_avg.items() if score < 60
+    ]
+
+    # Trend data (last 10 sessions, oldest to newest)
+    trend_data = [
+        {
+            "session": f"S{i+1}",
+            "score": sessions_data[i]["overall_score"],
+            "date": sessions_data[i]["ended_at"]
+        }
+        for i in range(min(10, len(sessions_data)))
+    ]
+    trend_data.reverse()
+
+    return {
+        "total_sessions": total_sessions,
+        "overall_avg": round(overall_avg, 1),
+        "category_avg": {k: round(v, 1) for k, v in category_avg.items()},
+        "trend_data": trend_data,
+        "recent_sessions": sessions_data[:5],
+        "insights": {
+            "strongest": {"category": strongest[0], "score": round(strongest[1], 1)},
+            "weakest": {"category": weakest[0], "score": round(weakest[1], 1)},
+            "improvement_areas": improvement_areas
+        }
+    }
+
+
+def rebuild_rollup(user_ref) -> dict:
+    """Recompute a user's rollup from every closed thread's latest feedback."""
+    rollup = empty_rollup()
+    threads = user_ref.collection("threads").where("status", "==", "closed")
+    for thread_snap in threads.stream():
+        fb_snap = thread_snap.reference.collection("feedback").document("latest").get()
+        if not fb_snap.exists:
+            continue
+        thread_data = thread_snap.to_dict() or {}
+        fb_data = fb_snap.to_dict() or {}
+        add_session(rollup, session_entry(
+            thread_snap.id,
+            thread_data.get("title", "Untitled"),
+            thread_data.get("ended_at"),
+            fb_data.get("overall_score", 0),
+            fb_data.get("rubric_json", {}),
+        ))
+    return rollup
@@ -1,28 +1,36 @@
 import os
 import datetime as dt
 from functools import wraps
-from typing import Optional, List
-from io import BytesIO
-import json
+from typing import Callable, Optional, List, Iterator, Tuple
+import hmac
+import importlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import jwt
 
-from flask import Flask, request, jsonify, send_file
+import click
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
-from google.cloud import firestore
-from google.oauth2 import id_token
-from google.auth.transport import requests as grequests
-from google import genai
-from google.genai.types import Content, Part, GenerateContentConfig
 
-from feedback import generate_feedback_json_with_model_v2
-
-try:
-    from elevenlabs.client import ElevenLabs
-    from elevenlabs import VoiceSettings
-    ELEVENLABS_AVAILABLE = True
-except ImportError:
-    print("⚠️ elevenlabs not installed. Run: pip install elevenlabs==1.7.0")
-    ELEVENLABS_AVAILABLE = False
+from feedback import generate_feedback_json_with_model_v2, evaluation_key, is_fallback
+import analytics
+import patient_context
+import rescore
+from tts_cache import AudioCache, cache_key
+from tts_prefetch import SpeechPrefetcher
+from conversation_cache import ConversationCache
+from storage import Storage, decode_cursor, encode_cursor
+from feedback_jobs import FeedbackJobs
+from feedback_cache import FeedbackCache
+from singleflight import FileLocks, SingleFlight
+import admission
+import clients
+import http_payloads
+import id_tokens
+import llm_calls
+import metrics
+from metrics import InstrumentedStorage, log
 
 
 # --- CONFIGURATION ---
@@ -39,24 +47,157 @@ GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "")
 GCP_LOCATION = os.environ.get("GCP_LOCATION", "us-central1")
 TUNED_MODEL = os.environ.get("TUNED_MODEL", "")
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY")
+TTS_VOICE_ID = "21m00Tcm4TlvDq8ikWAM"
+TTS_MODEL = "eleven_monolingual_v1"
+TTS_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.75,
+    "style": 0.0,
+    "use_speaker_boost": True,
+}
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tts_cache"))
+TTS_CACHE_MAX_MB = int(os.environ.get("TTS_CACHE_MAX_MB", "256"))
+# Opt-in: synthesize each patient reply in the background as soon as it is written
+TTS_PREFETCH = os.environ.get("TTS_PREFETCH", "").lower() in ("1", "true", "yes")
+TTS_PREFETCH_WORKERS = int(os.environ.get("TTS_PREFETCH_WORKERS", "2"))
+TTS_PREFETCH_MAX_PENDING = int(os.environ.get("TTS_PREFETCH_MAX_PENDING", "16"))
+TTS_PREFETCH_WAIT_SECONDS = float(os.environ.get("TTS_PREFETCH_WAIT_SECONDS", "30"))
+# "firestore" (default) or "sqlite" for an on-prem/offline deployment
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore")
+SQL_DATABASE_URL = os.environ.get("SQL_DATABASE_URL", "sqlite:///" + os.path.join(os.path.dirname(os.path.abspath(__file__)), "medsim.db"))
+CONVERSATION_CACHE_THREADS = int(os.environ.get("CONVERSATION_CACHE_THREADS", "1024"))
+DELETE_MAX_OPS_PER_SECOND = int(os.environ.get("DELETE_MAX_OPS_PER_SECOND", "500"))
+# GET /api/threads page size: the default, and the most a client may ask for with ?limit=
+THREAD_PAGE_SIZE = int(os.environ.get("THREAD_PAGE_SIZE", "50"))
+THREAD_PAGE_MAX = int(os.environ.get("THREAD_PAGE_MAX", "200"))
+# Patient prompt: recent turns verbatim within a budget, older turns as a rolling summary
+CONTEXT_MAX_TURNS = int(os.environ.get("CONTEXT_MAX_TURNS", "12"))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "4000"))
+CONTEXT_SUMMARY_BATCH = int(os.environ.get("CONTEXT_SUMMARY_BATCH", "6"))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", TUNED_MODEL)
+# Background session evaluation (POST /end?async=1)
+FEEDBACK_CACHE_ENTRIES = int(os.environ.get("FEEDBACK_CACHE_ENTRIES", "256"))
+FEEDBACK_JOB_WORKERS = int(os.environ.get("FEEDBACK_JOB_WORKERS", "2"))
+FEEDBACK_JOB_MAX_PENDING = int(os.environ.get("FEEDBACK_JOB_MAX_PENDING", "32"))
+FEEDBACK_JOB_RETRIES = int(os.environ.get("FEEDBACK_JOB_RETRIES", "3"))
+FEEDBACK_JOB_BACKOFF_SECONDS = float(os.environ.get("FEEDBACK_JOB_BACKOFF_SECONDS", "2"))
+# A queued/running job not updated for this long is assumed lost (worker restarted)
+FEEDBACK_JOB_STALE_SECONDS = int(os.environ.get("FEEDBACK_JOB_STALE_SECONDS", "600"))
+# Admission control: calls in flight per process, and calls a minute per user, for each upstream
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "16"))
+LLM_USER_PER_MINUTE = float(os.environ.get("LLM_USER_PER_MINUTE", "30"))
+FEEDBACK_CONCURRENCY = int(os.environ.get("FEEDBACK_CONCURRENCY", "4"))
+FEEDBACK_USER_PER_MINUTE = float(os.environ.get("FEEDBACK_USER_PER_MINUTE", "4"))
+TTS_CONCURRENCY = int(os.environ.get("TTS_CONCURRENCY", "8"))
+TTS_USER_PER_MINUTE = float(os.environ.get("TTS_USER_PER_MINUTE", "60"))
+# Beyond the concurrency, up to this many calls wait this long for a slot before getting 429
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "10"))
+# Directory for lock files that coalesce identical requests across worker processes on one host; empty = per process
+SINGLEFLIGHT_LOCK_DIR = os.environ.get("SINGLEFLIGHT_LOCK_DIR", "")
+SINGLEFLIGHT_LOCK_WAIT_SECONDS = float(os.environ.get("SINGLEFLIGHT_LOCK_WAIT_SECONDS", "60"))
+# Gemini call policies (see llm_calls.py): deadline covering all attempts, retries, hedging past the p95
+LLM_REPLY_DEADLINE_SECONDS = float(os.environ.get("LLM_REPLY_DEADLINE_SECONDS", "20"))
+LLM_REPLY_RETRIES = int(os.environ.get("LLM_REPLY_RETRIES", "2"))
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "true").lower() in ("1", "true", "yes")
+SUMMARY_DEADLINE_SECONDS = float(os.environ.get("SUMMARY_DEADLINE_SECONDS", "30"))
+# If set, GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Build the SDK clients and open their connections in the background at startup
+CLIENT_WARMUP = os.environ.get("CLIENT_WARMUP", "").lower() in ("1", "true", "yes")
 
 # --- INITIALIZATION ---
-db = firestore.Client(project=GCP_PROJECT_ID)
+# Nothing below connects to anything: clients are built on first use (see clients.py)
+def create_storage() -> Storage:
+    if STORAGE_BACKEND == "sqlite":
+        from storage_sql import SQLStorage
+        return SQLStorage(SQL_DATABASE_URL)
+    from storage_firestore import FirestoreStorage
+    return FirestoreStorage(
+        clients.get("firestore"),
+        ConversationCache(CONVERSATION_CACHE_THREADS),
+        delete_ops_per_second=DELETE_MAX_OPS_PER_SECOND,
+    )
 
-genai_client = genai.Client(vertexai=True, project=GCP_PROJECT_ID, location=GCP_LOCATION)
 
-elevenlabs_client = None
-if ELEVENLABS_AVAILABLE and ELEVENLABS_API_KEY:
-    try:
-        elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
-        print("✅ ElevenLabs initialized successfully")
-    except Exception as e:
-        print(f"❌ ElevenLabs initialization failed: {e}")
-else:
-    print("⚠️ ElevenLabs unavailable or missing API key")
+clients.register("storage", create_storage)
+store = InstrumentedStorage(clients.lazy("storage"))
+
+# The one genai client, shared with feedback.py
+genai_client = clients.lazy("genai")
+patient_llm = llm_calls.ResilientGenAI(genai_client, "patient", LLM_REPLY_DEADLINE_SECONDS, LLM_REPLY_RETRIES, hedge=LLM_HEDGE)
+# Background and skippable: one retry, never hedged
+summary_llm = llm_calls.ResilientGenAI(genai_client, "summary", SUMMARY_DEADLINE_SECONDS, retries=1)
+
+if CLIENT_WARMUP:
+    _warm = ["storage", "genai", "elevenlabs"] + (["firestore"] if STORAGE_BACKEND == "firestore" else [])
+    threading.Thread(target=clients.warmup, args=(_warm,), name="client-warmup", daemon=True).start()
+
+feedback_cache = FeedbackCache(store.get_cached_feedback, store.put_cached_feedback, FEEDBACK_CACHE_ENTRIES)
+
+audio_cache = AudioCache(TTS_CACHE_DIR, TTS_CACHE_MAX_MB * 1024 * 1024)
+
+# Patient replies and context summaries; session evaluations (several Gemini calls each); ElevenLabs
+llm_admission = admission.Upstream("llm", LLM_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_SECONDS, LLM_USER_PER_MINUTE)
+feedback_admission = admission.Upstream(
+    "feedback", FEEDBACK_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_SECONDS, FEEDBACK_USER_PER_MINUTE
+)
+tts_admission = admission.Upstream("tts", TTS_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_SECONDS, TTS_USER_PER_MINUTE)
+
+# Duplicate speech, analytics and end-session requests share one computation (see singleflight.py)
+flights = SingleFlight(FileLocks(SINGLEFLIGHT_LOCK_DIR) if SINGLEFLIGHT_LOCK_DIR else None, SINGLEFLIGHT_LOCK_WAIT_SECONDS)
+
+# Response headers the frontend reads; asgi.py's CORS middleware exposes the same ones
+CORS_EXPOSE_HEADERS = ["X-Next-Cursor", "ETag", "Retry-After"]
 
 app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": [FRONTEND_ORIGIN]}}, supports_credentials=False)
+app.json = http_payloads.JSONProvider(app)
+CORS(app, resources={r"/api/*": {"origins": [FRONTEND_ORIGIN]}}, supports_credentials=False, expose_headers=CORS_EXPOSE_HEADERS)
+
+
+@app.before_request
+def start_trace():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace = metrics.begin_request(route, request.headers.get("X-Request-ID"))
+
+
+@app.after_request
+def finish_trace(response):
+    trace = g.pop("trace", None)
+    if trace is not None:
+        response.headers["X-Request-ID"] = trace.trace_id
+        if response.is_streamed and not response.direct_passthrough:
+            # A generated body is still being produced: record once the server closes it
+            method, status = request.method, response.status_code
+            response.call_on_close(lambda: metrics.end_request(trace, method, status))
+        else:
+            metrics.end_request(trace, request.method, response.status_code)
+    return response
+
+
+app.after_request(http_payloads.compress)
+
+
+@app.errorhandler(admission.Rejected)
+def too_many_requests(e: admission.Rejected):
+    log(f"🚦 {e}")
+    response = jsonify({
+        "message": f"The service is busy, please try again in {e.retry_after}s",
+        "retry_after": e.retry_after,
+    })
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 429
+
+
+@app.errorhandler(llm_calls.Unavailable)
+def model_unavailable(e: llm_calls.Unavailable):
+    log(f"🚧 {e}")
+    response = jsonify({
+        "message": f"The AI model is not responding, please try again in {e.retry_after}s",
+        "retry_after": e.retry_after,
+    })
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 503
 
 
 # --- AUTH HELPERS ---
@@ -69,9 +210,8 @@ def create_token(uid: str, email: str) -> str:
     return jwt.encode(payload, SECRET, algorithm="HS256")
 
 
-def current_user() -> Optional[str]:
-    auth = request.headers.get("Authorization", "")
-    parts = auth.split()
+def user_from_authorization(auth: str) -> Optional[str]:
+    parts = (auth or "").split()
     if len(parts) == 2 and parts[0].lower() == "bearer":
         token = parts[1]
         try:
@@ -82,6 +222,10 @@ def current_user() -> Optional[str]:
     return None
 
 
+def current_user() -> Optional[str]:
+    return user_from_authorization(request.headers.get("Authorization", ""))
+
+
 def login_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -94,79 +238,320 @@ def login_required(fn):
 
 
 # --- ELEVENLABS TTS ---
-def generate_speech_elevenlabs(text: str) -> bytes:
+def _speech_key(text: str) -> str:
+    return cache_key(text, TTS_VOICE_ID, TTS_MODEL, TTS_VOICE_SETTINGS)
+
+
+def _synthesize_speech(key: str, text: str) -> str:
+    path = audio_cache.peek(key)  # another worker may have finished it meanwhile
+    if path:
+        return path
+    elevenlabs_client = clients.get("elevenlabs")
     if not elevenlabs_client:
         raise Exception("ElevenLabs not configured properly")
-    audio_generator = elevenlabs_client.generate(
-        text=text,
-        voice="21m00Tcm4TlvDq8ikWAM",
-        model="eleven_monolingual_v1",
-        voice_settings=VoiceSettings(
-            stability=0.5,
-            similarity_boost=0.75,
-            style=0.0,
-            use_speaker_boost=True
+    from elevenlabs import VoiceSettings
+    with tts_admission.slot(), metrics.observe_tts() as result:
+        audio_generator = elevenlabs_client.generate(
+            text=text,
+            voice=TTS_VOICE_ID,
+            model=TTS_MODEL,
+            voice_settings=VoiceSettings(**TTS_VOICE_SETTINGS)
         )
-    )
-    return b"".join(audio_generator)
+        path = audio_cache.put(key, audio_generator)  # the audio streams in while this writes
+        result["bytes"] = os.path.getsize(path)
+    return path
+
+
+speech_prefetcher = SpeechPrefetcher(
+    _synthesize_speech,
+    max_workers=TTS_PREFETCH_WORKERS,
+    max_pending=TTS_PREFETCH_MAX_PENDING,
+)
+
+
+def generate_speech_elevenlabs(text: str, user_id: Optional[str] = None) -> str:
+    """
+    Return the path of an MP3 for text, calling ElevenLabs only on a cache
+    miss. A miss counts against user_id's speech rate limit.
+    """
+    key = _speech_key(text)
+    path = audio_cache.get(key)
+    if path:
+        return path
+    tts_admission.charge(user_id)
+    # Waits for a background or concurrent synthesis of the same clip if one is running
+    return speech_prefetcher.get_or_synthesize(key, text, timeout=TTS_PREFETCH_WAIT_SECONDS)
+
+
+def prefetch_speech(text: str):
+    if TTS_PREFETCH and text and clients.get("elevenlabs"):
+        speech_prefetcher.submit(_speech_key(text), text)
 
 
 # --- GEMINI SIMULATION ---
-def simulate_patient_reply(prompt: str, conversation_history: List[dict] = None) -> str:
+def _offline_patient_reply(prompt: str) -> str:
+    p = prompt.lower()
+    if any(k in p for k in ["pain", "ache", "hurt"]):
+        return "I've had a dull ache for about 3 days. It gets worse when I move."
+    if any(k in p for k in ["fever", "temperature"]):
+        return "I felt feverish yesterday night, around 101°F, with chills."
+    if any(k in p for k in ["cough", "breath", "chest"]):
+        return "I've been coughing a lot and feel a little short of breath after climbing stairs."
+    if any(k in p for k in ["medication", "allergy", "drug"]):
+        return "I take only a daily multivitamin. I'm allergic to penicillin."
+    return "I'm not sure, doctor. Could you explain what you mean?"
+
+
+def _patient_request(prompt: str, conversation_history: List[dict] = None, summary: str = None, summary_upto: int = 0) -> dict:
+    history = conversation_history or []
+    # Never more than the window, so the prompt stays the same size however long the session runs. Summaries
+    # are skipped under load, and turns between summary_upto and the window wait for the next one to catch up.
+    start = patient_context.window_start(history, CONTEXT_MAX_TURNS, CONTEXT_TOKEN_BUDGET)
+    from google.genai.types import GenerateContentConfig
+    return {
+        "model": TUNED_MODEL,
+        "contents": patient_context.build_contents(history[start:], prompt),
+        "config": GenerateContentConfig(
+            system_instruction=patient_context.system_instruction(SYSTEM_INSTRUCTION, summary),
+            temperature=0.3,
+        ),
+    }
+
+
+def simulate_patient_reply(prompt: str, conversation_history: List[dict] = None, summary: str = None, summary_upto: int = 0) -> str:
+    """
+    The patient's answer. Raises llm_calls.Unavailable (or the model's own
+    error) instead of answering with a stock line, so a failed turn is never
+    saved to the transcript.
+    """
+    if not GCP_PROJECT_ID:
+        return _offline_patient_reply(prompt)
+    response = patient_llm.models.generate_content(**_patient_request(prompt, conversation_history, summary, summary_upto))
+    return response.text.strip() if response and response.text else "I'm not sure how to respond to that."
+
+
+def stream_patient_reply(prompt: str, conversation_history: List[dict] = None, summary: str = None, summary_upto: int = 0) -> Iterator[str]:
+    """Yield the patient reply in text chunks as the model produces them.
+
+    Errors are raised to the caller instead of being replaced by a stock line,
+    because some chunks may already have been sent to the client.
+    """
+    if not GCP_PROJECT_ID:
+        yield _offline_patient_reply(prompt)
+        return
+    for chunk in patient_llm.models.generate_content_stream(**_patient_request(prompt, conversation_history, summary, summary_upto)):
+        if chunk and chunk.text:
+            yield chunk.text
+
+
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-summary")
+_summaries_in_flight = set()
+_summaries_lock = threading.Lock()
+
+
+def refresh_summary(user_id: str, thread_id: str, thread_data: dict, messages: List[dict]):
+    """
+    Once enough turns have fallen out of the verbatim window, fold them into
+    the thread's rolling summary in the background, so no turn waits on it.
+    """
     if not GCP_PROJECT_ID:
-        p = prompt.lower()
-        if any(k in p for k in ["pain", "ache", "hurt"]):
-            return "I've had a dull ache for about 3 days. It gets worse when I move."
-        if any(k in p for k in ["fever", "temperature"]):
-            return "I felt feverish yesterday night, around 101°F, with chills."
-        if any(k in p for k in ["cough", "breath", "chest"]):
-            return "I've been coughing a lot and feel a little short of breath after climbing stairs."
-        if any(k in p for k in ["medication", "allergy", "drug"]):
-            return "I take only a daily multivitamin. I'm allergic to penicillin."
-        return "I'm not sure, doctor. Could you explain what you mean?"
+        return
+    upto = thread_data.get("summary_upto") or 0
+    start = patient_context.window_start(messages, CONTEXT_MAX_TURNS, CONTEXT_TOKEN_BUDGET)
+    if start - upto < CONTEXT_SUMMARY_BATCH:
+        return
+    key = (user_id, thread_id)
+    with _summaries_lock:
+        if key in _summaries_in_flight:
+            return
+        _summaries_in_flight.add(key)
+    summary_executor.submit(_update_summary, user_id, thread_id, thread_data.get("context_summary"), upto, messages[upto:start], start)
+
+
+def _update_summary(user_id: str, thread_id: str, summary: str, upto: int, messages: List[dict], new_upto: int):
     try:
-        context = ""
-        if conversation_history:
-            for msg in conversation_history:
-                role = msg["role"].capitalize()
-                context += f"{role}: {msg['content']}\n"
-        full_prompt = f"{context}\nDoctor: {prompt}\n"
-        contents = [Content(role="user", parts=[Part.from_text(text=full_prompt)])]
-        response = genai_client.models.generate_content(
-            model=TUNED_MODEL,
-            contents=contents,
-            config=GenerateContentConfig(
-                system_instruction=SYSTEM_INSTRUCTION,
-                temperature=0.3,
-            ),
-        )
-        return response.text.strip() if response and response.text else "I'm not sure how to respond to that."
+        # Optional work: skipped rather than queued when replies are using every slot
+        with llm_admission.slot(wait=0):
+            text = patient_context.summarize(summary_llm, SUMMARY_MODEL, summary, messages)
+        store.save_summary(user_id, thread_id, upto, text, new_upto)
     except Exception as e:
-        print(f"⚠️ Gemini error: {e}")
-        return "I'm having trouble expressing myself right now."
+        log(f"⚠️ Context summary failed: {e}")
+    finally:
+        with _summaries_lock:
+            _summaries_in_flight.discard((user_id, thread_id))
 
 
 # --- FEEDBACK ---
-def generate_feedback_for_thread(user_id: str, thread_id: str) -> dict:
-    msgs_ref = (
-        db.collection("users")
-          .document(user_id)
-          .collection("threads")
-          .document(thread_id)
-          .collection("messages")
-    )
-    messages = [
-        {"role": m.get("role"), "content": m.get("content")}
-        for m in (msg.to_dict() for msg in msgs_ref.order_by("created_at").stream())
-    ]
-    return generate_feedback_json_with_model_v2(messages)
+def generate_feedback_for_thread(user_id: str, thread_id: str, messages: List[dict] = None, wait: Optional[float] = None,
+                                 charge: bool = False) -> dict:
+    """
+    The evaluation of a thread. Uncached ones queue for a slot for up to wait
+    seconds (default ADMISSION_MAX_WAIT_SECONDS), and with charge count
+    against the user's evaluation rate limit.
+    """
+    if messages is None:
+        messages, _ = store.load_messages(user_id, thread_id, store.get_thread(user_id, thread_id) or {})
+    transcript = [{"role": m.get("role"), "content": m.get("content")} for m in messages]
+
+    def evaluate():
+        with feedback_admission.admit(user_id if charge else None, wait):
+            return generate_feedback_json_with_model_v2(transcript)
+
+    # Same transcript, model and prompts: reuse the stored evaluation
+    return feedback_cache.get_or_compute(evaluation_key(transcript), evaluate, lambda result: not is_fallback(result))
+
+
+# --- FEEDBACK JOBS ---
+def _job_is_live(job: dict) -> bool:
+    if job.get("status") == "done":
+        return True
+    if job.get("status") not in ("queued", "running"):
+        return False
+    updated = analytics._as_utc(job.get("updated_at"))
+    if not isinstance(updated, dt.datetime):
+        return True
+    age = dt.datetime.now(dt.timezone.utc) - updated
+    return age.total_seconds() < FEEDBACK_JOB_STALE_SECONDS
+
+
+def enqueue_feedback(user_id: str, thread_id: str, messages: Optional[List[dict]] = None) -> Optional[dict]:
+    """
+    Close the thread and queue its evaluation, reusing the job already
+    started for this transcript. Returns the job, or None if the pool is full;
+    raises LookupError if the thread was deleted in the meantime.
+    Given the thread's messages, a new job that will have to evaluate them
+    (no cached result) counts against the user's evaluation rate limit.
+    """
+    if not feedback_jobs.has_capacity():
+        return None
+    claimed = store.claim_feedback_job(user_id, thread_id, _job_is_live)
+    if claimed is None:
+        raise LookupError(thread_id)
+    job, created = claimed
+    if job["status"] == "done":
+        return job
+    if created and messages is not None:
+        transcript = [{"role": m.get("role"), "content": m.get("content")} for m in messages]
+        try:
+            if feedback_cache.get(evaluation_key(transcript)) is None:
+                feedback_admission.charge(user_id)
+        except admission.Rejected as e:
+            _fail_feedback_job(user_id, thread_id, job["id"], e)
+            raise
+    if not feedback_jobs.submit(user_id, thread_id, job["id"]):
+        if created:
+            _fail_feedback_job(user_id, thread_id, job["id"], Exception("feedback queue full"))
+        return None
+    return job
+
+
+def _run_feedback_job(user_id: str, thread_id: str, job_id: str, attempt: int):
+    store.update_feedback_job(user_id, job_id, {"status": "running", "attempts": attempt, "updated_at": dt.datetime.utcnow()})
+    thread = store.get_thread(user_id, thread_id) or {}
+    messages, _ = store.load_messages(user_id, thread_id, thread)
+    # Already queued once; wait for a slot for as long as the job doesn't count as stale
+    fb_dict = generate_feedback_for_thread(user_id, thread_id, messages, wait=FEEDBACK_JOB_STALE_SECONDS / 2)
+    if is_fallback(fb_dict) and attempt < FEEDBACK_JOB_RETRIES:
+        # Retried with backoff like any other failure; the last attempt stores what it got
+        raise RuntimeError("model evaluation fell back to placeholder scores")
+    store.store_feedback(user_id, thread_id, thread.get("title", "Untitled"), fb_dict)
+    store.update_feedback_job(user_id, job_id, {"status": "done", "error": None, "updated_at": dt.datetime.utcnow()})
+    log(f"✅ Feedback job {job_id} done for thread {thread_id}")
+
+
+def _fail_feedback_job(user_id: str, thread_id: str, job_id: str, error: Exception):
+    store.update_feedback_job(user_id, job_id, {
+        "status": "failed",
+        "error": str(error),
+        "updated_at": dt.datetime.utcnow(),
+    })
+
+
+def _job_response(job: dict) -> dict:
+    return {
+        "id": job["id"],
+        "thread_id": job.get("thread_id"),
+        "status": job.get("status"),
+        "attempts": job.get("attempts", 0),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+    }
+
+
+feedback_jobs = FeedbackJobs(
+    _run_feedback_job,
+    _fail_feedback_job,
+    max_workers=FEEDBACK_JOB_WORKERS,
+    max_pending=FEEDBACK_JOB_MAX_PENDING,
+    retries=FEEDBACK_JOB_RETRIES,
+    backoff=FEEDBACK_JOB_BACKOFF_SECONDS,
+)
 
 
 def _iso(dtobj):
-    # Firestore returns datetime objects; make them JSON-safe
-    if isinstance(dtobj, dt.datetime):
-        return dtobj.isoformat()
-    return dtobj or None
+    # For payloads built outside app.json; jsonify writes datetimes the same way itself
+    return http_payloads.iso(dtobj)
+
+
+def _truthy(value: Optional[str]) -> bool:
+    return (value or "").lower() in ("1", "true")
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+
+def _after_seq(args) -> Optional[int]:
+    """?after_seq=N, or None; ValueError unless N is a non-negative integer."""
+    value = args.get("after_seq")
+    if value in (None, ""):
+        return None
+    after_seq = int(value)
+    if after_seq < 0:
+        raise ValueError(f"negative after_seq: {after_seq}")
+    return after_seq
+
+
+def _turn_messages(history: List[dict], new_messages: List[dict], only_new: bool, after_seq: Optional[int]) -> List[dict]:
+    """What posting a message returns: the transcript, or only its tail with ?only_new=1 or ?after_seq=N."""
+    if only_new:
+        return new_messages
+    if after_seq is not None:
+        return [m for m in history + new_messages if m["seq"] > after_seq]
+    return history + new_messages
+
+
+def _messages_etag(thread_id: str, message_count: int) -> str:
+    # Messages are only ever appended, so the count identifies the transcript
+    return f"{thread_id}.{message_count}"
+
+
+def _thread_response(thread_id: str, data: dict) -> dict:
+    return {
+        "id": thread_id,
+        "title": data.get("title", "New Patient Session"),
+        "status": data.get("status", "open"),
+        "created_at": data.get("created_at"),
+        "updated_at": data.get("updated_at"),
+        "ended_at": data.get("ended_at"),
+    }
+
+
+def _message_response(m: dict) -> dict:
+    return {
+        "id": m["id"],
+        "seq": m.get("seq"),
+        "role": m.get("role"),
+        "content": m.get("content"),
+        "created_at": m.get("created_at"),
+    }
+
+
+def _revalidate(response: Response) -> Response:
+    """Let browsers keep the response but check it with If-None-Match before each reuse."""
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 # --- API ROUTES ---
@@ -175,25 +560,45 @@ def _iso(dtobj):
 @app.get("/api/threads/<thread_id>")
 @login_required
 def get_thread(thread_id):
-    thread_ref = (
-        db.collection("users")
-          .document(request.user_id)
-          .collection("threads")
-          .document(thread_id)
-    )
-    doc = thread_ref.get()
-    if not doc.exists:
+    data = store.get_thread(request.user_id, thread_id)
+    if data is None:
         return jsonify({"message": "Not found"}), 404
 
-    data = doc.to_dict() or {}
-    return jsonify({
-        "id": thread_id,
-        "title": data.get("title", "New Patient Session"),
-        "status": data.get("status", "open"),
-        "created_at": _iso(data.get("created_at")),
-        "updated_at": _iso(data.get("updated_at")),
-        "ended_at": _iso(data.get("ended_at")),
-    })
+    response = jsonify(_thread_response(thread_id, data))
+    response.add_etag()
+    return _revalidate(response).make_conditional(request)
+
+
+@app.get("/api/threads/<thread_id>/bootstrap")
+@login_required
+def bootstrap_thread(thread_id):
+    """
+    Everything the session view needs to open a thread, in one response:
+    the thread, its transcript (from seq ?after_seq=N on, when given) and its
+    feedback, or the feedback job still working on it. The storage reads are
+    issued together instead of one request after another.
+    """
+    try:
+        after_seq = _after_seq(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid after_seq"}), 400
+    session = store.load_session(request.user_id, thread_id)
+    if session is None:
+        return jsonify({"message": "Not found"}), 404
+    thread, loaded, fb = session
+
+    body = {
+        "thread": _thread_response(thread_id, thread),
+        "messages": [_message_response(m) for m in loaded if after_seq is None or m["seq"] > after_seq],
+        "feedback": fb,
+    }
+    if fb is None and thread.get("feedback_job_id"):
+        job = store.get_feedback_job(request.user_id, thread["feedback_job_id"])
+        if job and job.get("status") in ("queued", "running"):
+            body["feedback_job"] = _job_response(job)
+    response = jsonify(body)
+    response.add_etag()
+    return _revalidate(response).make_conditional(request)
 
 @app.post("/api/auth/google-login")
 def google_login():
@@ -203,26 +608,21 @@ def google_login():
     if not idtok or not hospital:
         return jsonify({"message": "Missing id_token or hospital"}), 400
     try:
-        ginfo = id_token.verify_oauth2_token(idtok, grequests.Request(), GOOGLE_CLIENT_ID)
+        ginfo = id_tokens.verify(idtok, GOOGLE_CLIENT_ID)
         email = ginfo["email"]
         name = ginfo.get("name", email.split("@")[0])
         picture = ginfo.get("picture", "")
 
-        users_ref = db.collection("users")
-        query = users_ref.where("email", "==", email).limit(1).stream()
-        user_doc = next(query, None)
-        if user_doc:
-            uid = user_doc.id
-            users_ref.document(uid).update({
+        uid = store.find_user(email)
+        if uid:
+            store.update_user(uid, {
                 "name": name,
                 "picture": picture,
                 "hospital": hospital,
                 "last_login": dt.datetime.utcnow(),
             })
         else:
-            new_doc = users_ref.document()
-            uid = new_doc.id
-            new_doc.set({
+            uid = store.create_user({
                 "email": email,
                 "name": name,
                 "picture": picture,
@@ -247,15 +647,9 @@ def dev_login():
     hospital = data.get("hospital")
     if not email or not hospital:
         return jsonify({"message": "email and hospital required"}), 400
-    users_ref = db.collection("users")
-    query = users_ref.where("email", "==", email).limit(1).stream()
-    user_doc = next(query, None)
-    if user_doc:
-        uid = user_doc.id
-    else:
-        new_doc = users_ref.document()
-        uid = new_doc.id
-        new_doc.set({
+    uid = store.find_user(email)
+    if not uid:
+        uid = store.create_user({
             "email": email,
             "name": email.split("@")[0],
             "hospital": hospital,
@@ -272,396 +666,433 @@ def dev_login():
 @app.get("/api/threads")
 @login_required
 def list_threads():
-    threads_ref = db.collection("users").document(request.user_id).collection("threads").order_by("created_at", direction="DESCENDING")
-    status = request.args.get("status")
-    q = threads_ref
-    if status:
-        q = q.where("status", "==", status)
-    threads = [{"id": t.id, **t.to_dict()} for t in q.stream()]
-    return jsonify(threads)
+    """
+    One page of threads, newest first. ?limit= sets the page size and
+    ?start_after= takes the X-Next-Cursor header of the previous page, which
+    is only set while more threads remain.
+    """
+    try:
+        limit = min(max(int(request.args.get("limit", THREAD_PAGE_SIZE)), 1), THREAD_PAGE_MAX)
+        start_after = decode_cursor(request.args["start_after"]) if request.args.get("start_after") else None
+    except ValueError:
+        return jsonify({"message": "Invalid limit or start_after"}), 400
+    # One extra row tells whether there is a next page
+    threads = store.list_threads(request.user_id, request.args.get("status"), limit + 1, start_after)
+    response = jsonify(threads[:limit])
+    if len(threads) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(threads[limit - 1])
+    return response
 
 
 @app.post("/api/threads")
 @login_required
 def create_thread():
-    threads_ref = db.collection("users").document(request.user_id).collection("threads")
     data = request.get_json() or {}
-    title = (data.get("title") or "").strip()
-    if not title:
-        count = len(list(threads_ref.stream()))
-        title = f"Patient {count + 1}"
-    thread_doc = threads_ref.document()
-    thread_doc.set({
-        "title": title,
-        "status": "open",
-        "created_at": dt.datetime.utcnow(),
-        "updated_at": dt.datetime.utcnow(),
-    })
-    return jsonify({"id": thread_doc.id, "title": title, "status": "open"}), 201
+    thread = store.create_thread(request.user_id, (data.get("title") or "").strip())
+    return jsonify({"id": thread["id"], "title": thread["title"], "status": "open"}), 201
 
 @app.get("/api/threads/<thread_id>/messages")
 @login_required
 def list_messages(thread_id):
-    thread_ref = (
-        db.collection("users")
-          .document(request.user_id)
-          .collection("threads")
-          .document(thread_id)
-    )
-    if not thread_ref.get().exists:
+    """
+    The transcript in seq order, or with ?after_seq=N only the messages after
+    seq N. The ETag changes with the message count, so an If-None-Match
+    that still matches gets a 304 without any message being read.
+    """
+    thread = store.get_thread(request.user_id, thread_id)
+    if thread is None:
         return jsonify({"message": "Not found"}), 404
+    try:
+        after_seq = _after_seq(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid after_seq"}), 400
+
+    count = thread.get("message_count")
+    if count is not None and request.if_none_match.contains_weak(_messages_etag(thread_id, count)):
+        response = Response(status=304)
+        response.set_etag(_messages_etag(thread_id, count))
+        return _revalidate(response)
+
+    if after_seq is None:
+        loaded, count = store.load_messages(request.user_id, thread_id, thread)
+    else:
+        loaded = store.load_messages_after(request.user_id, thread_id, thread, after_seq)
 
-    msgs_ref = thread_ref.collection("messages").order_by("created_at")
-    messages = []
-    for snap in msgs_ref.stream():
-        d = snap.to_dict() or {}
-        messages.append({
-            "id": snap.id,
-            "role": d.get("role"),
-            "content": d.get("content"),
-            "created_at": _iso(d.get("created_at")),
-        })
-
-    return jsonify(messages)
+    response = jsonify([_message_response(m) for m in loaded])
+    if count is not None:
+        response.set_etag(_messages_etag(thread_id, count))
+    return _revalidate(response)
 
 @app.post("/api/threads/<thread_id>/messages")
 @login_required
 def post_message(thread_id):
-    threads_ref = db.collection("users").document(request.user_id).collection("threads").document(thread_id)
-    if not threads_ref.get().exists:
+    """
+    Add a message; doctor messages also get a simulated patient reply.
+    Returns the whole transcript, only the messages added by this call with
+    ?only_new=1, or those after seq N with ?after_seq=N. If the model can't
+    answer, nothing is written and the client gets 503 with Retry-After.
+    """
+    thread_data = store.get_thread(request.user_id, thread_id)
+    if thread_data is None:
         return jsonify({"message": "Thread not found"}), 404
 
     data = request.get_json() or {}
     role = data.get("role")
     content = (data.get("content") or "").strip()
+    try:
+        after_seq = _after_seq(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid after_seq"}), 400
     if role not in ("doctor", "patient") or not content:
         return jsonify({"message": "Invalid payload"}), 400
 
-    msg_ref = threads_ref.collection("messages").document()
-    msg_ref.set({
+    history, count = store.load_messages(request.user_id, thread_id, thread_data)
+
+    new_messages = [{
         "role": role,
         "content": content,
         "created_at": dt.datetime.utcnow(),
-    })
-
+    }]
     if role == "doctor":
-        messages = [{"role": m.get("role"), "content": m.get("content")} for m in (x.to_dict() for x in threads_ref.collection("messages").order_by("created_at").stream())]
-        reply = simulate_patient_reply(content, messages)
-        threads_ref.collection("messages").document().set({
+        with llm_admission.admit(request.user_id):
+            reply = simulate_patient_reply(
+                content,
+                [{"role": m.get("role"), "content": m.get("content")} for m in history],
+                thread_data.get("context_summary"),
+                thread_data.get("summary_upto") or 0,
+            )
+        new_messages.append({
             "role": "patient",
             "content": reply,
             "created_at": dt.datetime.utcnow(),
         })
 
-    threads_ref.update({"updated_at": dt.datetime.utcnow()})
-    messages = [{"id": m.id, **m.to_dict()} for m in threads_ref.collection("messages").order_by("created_at").stream()]
-    return jsonify(messages), 201
-
-
-# @app.post("/api/threads/<thread_id>/end")
-# @login_required
-# def end_thread(thread_id):
-#     thread_ref = db.collection("users").document(request.user_id).collection("threads").document(thread_id)
-#     thread = thread_ref.get()
-#     if not thread.exists:
-#         return jsonify({"message": "Not found"}), 404
-
-#     fb_ref = thread_ref.collection("feedback").document("latest")
-#     fb_dict = generate_feedback_for_thread(request.user_id, thread_id)
-#     thread_ref.update({
-#         "status": "closed",
-#         "ended_at": dt.datetime.utcnow(),
-#         "updated_at": dt.datetime.utcnow()
-#     })
-#     fb_ref.set({
-#         "feedback_text": fb_dict["feedback_text"],
-#         "overall_score": fb_dict["overall_score"],
-#         "rubric_json": fb_dict["sections"],
-#         "created_at": dt.datetime.utcnow(),
-#     })
-#     return jsonify({
-#         "thread": {"id": thread_id, "status": "closed"},
-#         "feedback": fb_dict
-#     }), 200
+    new_messages = store.add_messages(request.user_id, thread_id, thread_data, count, new_messages)
+    if role == "doctor":
+        prefetch_speech(new_messages[-1]["content"])
+    refresh_summary(request.user_id, thread_id, thread_data, history + new_messages)
 
-@app.post("/api/threads/<thread_id>/end")
+    return jsonify(_turn_messages(history, new_messages, _truthy(request.args.get("only_new")), after_seq)), 201
+
+
+@app.post("/api/threads/<thread_id>/messages/stream")
 @login_required
-def end_thread(thread_id):
-    thread_ref = db.collection("users").document(request.user_id).collection("threads").document(thread_id)
-    thread = thread_ref.get()
-    if not thread.exists:
-        return jsonify({"message": "Not found"}), 404
+def post_message_stream(thread_id):
+    """
+    Streaming variant of post_message. Sends the patient reply as Server-Sent
+    Events ("token" events with text chunks, then "done" with the transcript,
+    or its tail with ?only_new=1 or ?after_seq=N).
+    Nothing is written until the reply is complete, so a client that drops
+    mid-stream leaves neither a half reply nor an unanswered question behind.
+    """
+    thread_data = store.get_thread(request.user_id, thread_id)
+    if thread_data is None:
+        return jsonify({"message": "Thread not found"}), 404
+
+    data = request.get_json() or {}
+    content = (data.get("content") or "").strip()
+    try:
+        after_seq = _after_seq(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid after_seq"}), 400
+    if data.get("role") != "doctor" or not content:
+        return jsonify({"message": "Invalid payload"}), 400
+
+    history, count = store.load_messages(request.user_id, thread_id, thread_data)
+    asked_at = dt.datetime.utcnow()
+    user_id = request.user_id  # the generator runs after the request context is gone
+    only_new = _truthy(request.args.get("only_new"))
+    if GCP_PROJECT_ID:
+        patient_llm.check()  # fail fast with a 503 while Vertex is down, before the stream starts
+    # Admitted before any byte is sent, so a refusal can still be a 429; held until the stream ends
+    llm_admission.charge(user_id)
+    release = llm_admission.acquire()
+
+    def generate():
+        parts = []
+        try:
+            for text in stream_patient_reply(
+                content,
+                [{"role": m.get("role"), "content": m.get("content")} for m in history],
+                thread_data.get("context_summary"),
+                thread_data.get("summary_upto") or 0,
+            ):
+                parts.append(text)
+                yield _sse("token", {"text": text})
+        except Exception as e:
+            log(f"⚠️ Gemini stream error: {e}")
+            yield _sse("error", {"message": "Patient reply failed, please resend your message."})
+            return
+        finally:
+            release()
+
+        reply = "".join(parts).strip() or "I'm not sure how to respond to that."
+        new_messages = store.add_messages(user_id, thread_id, thread_data, count, [
+            {"role": "doctor", "content": content, "created_at": asked_at},
+            {"role": "patient", "content": reply, "created_at": dt.datetime.utcnow()},
+        ])
+        prefetch_speech(reply)
+        refresh_summary(user_id, thread_id, thread_data, history + new_messages)
+
+        messages = _turn_messages(history, new_messages, only_new, after_seq)
+        yield _sse("done", {"messages": messages})
+
+    response = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(release)  # in case the body is never iterated
+    return response
+
+
+def _end_thread(user_id: str, thread_id: str, run_async: bool) -> Tuple[dict, int]:
+    thread = store.get_thread(user_id, thread_id)
+    if thread is None:
+        return {"message": "Not found"}, 404
 
     # ✅ CHECK MESSAGE COUNT - Don't evaluate empty sessions
-    msgs_ref = thread_ref.collection("messages")
-    messages = list(msgs_ref.stream())
+    messages, _ = store.load_messages(user_id, thread_id, thread)
     
     # Count doctor messages (actual conversation)
-    doctor_messages = [m for m in messages if m.to_dict().get("role") == "doctor"]
+    doctor_messages = [m for m in messages if m.get("role") == "doctor"]
     
     if len(doctor_messages) < 2:
         # Too few messages - delete the thread entirely
-        print(f"⚠️ Deleting empty thread {thread_id} - only {len(doctor_messages)} doctor messages")
+        log(f"⚠️ Deleting empty thread {thread_id} - only {len(doctor_messages)} doctor messages")
         
-        # Delete all messages first
-        for msg in messages:
-            msg.reference.delete()
+        store.delete_thread(user_id, thread_id, messages)
         
-        # Delete the thread
-        thread_ref.delete()
-        
-        return jsonify({
+        return {
             "message": "Thread deleted - insufficient conversation for evaluation",
             "deleted": True
-        }), 200
-    
+        }, 200
+
+    # Charged only where an evaluation actually starts: not for cached results or a job already running
+    if run_async:
+        try:
+            job = enqueue_feedback(user_id, thread_id, messages)
+        except LookupError:
+            return {"message": "Not found"}, 404
+        if job is None:
+            return {"message": "Feedback queue is full, please try again shortly"}, 503
+        return {
+            "thread": {"id": thread_id, "status": "closed"},
+            "job": _job_response(job)
+        }, 200 if job["status"] == "done" else 202
+
     # Proceed with normal feedback generation
     try:
-        fb_dict = generate_feedback_for_thread(request.user_id, thread_id)
-        
-        thread_ref.update({
-            "status": "closed",
-            "ended_at": dt.datetime.utcnow(),
-            "updated_at": dt.datetime.utcnow()
-        })
-        
-        fb_ref = thread_ref.collection("feedback").document("latest")
-        fb_ref.set({
-            "feedback_text": fb_dict["feedback_text"],
-            "overall_score": fb_dict["overall_score"],
-            "rubric_json": fb_dict["sections"],
-            "created_at": dt.datetime.utcnow(),
-        })
+        fb_dict = generate_feedback_for_thread(user_id, thread_id, messages, charge=True)
+        store.store_feedback(user_id, thread_id, thread.get("title", "Untitled"), fb_dict)
         
-        return jsonify({
+        return {
             "thread": {"id": thread_id, "status": "closed"},
             "feedback": fb_dict
-        }), 200
-        
+        }, 200
+
+    except (admission.Rejected, llm_calls.Unavailable):
+        raise
     except Exception as e:
-        print(f"❌ Feedback generation failed: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"message": f"Failed to generate feedback: {str(e)}"}), 500
+        log(f"❌ Feedback generation failed: {e}\n{traceback.format_exc()}")
+        return {"message": f"Failed to generate feedback: {str(e)}"}, 500
+
+
+@app.post("/api/threads/<thread_id>/end")
+@login_required
+def end_thread(thread_id):
+    run_async = _truthy(request.args.get("async"))
+    # A double-clicked "End session" evaluates, stores and counts against the rate limit once
+    body, status = flights.do(
+        (request.user_id, "end", thread_id, run_async),
+        lambda: _end_thread(request.user_id, thread_id, run_async),
+    )
+    return jsonify(body), status
 
 @app.get("/api/threads/<thread_id>/feedback")
 @login_required
 def get_feedback(thread_id):
-    fb_ref = (
-        db.collection("users")
-          .document(request.user_id)
-          .collection("threads")
-          .document(thread_id)
-          .collection("feedback")
-          .document("latest")
-    )
-    fb = fb_ref.get()
-    if not fb.exists:
+    fb = store.get_feedback(request.user_id, thread_id)
+    if fb is None:
+        # Still being evaluated in the background?
+        job_id = (store.get_thread(request.user_id, thread_id) or {}).get("feedback_job_id")
+        job = store.get_feedback_job(request.user_id, job_id) if job_id else None
+        if job and job.get("status") in ("queued", "running"):
+            return jsonify({"message": "Feedback in progress", "job": _job_response(job)}), 202
         return jsonify({"message": "Feedback not available"}), 404
-    return jsonify(fb.to_dict())
+    return jsonify(fb)
+
+
+@app.get("/api/feedback/jobs/<job_id>")
+@login_required
+def get_feedback_job(job_id):
+    job = store.get_feedback_job(request.user_id, job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    response = _job_response(job)
+    if job["status"] == "done":
+        response["feedback"] = store.get_feedback(request.user_id, job["thread_id"])
+    return jsonify(response)
+
+
+def _speech_file(found_data: Optional[dict], user_id: str) -> Tuple[Optional[str], Optional[str], int]:
+    """(mp3 path, None, 200) for a patient message, else (None, error message, status)."""
+    if not found_data:
+        return None, "Message not found", 404
+
+    # Only patient messages are allowed for TTS
+    if found_data.get("role") != "patient":
+        return None, "Only patient messages have speech", 400
+
+    text = (found_data.get("content") or "").strip()
+    if not text:
+        return None, "Message has no content", 400
+
+    return generate_speech_elevenlabs(text, user_id), None, 200
+
+
+def _speech_response(msg_id: str, find: Callable[[], Optional[dict]]):
+    # A double-clicked play button looks the message up and synthesizes it once
+    user_id = request.user_id
+    path, error, status = flights.do((user_id, "speech", msg_id), lambda: _speech_file(find(), user_id))
+    if error:
+        return jsonify({"message": error}), status
+    return send_file(
+        path,
+        mimetype="audio/mpeg",
+        as_attachment=False,
+        download_name=f"patient_{msg_id}.mp3"
+    )
+
+
+def _speech_error(e: Exception):
+    log(f"❌ ElevenLabs error: {e}\n{traceback.format_exc()}")
+    return jsonify({"message": f"Speech generation failed: {str(e)}"}), 500
+
+
+@app.get("/api/threads/<thread_id>/messages/<msg_id>/speech")
+@login_required
+def get_thread_message_speech(thread_id, msg_id):
+    """Thread-scoped speech lookup: a single message read."""
+    try:
+        return _speech_response(msg_id, lambda: store.find_message(request.user_id, msg_id, thread_id))
+    except admission.Rejected:
+        raise
+    except Exception as e:
+        return _speech_error(e)
 
 
 @app.get("/api/messages/<msg_id>/speech")
 @login_required
 def get_message_speech(msg_id):
     """
-    Look up the message under the current user's threads in Firestore,
-    ensure it's a patient message, then return ElevenLabs TTS audio.
+    Look up the message under the current user's threads, ensure it's a
+    patient message, then return ElevenLabs TTS audio.
     """
     try:
-        user_ref = db.collection("users").document(request.user_id)
-        threads_ref = user_ref.collection("threads")
-
-        found_data = None
-
-        # Search each thread's messages for this message ID
-        for thread_snap in threads_ref.stream():
-            msg_snap = (
-                threads_ref
-                .document(thread_snap.id)
-                .collection("messages")
-                .document(msg_id)
-                .get()
-            )
-            if msg_snap.exists:
-                found_data = msg_snap.to_dict() or {}
-                break
+        return _speech_response(msg_id, lambda: store.find_message(request.user_id, msg_id))
+    except admission.Rejected:
+        raise
+    except Exception as e:
+        return _speech_error(e)
 
-        if not found_data:
-            return jsonify({"message": "Message not found"}), 404
+@app.get("/api/tts/cache")
+@login_required
+def get_tts_cache_stats():
+    return jsonify({**audio_cache.stats(), "prefetch": speech_prefetcher.stats()})
 
-        # Only patient messages are allowed for TTS
-        if found_data.get("role") != "patient":
-            return jsonify({"message": "Only patient messages have speech"}), 400
 
-        text = (found_data.get("content") or "").strip()
-        if not text:
-            return jsonify({"message": "Message has no content"}), 400
+@app.get("/api/feedback/jobs")
+@login_required
+def get_feedback_job_stats():
+    return jsonify({**feedback_jobs.stats(), "cache": feedback_cache.stats()})
 
-        # If you implemented expressions, this will use them; otherwise we fall back.
-        try:
-            expression = found_data.get("expression")  # may be None for older messages
-            audio_bytes = generate_speech_elevenlabs_expressive(text, expression)
-        except NameError:
-            # expressive helper not defined → use the basic TTS
-            audio_bytes = generate_speech_elevenlabs(text)
-
-        return send_file(
-            BytesIO(audio_bytes),
-            mimetype="audio/mpeg",
-            as_attachment=False,
-            download_name=f"patient_{msg_id}.mp3"
-        )
-    except Exception as e:
-        print(f"❌ ElevenLabs error: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"message": f"Speech generation failed: {str(e)}"}), 500
-    
-# Add this to app.py after the other routes
 
-# Replace the @app.get("/api/analytics") endpoint in app.py with this:
+@app.get("/api/admission")
+@login_required
+def get_admission_stats():
+    return jsonify({
+        **{u.name: u.stats() for u in (llm_admission, feedback_admission, tts_admission)},
+        "singleflight": flights.stats(),
+        "llm_calls": llm_calls.stats(),
+    })
+
 
 @app.get("/api/analytics")
 @login_required
 def get_analytics():
     """Get comprehensive analytics for the logged-in doctor"""
     try:
-        # Fetch all closed threads (no order_by to avoid index requirement)
-        threads_ref = (
-            db.collection("users")
-            .document(request.user_id)
-            .collection("threads")
-            .where("status", "==", "closed")
-        )
-        
-        sessions_data = []
-        category_totals = {
-            "history": [], "red_flags": [], "meds_allergies": [],
-            "differential": [], "plan": [], "communication": []
-        }
-        overall_scores = []
-        
-        # Collect all threads
-        all_threads = []
-        for thread_snap in threads_ref.stream():
-            thread_data = thread_snap.to_dict()
-            thread_id = thread_snap.id
-            
-            # Get feedback for this thread
-            fb_ref = (
-                db.collection("users").document(request.user_id)
-                .collection("threads").document(thread_id)
-                .collection("feedback").document("latest")
-            )
-            fb_snap = fb_ref.get()
-            
-            if fb_snap.exists:
-                fb_data = fb_snap.to_dict()
-                rubric = fb_data.get("rubric_json", {})
-                if isinstance(rubric, str):
-                    rubric = json.loads(rubric)
-                
-                sections = rubric.get("sections", rubric)
-                overall_score = fb_data.get("overall_score", 0)
-                
-                all_threads.append({
-                    "id": thread_id,
-                    "title": thread_data.get("title", "Untitled"),
-                    "ended_at": thread_data.get("ended_at"),
-                    "ended_at_iso": _iso(thread_data.get("ended_at")),
-                    "overall_score": overall_score,
-                    "sections": sections
-                })
-        
-        # Sort by ended_at in Python (most recent first)
-        all_threads.sort(key=lambda x: x.get("ended_at") or dt.datetime.min, reverse=True)
-        
-        # Process sorted threads
-        for thread in all_threads:
-            overall_scores.append(thread["overall_score"])
-            
-            for category in category_totals.keys():
-                if category in thread["sections"]:
-                    score = thread["sections"][category].get("score", 0)
-                    category_totals[category].append(score)
-            
-            sessions_data.append({
-                "id": thread["id"],
-                "title": thread["title"],
-                "ended_at": thread["ended_at_iso"],
-                "overall_score": thread["overall_score"],
-                "categories": {
-                    cat: thread["sections"].get(cat, {}).get("score", 0) 
-                    for cat in category_totals.keys()
-                }
-            })
-        
-        total_sessions = len(overall_scores)
-        
-        if total_sessions == 0:
-            return jsonify({
-                "total_sessions": 0,
-                "overall_avg": 0,
-                "category_avg": {},
-                "trend_data": [],
-                "recent_sessions": [],
-                "insights": {"strongest": None, "weakest": None, "improvement_areas": []}
-            })
-        
-        overall_avg = sum(overall_scores) / total_sessions
-        
-        # Calculate category averages (convert 0-5 scale to 0-100)
-        category_avg = {
-            cat: (sum(scores) / len(scores) * 20) if scores else 0
-            for cat, scores in category_totals.items()
-        }
-        
-        # Find strongest and weakest areas
-        strongest = max(category_avg.items(), key=lambda x: x[1])
-        weakest = min(category_avg.items(), key=lambda x: x[1])
-        
-        # Improvement areas (categories below 60%)
-        improvement_areas = [
-            {"category": cat, "score": score}
-            for cat, score in category_avg.items() if score < 60
-        ]
-        
-        # Trend data (last 10 sessions, oldest to newest)
-        trend_data = [
-            {
-                "session": f"S{i+1}",
-                "score": sessions_data[i]["overall_score"],
-                "date": sessions_data[i]["ended_at"]
-            }
-            for i in range(min(10, len(sessions_data)))
-        ]
-        trend_data.reverse()  # Reverse to show oldest to newest
-        
-        return jsonify({
-            "total_sessions": total_sessions,
-            "overall_avg": round(overall_avg, 1),
-            "category_avg": {k: round(v, 1) for k, v in category_avg.items()},
-            "trend_data": trend_data,
-            "recent_sessions": sessions_data[:5],  # Last 5 sessions
-            "insights": {
-                "strongest": {"category": strongest[0], "score": round(strongest[1], 1)},
-                "weakest": {"category": weakest[0], "score": round(weakest[1], 1)},
-                "improvement_areas": improvement_areas
-            }
-        })
+        # The dashboard refetching on focus and on mount reads the rollup once
+        user_id = request.user_id
+        return jsonify(flights.do(
+            (user_id, "analytics", None),
+            lambda: analytics.rollup_to_response(store.analytics_rollup(user_id), _iso),
+        ))
         
     except Exception as e:
-        print(f"❌ Analytics error: {e}")
-        import traceback
-        traceback.print_exc()
+        log(f"❌ Analytics error: {e}\n{traceback.format_exc()}")
         return jsonify({"message": f"Analytics failed: {str(e)}"}), 500
 
 
+@app.cli.command("rebuild-analytics")
+@click.option("--user", "user_id", default=None, help="Only rebuild this user id.")
+def rebuild_analytics_command(user_id):
+    """Recompute the analytics rollup for one user or for every user."""
+    user_ids = [user_id] if user_id else store.user_ids()
+    for uid in user_ids:
+        rollup = store.rebuild_analytics(uid)
+        print(f"✅ {uid}: {rollup['total_sessions']} sessions")
+
+
+@app.cli.command("rescore-feedback")
+@click.option("--user", "user_ids", multiple=True, help="Only re-score this user id (repeatable).")
+@click.option("--workers", default=4, show_default=True, help="Evaluations running at once.")
+@click.option("--rpm", default=60.0, show_default=True, help="Maximum evaluations started per minute.")
+@click.option("--batch-size", default=200, show_default=True, help="Threads per commit (max 500).")
+@click.option("--checkpoint", default=".rescore_checkpoint.jsonl", show_default=True, help="Progress file used to resume.")
+@click.option("--restart", is_flag=True, help="Ignore and clear the checkpoint.")
+@click.option("--evaluator", default=None, help="module:function to evaluate with instead of the model (e.g. a local stand-in).")
+def rescore_feedback_command(user_ids, workers, rpm, batch_size, checkpoint, restart, evaluator):
+    """Re-evaluate every closed session with the current rubric prompt."""
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    evaluate = generate_feedback_json_with_model_v2
+    if evaluator:
+        module, _, name = evaluator.partition(":")
+        evaluate = getattr(importlib.import_module(module), name)
+
+    stats = rescore.rescore(
+        store,
+        store.closed_threads(user_ids or None),
+        evaluate,
+        accept=lambda result: not is_fallback(result),
+        workers=workers,
+        per_minute=rpm,
+        # One write per thread; a Firestore commit takes at most 500
+        batch_size=min(batch_size, 500),
+        checkpoint=checkpoint,
+    )
+
+    for uid in stats.pop("users"):
+        store.rebuild_analytics(uid)
+    print(f"✅ Re-scored {stats['written']} sessions in {stats['elapsed_seconds']}s "
+          f"({stats['threads_per_minute']} threads/min): {stats['skipped']} already done, "
+          f"{stats['rejected']} fallback, {stats['errors']} errors")
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text format; see metrics.py for what is recorded."""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"message": "Unauthorized"}), 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.get("/")
 def home():
     status = []
-    if elevenlabs_client:
+    if clients.get("elevenlabs"):
         status.append("ElevenLabs ✅")
     else:
         status.append("ElevenLabs ❌")
@@ -0,0 +1,569 @@
+"""
+Asyncio serving mode for the MediSim API.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5001
+
+The routes that spend their time waiting on Gemini, ElevenLabs or Firestore
+(posting a message, streaming a reply, ending a session, speech) run as
+coroutines on the async Firestore, genai and ElevenLabs clients, so a single
+process can hold many consultations in flight. Every other route is the
+Flask app mounted through WSGI, so paths, JWT auth and response shapes are
+identical to `python app.py`.
+
+The native routes use Firestore directly; with STORAGE_BACKEND=sqlite every
+route is served by the Flask app.
+"""
+import asyncio
+import datetime as dt
+import json
+import os
+import re
+import traceback
+from functools import wraps
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match, Mount, Route
+from starlette.types import ASGIApp, Receive, Scope, Send
+from google.cloud import firestore
+
+import app as backend
+import http_payloads
+import metrics
+from admission import Rejected
+from llm_calls import Unavailable
+from metrics import log
+from storage_firestore import message_index_ref, messages_query, number_messages, stage_turn, write_feedback
+from feedback import generate_feedback_json_with_model_v2_async, evaluation_key, is_fallback
+
+try:
+    from elevenlabs.client import AsyncElevenLabs
+    from elevenlabs import VoiceSettings
+except ImportError:
+    AsyncElevenLabs = None
+
+_async_db = None
+_async_elevenlabs = None
+
+
+def adb() -> firestore.AsyncClient:
+    # Created on first use so it binds to the server's event loop
+    global _async_db
+    if _async_db is None:
+        _async_db = firestore.AsyncClient(project=backend.GCP_PROJECT_ID)
+    return _async_db
+
+
+def _elevenlabs():
+    global _async_elevenlabs
+    if _async_elevenlabs is None and AsyncElevenLabs and backend.ELEVENLABS_API_KEY:
+        _async_elevenlabs = AsyncElevenLabs(api_key=backend.ELEVENLABS_API_KEY)
+    return _async_elevenlabs
+
+
+def _json(data, status: int = 200, request: Optional[Request] = None) -> Response:
+    # Flask's JSON provider, so datetimes etc. serialize exactly as under WSGI.
+    # Pass the request to compress the body as the Flask routes do.
+    body = backend.app.json.dumps(data).encode()
+    if request is None:
+        return Response(body, status_code=status, media_type="application/json")
+    body, encoding = http_payloads.encode_body(body, request.headers.get("accept-encoding"))
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, status_code=status, media_type="application/json", headers=headers)
+
+
+def login_required(fn):
+    @wraps(fn)
+    async def wrapper(request: Request):
+        uid = backend.user_from_authorization(request.headers.get("Authorization", ""))
+        if not uid:
+            return _json({"message": "Unauthorized"}, 401)
+        request.state.user_id = uid
+        return await fn(request)
+    return wrapper
+
+
+async def _body(request: Request) -> dict:
+    try:
+        return await request.json() or {}
+    except ValueError:
+        return {}
+
+
+def _thread_ref(user_id: str, thread_id: str):
+    return adb().collection("users").document(user_id).collection("threads").document(thread_id)
+
+
+# --- CONVERSATION STATE ---
+# The Firestore calls made here rather than through backend.store are timed as the same storage operations
+
+async def get_thread(thread_ref):
+    with metrics.observe_storage("get_thread"):
+        return await thread_ref.get()
+
+
+async def load_messages(thread_ref, thread_snap):
+    """Async counterpart of FirestoreStorage.load_messages, sharing its conversation cache."""
+    count = (thread_snap.to_dict() or {}).get("message_count")
+    cached = backend.store.conversation_cache.get(thread_ref.path, count)
+    if cached is not None:
+        return cached, count
+    thread = thread_snap.to_dict() or {}
+    with metrics.observe_storage("load_messages"):
+        messages = number_messages([{"id": m.id, **m.to_dict()} async for m in messages_query(thread_ref, thread).stream()])
+    if count is None:
+        count = len(messages)
+    backend.store.conversation_cache.put(thread_ref.path, count, messages)
+    return messages, count
+
+
+@firestore.async_transactional
+async def _add_turn_txn(transaction, thread_ref, count: int, messages: List[dict]) -> Tuple[int, List[dict]]:
+    return stage_turn(transaction, thread_ref, await thread_ref.get(transaction=transaction), count, messages)
+
+
+async def commit_turn(thread_ref, count: int, messages: List[dict]) -> List[dict]:
+    """Async counterpart of FirestoreStorage.add_messages."""
+    with metrics.observe_storage("add_messages"):
+        count, written = await _add_turn_txn(adb().transaction(), thread_ref, count, messages)
+    backend.store.conversation_cache.append(thread_ref.path, count, written)
+    return written
+
+
+def _history(messages: List[dict]) -> List[dict]:
+    return [{"role": m.get("role"), "content": m.get("content")} for m in messages]
+
+
+# --- GEMINI SIMULATION ---
+async def simulate_patient_reply(prompt: str, conversation_history: List[dict] = None, summary: str = None, summary_upto: int = 0) -> str:
+    """Raises instead of answering with a stock line; see app.simulate_patient_reply."""
+    if not backend.GCP_PROJECT_ID:
+        return backend._offline_patient_reply(prompt)
+    response = await backend.patient_llm.aio.models.generate_content(
+        **backend._patient_request(prompt, conversation_history, summary, summary_upto)
+    )
+    return response.text.strip() if response and response.text else "I'm not sure how to respond to that."
+
+
+async def stream_patient_reply(prompt: str, conversation_history: List[dict] = None, summary: str = None, summary_upto: int = 0):
+    if not backend.GCP_PROJECT_ID:
+        yield backend._offline_patient_reply(prompt)
+        return
+    async for chunk in backend.patient_llm.aio.models.generate_content_stream(
+        **backend._patient_request(prompt, conversation_history, summary, summary_upto)
+    ):
+        if chunk and chunk.text:
+            yield chunk.text
+
+
+# --- ELEVENLABS TTS ---
+async def _synthesize_speech(key: str, text: str) -> str:
+    path = backend.audio_cache.peek(key)
+    if path:
+        return path
+    client = _elevenlabs()
+    if not client:
+        raise Exception("ElevenLabs not configured properly")
+    async with backend.tts_admission.admit_async():
+        with metrics.observe_tts() as result:
+            audio = await client.generate(
+                text=text,
+                voice=backend.TTS_VOICE_ID,
+                model=backend.TTS_MODEL,
+                voice_settings=VoiceSettings(**backend.TTS_VOICE_SETTINGS),
+            )
+            path = await backend.audio_cache.put_async(key, audio)
+            result["bytes"] = os.path.getsize(path)
+        return path
+
+
+async def generate_speech_elevenlabs(text: str, user_id: str = None) -> str:
+    key = backend._speech_key(text)
+    path = backend.audio_cache.get(key)
+    if path:
+        return path
+    backend.tts_admission.charge(user_id)
+    fut, owner = backend.speech_prefetcher.claim(key)
+    if not owner:
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), backend.TTS_PREFETCH_WAIT_SECONDS)
+        except Exception:
+            return await _synthesize_speech(key, text)
+    try:
+        path = await _synthesize_speech(key, text)
+        fut.set_result(path)
+        return path
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        backend.speech_prefetcher.release(key, fut)
+
+
+async def _speech_file(found_data, user_id: str) -> Tuple[Optional[str], Optional[str], int]:
+    if not found_data:
+        return None, "Message not found", 404
+    if found_data.get("role") != "patient":
+        return None, "Only patient messages have speech", 400
+    text = (found_data.get("content") or "").strip()
+    if not text:
+        return None, "Message has no content", 400
+    return await generate_speech_elevenlabs(text, user_id), None, 200
+
+
+async def _speech_response(msg_id: str, find: Callable[[], Awaitable[Optional[dict]]], user_id: str):
+    async def build():
+        return await _speech_file(await find(), user_id)
+
+    # Shares backend.flights, so a duplicate served by the Flask app joins too
+    path, error, status = await backend.flights.do_async((user_id, "speech", msg_id), build)
+    if error:
+        return _json({"message": error}, status)
+    return FileResponse(
+        path,
+        media_type="audio/mpeg",
+        filename=f"patient_{msg_id}.mp3",
+        content_disposition_type="inline",
+    )
+
+
+def _too_many_requests(request: Request, e: Rejected) -> Response:
+    log(f"🚦 {e}")
+    response = _json({"message": f"The service is busy, please try again in {e.retry_after}s", "retry_after": e.retry_after}, 429)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+def _model_unavailable(request: Request, e: Unavailable) -> Response:
+    log(f"🚧 {e}")
+    response = _json({"message": f"The AI model is not responding, please try again in {e.retry_after}s", "retry_after": e.retry_after}, 503)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+def _speech_error(e: Exception):
+    log(f"❌ ElevenLabs error: {e}\n{traceback.format_exc()}")
+    return _json({"message": f"Speech generation failed: {str(e)}"}, 500)
+
+
+# --- FEEDBACK ---
+async def generate_feedback(transcript: List[dict], user_id: Optional[str] = None) -> dict:
+    """
+    Async counterpart of app.generate_feedback_for_thread, sharing its feedback
+    cache. An evaluation that has to run counts against user_id's rate limit.
+    """
+    cache = backend.feedback_cache
+    key = evaluation_key(transcript)
+    result = await asyncio.to_thread(cache.get, key)
+    if result is not None:
+        return result
+    fut, owner = cache.claim(key)
+    if not owner:
+        return await asyncio.wrap_future(fut)
+    try:
+        async with backend.feedback_admission.admit_async(user_id):
+            result = await generate_feedback_json_with_model_v2_async(transcript)
+        if not is_fallback(result):
+            await asyncio.to_thread(cache.put, key, result)
+        fut.set_result(result)
+        return result
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        cache.release(key, fut)
+
+
+@firestore.async_transactional
+async def _store_feedback_txn(transaction, thread_ref, title: str, fb_dict: dict):
+    user_ref = thread_ref.parent.parent
+    stats_snap = await user_ref.collection("stats").document("analytics").get(transaction=transaction)
+    prev_snap = await thread_ref.collection("feedback").document("latest").get(transaction=transaction)
+    write_feedback(transaction, thread_ref, stats_snap, prev_snap, title, fb_dict)
+
+
+# --- API ROUTES ---
+@login_required
+async def post_message(request: Request):
+    thread_id = request.path_params["thread_id"]
+    threads_ref = _thread_ref(request.state.user_id, thread_id)
+    thread_snap = await get_thread(threads_ref)
+    if not thread_snap.exists:
+        return _json({"message": "Thread not found"}, 404)
+
+    data = await _body(request)
+    role = data.get("role")
+    content = (data.get("content") or "").strip()
+    try:
+        after_seq = backend._after_seq(request.query_params)
+    except ValueError:
+        return _json({"message": "Invalid after_seq"}, 400)
+    if role not in ("doctor", "patient") or not content:
+        return _json({"message": "Invalid payload"}, 400)
+
+    thread_data = thread_snap.to_dict() or {}
+    history, count = await load_messages(threads_ref, thread_snap)
+
+    new_messages = [{"role": role, "content": content, "created_at": dt.datetime.utcnow()}]
+    if role == "doctor":
+        async with backend.llm_admission.admit_async(request.state.user_id):
+            reply = await simulate_patient_reply(
+                content,
+                _history(history),
+                thread_data.get("context_summary"),
+                thread_data.get("summary_upto") or 0,
+            )
+        new_messages.append({"role": "patient", "content": reply, "created_at": dt.datetime.utcnow()})
+
+    new_messages = await commit_turn(threads_ref, count, new_messages)
+    if role == "doctor":
+        backend.prefetch_speech(new_messages[-1]["content"])
+    backend.refresh_summary(request.state.user_id, thread_id, thread_data, history + new_messages)
+
+    only_new = backend._truthy(request.query_params.get("only_new"))
+    return _json(backend._turn_messages(history, new_messages, only_new, after_seq), 201, request)
+
+
+@login_required
+async def post_message_stream(request: Request):
+    thread_id = request.path_params["thread_id"]
+    threads_ref = _thread_ref(request.state.user_id, thread_id)
+    thread_snap = await get_thread(threads_ref)
+    if not thread_snap.exists:
+        return _json({"message": "Thread not found"}, 404)
+
+    data = await _body(request)
+    content = (data.get("content") or "").strip()
+    try:
+        after_seq = backend._after_seq(request.query_params)
+    except ValueError:
+        return _json({"message": "Invalid after_seq"}, 400)
+    if data.get("role") != "doctor" or not content:
+        return _json({"message": "Invalid payload"}, 400)
+    only_new = backend._truthy(request.query_params.get("only_new"))
+
+    thread_data = thread_snap.to_dict() or {}
+    history, count = await load_messages(threads_ref, thread_snap)
+    asked_at = dt.datetime.utcnow()
+    if backend.GCP_PROJECT_ID:
+        backend.patient_llm.check()
+    backend.llm_admission.charge(request.state.user_id)
+    release = await backend.llm_admission.acquire_async()
+
+    async def generate():
+        # A client disconnect cancels this generator before anything is written
+        parts = []
+        try:
+            async for text in stream_patient_reply(
+                content,
+                _history(history),
+                thread_data.get("context_summary"),
+                thread_data.get("summary_upto") or 0,
+            ):
+                parts.append(text)
+                yield backend._sse("token", {"text": text})
+        except Exception as e:
+            log(f"⚠️ Gemini stream error: {e}")
+            yield backend._sse("error", {"message": "Patient reply failed, please resend your message."})
+            return
+        finally:
+            release()
+
+        reply = "".join(parts).strip() or "I'm not sure how to respond to that."
+        new_messages = await commit_turn(threads_ref, count, [
+            {"role": "doctor", "content": content, "created_at": asked_at},
+            {"role": "patient", "content": reply, "created_at": dt.datetime.utcnow()},
+        ])
+        backend.prefetch_speech(reply)
+        backend.refresh_summary(request.state.user_id, thread_id, thread_data, history + new_messages)
+
+        yield backend._sse("done", {"messages": backend._turn_messages(history, new_messages, only_new, after_seq)})
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(release),  # in case the body is never iterated
+    )
+
+
+async def _end_thread(user_id: str, thread_id: str, run_async: bool) -> Tuple[dict, int]:
+    thread_ref = _thread_ref(user_id, thread_id)
+    thread = await get_thread(thread_ref)
+    if not thread.exists:
+        return {"message": "Not found"}, 404
+
+    messages, _ = await load_messages(thread_ref, thread)
+    doctor_messages = [m for m in messages if m.get("role") == "doctor"]
+    if len(doctor_messages) < 2:
+        log(f"⚠️ Deleting empty thread {thread_id} - only {len(doctor_messages)} doctor messages")
+        # The storage method, as under Flask: a bulk writer over every subcollection and the thread_count update
+        await asyncio.to_thread(backend.store.delete_thread, user_id, thread_id, messages)
+        return {
+            "message": "Thread deleted - insufficient conversation for evaluation",
+            "deleted": True
+        }, 200
+
+    # Charged only where an evaluation actually starts: not for cached results or a job already running
+    if run_async:
+        try:
+            job = await asyncio.to_thread(backend.enqueue_feedback, user_id, thread_id, messages)
+        except LookupError:
+            return {"message": "Not found"}, 404
+        if job is None:
+            return {"message": "Feedback queue is full, please try again shortly"}, 503
+        return {
+            "thread": {"id": thread_id, "status": "closed"},
+            "job": backend._job_response(job)
+        }, 200 if job["status"] == "done" else 202
+
+    try:
+        fb_dict = await generate_feedback(_history(messages), user_id)
+        title = (thread.to_dict() or {}).get("title", "Untitled")
+        with metrics.observe_storage("store_feedback"):
+            await _store_feedback_txn(adb().transaction(), thread_ref, title, fb_dict)
+        return {
+            "thread": {"id": thread_id, "status": "closed"},
+            "feedback": fb_dict
+        }, 200
+    except (Rejected, Unavailable):
+        raise
+    except Exception as e:
+        log(f"❌ Feedback generation failed: {e}\n{traceback.format_exc()}")
+        return {"message": f"Failed to generate feedback: {str(e)}"}, 500
+
+
+@login_required
+async def end_thread(request: Request):
+    user_id = request.state.user_id
+    thread_id = request.path_params["thread_id"]
+    run_async = backend._truthy(request.query_params.get("async"))
+    body, status = await backend.flights.do_async(
+        (user_id, "end", thread_id, run_async),
+        lambda: _end_thread(user_id, thread_id, run_async),
+    )
+    return _json(body, status, request)
+
+
+@login_required
+async def get_thread_message_speech(request: Request):
+    thread_id = request.path_params["thread_id"]
+    msg_id = request.path_params["msg_id"]
+    async def find():
+        with metrics.observe_storage("find_message"):
+            msg_snap = await _thread_ref(request.state.user_id, thread_id).collection("messages").document(msg_id).get()
+        return msg_snap.to_dict() if msg_snap.exists else None
+
+    try:
+        return await _speech_response(msg_id, find, request.state.user_id)
+    except Rejected:
+        raise
+    except Exception as e:
+        return _speech_error(e)
+
+
+@login_required
+async def get_message_speech(request: Request):
+    msg_id = request.path_params["msg_id"]
+
+    async def find():
+        user_ref = adb().collection("users").document(request.state.user_id)
+        threads_ref = user_ref.collection("threads")
+        index_ref = message_index_ref(user_ref, msg_id)
+
+        with metrics.observe_storage("find_message"):
+            index_snap = await index_ref.get()
+            if index_snap.exists:
+                thread_id = (index_snap.to_dict() or {}).get("thread_id")
+                msg_snap = await threads_ref.document(thread_id).collection("messages").document(msg_id).get()
+                return (msg_snap.to_dict() or {}) if msg_snap.exists else None
+        # Not indexed: FirestoreStorage.find_message answers, indexing the user's older threads on the first miss
+        return await asyncio.to_thread(backend.store.find_message, request.state.user_id, msg_id)
+
+    try:
+        return await _speech_response(msg_id, find, request.state.user_id)
+    except Rejected:
+        raise
+    except Exception as e:
+        return _speech_error(e)
+
+
+routes = []
+if backend.STORAGE_BACKEND == "firestore":
+    routes = [
+        Route("/api/threads/{thread_id}/messages", post_message, methods=["POST"]),
+        Route("/api/threads/{thread_id}/messages/stream", post_message_stream, methods=["POST"]),
+        Route("/api/threads/{thread_id}/end", end_thread, methods=["POST"]),
+        Route("/api/threads/{thread_id}/messages/{msg_id}/speech", get_thread_message_speech, methods=["GET"]),
+        Route("/api/messages/{msg_id}/speech", get_message_speech, methods=["GET"]),
+    ]
+
+
+
+class TraceNativeRoutes:
+    """
+    The native routes' counterpart of app.start_trace/finish_trace: each
+    request gets a trace (X-Request-ID), a request_seconds observation and
+    its 🧭 line, with the route labelled as Flask would label it. Streamed
+    bodies are timed to their end. Sits outside the exception handlers, so
+    429s and 503s are recorded with their status. The mounted Flask app
+    traces its own requests.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes = [(route, re.sub(r"\{(\w+)(:\w+)?\}", r"<\1>", route.path)) for route in routes]
+
+    def _route(self, scope: Scope) -> Optional[str]:
+        for route, label in self._routes:
+            if route.matches(scope)[0] == Match.FULL:
+                return label
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        route = self._route(scope) if scope["type"] == "http" else None
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+        trace = metrics.begin_request(route, Request(scope).headers.get("X-Request-ID"))
+        status = 500
+
+        async def send_traced(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message)["X-Request-ID"] = trace.trace_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            metrics.end_request(trace, scope["method"], status)
+
+
+app = Starlette(
+    routes=routes + [
+        # Everything else: the Flask app, unchanged
+        Mount("/", app=WSGIMiddleware(backend.app)),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=[backend.FRONTEND_ORIGIN],
+            allow_methods=["*"],
+            allow_headers=["*"],
+            expose_headers=backend.CORS_EXPOSE_HEADERS,
+        ),
+        Middleware(TraceNativeRoutes),
+    ],
+    exception_handlers={Rejected: _too_many_requests, Unavailable: _model_unavailable},
+)
@@ -0,0 +1,427 @@
+"""
+Load and latency benchmark for the MediSim API.
+
+    python bench.py --users 2 --threads 2000 --messages 40 --requests 200 --concurrency 16
+
+Firestore, Gemini, ElevenLabs and Google's signing certs are replaced by
+the in-process fakes in bench_fakes.py (or Firestore by a scratch SQLite
+database with --storage sqlite), each with its own latency and failure rate. The script
+seeds synthetic users, drives each endpoint in turn through the Flask app
+from --concurrency threads, and reports p50/p95/p99 latency, throughput and
+the backend calls each endpoint made.
+"""
+import argparse
+import contextlib
+import datetime as dt
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bench_fakes
+
+ENDPOINTS = ["post_message", "list_threads", "list_messages", "bootstrap", "end", "analytics", "speech", "login"]
+BENCH_CLIENT_ID = "medsim-bench.apps.googleusercontent.com"
+
+SYMPTOMS = ["chest pain", "headache", "cough", "abdominal pain", "back pain", "dizziness", "rash", "fatigue"]
+DOCTOR_LINES = [
+    "When did the {s} start, and has it changed since?",
+    "On a scale of one to ten, how bad is the {s} right now?",
+    "Does anything make the {s} better or worse?",
+    "Have you had {s} like this before, or anything similar in your family?",
+    "Are you taking any medications or supplements for the {s}?",
+    "Any fever, weight loss or night sweats along with the {s}?",
+]
+PATIENT_LINES = [
+    "It started about {n} days ago, mostly in the evenings, and it's been getting a bit worse each day.",
+    "I'd say around {n} out of ten. It was worse this morning when I tried to get out of bed.",
+    "Resting helps a little. Taking the stairs or bending over makes it noticeably worse.",
+    "My father had something like it when he was {n}, but I don't know what they called it.",
+    "Just ibuprofen twice a day for the last {n} days, and a multivitamin. I'm allergic to penicillin.",
+    "No fever that I noticed, but I've been sleeping badly and lost maybe {n} pounds.",
+]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("--storage", choices=["firestore", "sqlite"], default="firestore")
+    p.add_argument("--users", type=int, default=2)
+    p.add_argument("--threads", type=int, default=1000, help="Closed threads per user, each with feedback.")
+    p.add_argument("--messages", type=int, default=40, help="Messages per seeded transcript.")
+    p.add_argument("--open-threads", type=int, default=20, help="Open threads per user that messages are posted to.")
+    p.add_argument("--requests", type=int, default=200, help="Requests per endpoint.")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--endpoints", default=",".join(ENDPOINTS), help="Comma-separated subset of " + ", ".join(ENDPOINTS))
+    p.add_argument("--firestore-ms", type=float, default=8, help="Latency of one Firestore RPC.")
+    p.add_argument("--gemini-ms", type=float, default=800, help="Latency of one Gemini call.")
+    p.add_argument("--tts-ms", type=float, default=400, help="Latency of one ElevenLabs call.")
+    p.add_argument("--certs-ms", type=float, default=80, help="Latency of one fetch of Google's signing certs.")
+    p.add_argument("--jitter", type=float, default=0.25, help="Latency jitter as a fraction of the latency.")
+    p.add_argument("--firestore-failures", type=float, default=0.0, help="Fraction of Firestore RPCs that fail.")
+    p.add_argument("--gemini-failures", type=float, default=0.0)
+    p.add_argument("--gemini-quota", type=int, default=0,
+                   help="Gemini calls allowed at once before the fake answers 429 RESOURCE_EXHAUSTED (0: unlimited).")
+    p.add_argument("--gemini-slow-rate", type=float, default=0.0,
+                   help="Fraction of Gemini calls that take --gemini-slow-ms longer (a latency tail, for hedging and deadlines).")
+    p.add_argument("--gemini-slow-ms", type=float, default=10000)
+    p.add_argument("--tts-failures", type=float, default=0.0)
+    p.add_argument("--accept-encoding", default="gzip, deflate, br", help="Accept-Encoding sent with every request ('' for none).")
+    p.add_argument("--payloads", action="store_true",
+                   help="Only compare JSON serialization CPU and bytes on the wire for one --messages long transcript.")
+    p.add_argument("--seed", type=int, default=None, help="Random seed for the synthetic data.")
+    p.add_argument("--json", dest="json_path", default=None, help="Also write the results to this file.")
+    p.add_argument("--verbose", action="store_true", help="Show the app's own logging.")
+    return p.parse_args()
+
+
+@contextlib.contextmanager
+def quiet(enabled: bool):
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+# --- synthetic data ---
+def synthetic_transcript(rng: random.Random, n: int, start: dt.datetime) -> list:
+    """n alternating doctor/patient messages, worded differently per thread so caches don't collapse them."""
+    symptom = rng.choice(SYMPTOMS)
+    messages = []
+    for i in range(n):
+        if i % 2 == 0:
+            content = rng.choice(DOCTOR_LINES).format(s=symptom)
+        else:
+            content = rng.choice(PATIENT_LINES).format(n=rng.randint(2, 60))
+        messages.append({
+            "role": "doctor" if i % 2 == 0 else "patient",
+            "content": content,
+            "created_at": start + dt.timedelta(seconds=20 * i),
+        })
+    return messages
+
+
+def synthetic_feedback(rng: random.Random) -> dict:
+    from feedback import SECTION_HINTS
+    sections = {
+        key: {"title": hint["title"], "score": rng.randint(1, 5), "feedback": "Covered the basics; probe for red flags earlier."}
+        for key, hint in SECTION_HINTS.items()
+    }
+    return {
+        "feedback_text": "A reasonable consultation with room to tighten the history.",
+        "overall_score": rng.randint(40, 95),
+        "sections": sections,
+    }
+
+
+def seed_thread(store, rng: random.Random, user_id: str, title: str, messages: int, started: dt.datetime) -> tuple:
+    thread = store.create_thread(user_id, title)
+    written = store.add_messages(user_id, thread["id"], thread, 0, synthetic_transcript(rng, messages, started))
+    return thread["id"], written
+
+
+def seed(backend, args, rng: random.Random) -> list:
+    """Create the users and their threads; returns one dict of request targets per user."""
+    store = backend.store
+    users = []
+    for u in range(args.users):
+        email = f"bench{u}@example.com"
+        user_id = store.find_user(email) or store.create_user({
+            "email": email,
+            "name": f"bench{u}",
+            "hospital": "Bench General",
+            "created_at": dt.datetime.utcnow(),
+            "last_login": dt.datetime.utcnow(),
+        })
+        started = dt.datetime.utcnow() - dt.timedelta(days=365)
+        for i in range(args.threads):
+            title = f"Patient {i + 1}"
+            thread_id, _ = seed_thread(store, rng, user_id, title, args.messages, started + dt.timedelta(hours=i))
+            store.store_feedback(user_id, thread_id, title, synthetic_feedback(rng))
+        open_threads, patient_messages = [], []
+        for i in range(args.open_threads):
+            thread_id, written = seed_thread(store, rng, user_id, f"Open {i + 1}", args.messages, dt.datetime.utcnow())
+            open_threads.append(thread_id)
+            patient_messages += [m["id"] for m in written if m["role"] == "patient"]
+        store.rebuild_analytics(user_id)  # as `flask rebuild-analytics` would, so /analytics starts warm
+        users.append({
+            "id": user_id,
+            "email": email,
+            "token": backend.create_token(user_id, email),
+            "open": open_threads,
+            "patient_messages": patient_messages,
+            "to_end": [],
+        })
+    return users
+
+
+def prepare_end_threads(backend, users: list, count: int, rng: random.Random):
+    """Short, distinct open sessions for /end to close (each request closes one)."""
+    for i in range(count):
+        user = users[i % len(users)]
+        thread_id, _ = seed_thread(backend.store, rng, user["id"], f"To end {i + 1}", 8, dt.datetime.utcnow())
+        user["to_end"].append(thread_id)
+
+
+# --- requests ---
+def build_requests(endpoint: str, users: list, count: int, rng: random.Random, certs=None) -> list:
+    """(method, path, json body, user) for count requests spread over the users."""
+    out = []
+    for i in range(count):
+        user = users[i % len(users)]
+        if endpoint == "post_message":
+            thread_id = user["open"][(i // len(users)) % len(user["open"])]
+            body = {"role": "doctor", "content": rng.choice(DOCTOR_LINES).format(s=rng.choice(SYMPTOMS))}
+            out.append(("POST", f"/api/threads/{thread_id}/messages", body, user))
+        elif endpoint == "list_threads":
+            out.append(("GET", "/api/threads", None, user))
+        elif endpoint == "list_messages":
+            out.append(("GET", f"/api/threads/{rng.choice(user['open'])}/messages", None, user))
+        elif endpoint == "bootstrap":
+            out.append(("GET", f"/api/threads/{rng.choice(user['open'])}/bootstrap", None, user))
+        elif endpoint == "end":
+            out.append(("POST", f"/api/threads/{user['to_end'].pop()}/end", {}, user))
+        elif endpoint == "analytics":
+            out.append(("GET", "/api/analytics", None, user))
+        elif endpoint == "speech":
+            out.append(("GET", f"/api/messages/{rng.choice(user['patient_messages'])}/speech", None, user))
+        elif endpoint == "login":
+            body = {"id_token": certs.issue(user["email"], BENCH_CLIENT_ID), "hospital": "Bench General"}
+            out.append(("POST", "/api/auth/google-login", body, user))
+    return out
+
+
+def count_statements(engine, calls):
+    """Count SQL statements (and the selects among them) like the fakes count RPCs."""
+    from sqlalchemy import event
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        calls.count("sql.statements")
+        if statement.lstrip().upper().startswith("SELECT"):
+            calls.count("sql.selects")
+
+    event.listen(engine, "before_cursor_execute", before_execute)
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
+
+
+def run_endpoint(flask_app, calls, endpoint: str, plan: list, concurrency: int, accept_encoding: str = "") -> dict:
+    local = threading.local()
+    sent = []
+
+    def send(spec):
+        method, path, body, user = spec
+        if not hasattr(local, "client"):
+            local.client = flask_app.test_client()
+        with calls.scope(endpoint):
+            started = time.perf_counter()
+            headers = {"Authorization": f"Bearer {user['token']}"}
+            if accept_encoding:
+                headers["Accept-Encoding"] = accept_encoding
+            response = local.client.open(path, method=method, json=body, headers=headers)
+            sent.append(len(response.get_data()))  # as encoded on the wire
+            elapsed = time.perf_counter() - started
+            response.close()
+        return elapsed, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as pool:
+        results = list(pool.map(send, plan))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(ms * 1000 for ms, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {
+        "requests": len(results),
+        "errors": sum(n for status, n in statuses.items() if status >= 400),
+        "statuses": statuses,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "mean_ms": round(sum(latencies) / max(len(latencies), 1), 1),
+        "throughput_rps": round(len(results) / max(wall, 1e-9), 1),
+        "mean_kb": round(sum(sent) / max(len(sent), 1) / 1024, 1),
+    }
+
+
+def print_report(results: dict, backend_calls: dict):
+    print()
+    print(f"{'endpoint':<14} {'reqs':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'KB/req':>8}")
+    for endpoint, r in results.items():
+        print(f"{endpoint:<14} {r['requests']:>6} {r['errors']:>6} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} "
+              f"{r['throughput_rps']:>8} {r['mean_kb']:>8}")
+    for endpoint, r in results.items():
+        if r["errors"]:
+            print(f"  {endpoint} statuses: " + ", ".join(f"{status}={n}" for status, n in sorted(r["statuses"].items())))
+    print()
+    print("Backend calls per request:")
+    for scope in list(results) + ["background"]:
+        counts = backend_calls.get(scope)
+        if not counts:
+            continue
+        per = results[scope]["requests"] if scope in results else 1
+        line = ", ".join(f"{name}={n / per:.1f}" for name, n in sorted(counts.items()))
+        print(f"  {scope:<14} {line}" + (" (totals)" if scope == "background" else ""))
+
+
+def print_model_calls(stats: dict):
+    """Outcomes per Gemini call policy (see llm_calls.py): retries, hedges, timeouts, breaker trips."""
+    config = ("deadline", "retries", "hedge", "p95_seconds")
+    lines = []
+    for name, policy in stats.items():
+        if name == "breaker":
+            continue
+        outcomes = {k: v for k, v in policy.items() if k not in config}
+        if outcomes:
+            p95 = f", p95 {policy['p95_seconds']}s" if policy.get("p95_seconds") is not None else ""
+            lines.append(f"  {name:<14} " + ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items())) + p95)
+    if lines:
+        breaker = stats["breaker"]
+        print(f"Model calls (breaker {breaker['state']}, opened {breaker['opened']}x):")
+        print("\n".join(lines))
+
+
+def payload_report(backend, messages: int, rng: random.Random, rounds: int = 200):
+    """
+    Serialize one transcript as GET .../messages returns it, the old way
+    (Flask's stdlib provider, each timestamp formatted by the route) and
+    through the app's provider, and compress the result.
+    """
+    import gzip
+    from flask import Flask
+    import http_payloads
+
+    started = dt.datetime.utcnow()
+    transcript = []
+    for i in range(messages):
+        line = rng.choice(DOCTOR_LINES if i % 2 == 0 else PATIENT_LINES)
+        transcript.append({
+            "id": f"{i:020d}", "seq": i + 1, "role": "doctor" if i % 2 == 0 else "patient",
+            "content": line.format(s=rng.choice(SYMPTOMS), n=rng.randint(2, 9)),
+            "created_at": started + dt.timedelta(seconds=20 * i, microseconds=rng.randint(0, 999999)),
+        })
+    old_app = Flask("bench-stdlib-json")
+
+    def old():
+        with old_app.app_context():
+            return old_app.json.response([{**m, "created_at": m["created_at"].isoformat()} for m in transcript]).get_data()
+
+    def new():
+        with backend.app.app_context():
+            return backend.app.json.response(transcript).get_data()
+
+    rows = []
+    for name, render in (("stdlib json + _iso", old), ("app provider", new)):
+        cpu = time.process_time()
+        for _ in range(rounds):
+            body = render()
+        rows.append((name, (time.process_time() - cpu) / rounds * 1000, body))
+    provider = "orjson" if http_payloads.orjson is not None else "stdlib json (orjson not installed)"
+    print(f"📦 {messages}-message transcript, {rounds} rounds; app provider uses {provider}")
+    print(f"{'serializer':<20} {'CPU ms':>8} {'bytes':>8} {'gzip':>8} {'br':>8}")
+    for name, ms, body in rows:
+        gz = len(gzip.compress(body, compresslevel=http_payloads.GZIP_LEVEL))
+        br = len(http_payloads.brotli.compress(body, quality=http_payloads.BROTLI_QUALITY)) if http_payloads.brotli else "-"
+        print(f"{name:<20} {ms:>8.3f} {len(body):>8} {gz:>8} {br:>8}")
+    body = rows[-1][2]
+    cpu = time.process_time()
+    for _ in range(rounds):
+        http_payloads.encode_body(body, "gzip")
+    print(f"gzip level {http_payloads.GZIP_LEVEL}: {(time.process_time() - cpu) / rounds * 1000:.3f} CPU ms per response")
+
+
+def main():
+    args = parse_args()
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        sys.exit(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+    rng = random.Random(args.seed)
+
+    calls = bench_fakes.CallLog()
+    firestore_behavior = bench_fakes.Behavior(args.firestore_ms, args.firestore_ms * args.jitter, args.firestore_failures)
+    gemini_behavior = bench_fakes.Behavior(
+        args.gemini_ms, args.gemini_ms * args.jitter, args.gemini_failures, args.gemini_quota,
+        slow_rate=args.gemini_slow_rate, slow_ms=args.gemini_slow_ms,
+    )
+    tts_behavior = bench_fakes.Behavior(args.tts_ms, args.tts_ms * args.jitter, args.tts_failures)
+    certs_behavior = bench_fakes.Behavior(args.certs_ms, args.certs_ms * args.jitter)
+    behaviors = [firestore_behavior, gemini_behavior, tts_behavior, certs_behavior]
+    certs = bench_fakes.FakeGoogleCerts(certs_behavior, calls)
+
+    workdir = tempfile.mkdtemp(prefix="medsim-bench-")
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ["SQL_DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ["TTS_CACHE_DIR"] = os.path.join(workdir, "tts")
+    os.environ["GCP_PROJECT_ID"] = "medsim-bench"  # any value: the fakes answer, but the offline stand-ins stay off
+    os.environ["ELEVENLABS_API_KEY"] = "bench"
+    os.environ["GOOGLE_CLIENT_ID"] = BENCH_CLIENT_ID
+    bench_fakes.install(
+        bench_fakes.FakeFirestore(firestore_behavior, calls) if args.storage == "firestore" else None,
+        bench_fakes.FakeGenAI(gemini_behavior, calls),
+        bench_fakes.FakeElevenLabs(tts_behavior, calls),
+        certs,
+    )
+
+    with quiet(not args.verbose):
+        import app as backend
+
+    if args.payloads:
+        payload_report(backend, args.messages, rng)
+        return
+
+    print(f"🧪 Benchmark data in {workdir} ({args.storage})")
+    if args.storage == "sqlite":
+        count_statements(backend.store.engine, calls)
+    for behavior in behaviors:
+        behavior.active = False
+    seed_started = time.perf_counter()
+    with quiet(not args.verbose):
+        users = seed(backend, args, rng)
+        if "end" in endpoints:
+            prepare_end_threads(backend, users, args.requests, rng)
+    print(f"🌱 Seeded {args.users} users with {args.threads} closed + {args.open_threads} open threads of "
+          f"{args.messages} messages each in {time.perf_counter() - seed_started:.1f}s")
+    for behavior in behaviors:
+        behavior.active = True
+    calls.reset()
+
+    results = {}
+    for endpoint in endpoints:
+        plan = build_requests(endpoint, users, args.requests, rng, certs)
+        print(f"🏃 {endpoint}: {len(plan)} requests, concurrency {args.concurrency}")
+        with quiet(not args.verbose):
+            results[endpoint] = run_endpoint(backend.app, calls, endpoint, plan, args.concurrency, args.accept_encoding)
+
+    # Let background work started by the requests (summaries, speech prefetch) finish
+    with quiet(not args.verbose):
+        backend.summary_executor.shutdown(wait=True)
+    backend_calls = calls.by_scope()
+    print_report(results, backend_calls)
+    print_model_calls(backend.llm_calls.stats())
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({
+                "config": vars(args),
+                "endpoints": {e: {**r, "backend_calls": backend_calls.get(e, {})} for e, r in results.items()},
+                "background_calls": backend_calls.get("background", {}),
+            }, f, indent=2, default=str)
+        print(f"💾 Results written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,774 @@
+"""
+In-process stand-ins for Firestore, Gemini, ElevenLabs and Google's ID-token
+signing certs, used by bench.py.
+
+Each fake sleeps for a configurable latency on every backend round trip,
+fails a configurable fraction of them with the error the real client would
+raise, and counts the calls under the scope (endpoint) of the calling thread.
+"""
+import copy
+import contextvars
+import json
+import random
+import asyncio
+import threading
+import time
+import uuid
+import datetime as dt
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import requests
+from google.api_core import exceptions as gexc
+from google.cloud.firestore_v1 import transforms
+from google.genai import errors as genai_errors
+
+
+class Behavior:
+    """Latency and failure profile of one backend."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, failure_rate: float = 0.0, max_concurrent: int = 0,
+                 slow_rate: float = 0.0, slow_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.max_concurrent = max_concurrent  # calls beyond this many at once are refused, like a quota; 0 = no limit
+        # A long tail: this fraction of calls takes slow_ms longer
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.active = True  # off while seeding
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.overloaded = 0
+
+    def delay(self) -> float:
+        if not self.active:
+            return 0.0
+        latency = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        if self.slow_rate and self._random.random() < self.slow_rate:
+            latency += self.slow_ms
+        return max(0.0, latency) / 1000
+
+    def call(self, error: Callable[[], Exception], overload: Optional[Callable[[], Exception]] = None):
+        """
+        Sleep for one round trip, then maybe raise error(). Beyond
+        max_concurrent calls at once, raise overload() (default error()) straight away.
+        """
+        with self._lock:
+            if self.active and self.max_concurrent and self._in_flight >= self.max_concurrent:
+                self.overloaded += 1
+                raise (overload or error)()
+            self._in_flight += 1
+        try:
+            wait = self.delay()
+            if wait:
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        if self.active and self.failure_rate and self._random.random() < self.failure_rate:
+            raise error()
+
+
+class CallLog:
+    """
+    Backend call counters keyed by (scope, name). The scope follows the
+    context, so reads a request hands to a pool with copy_context() count
+    for that request; plain pool work counts as background.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scope = contextvars.ContextVar("bench_call_scope", default=None)
+        self._counts = Counter()
+
+    @contextmanager
+    def scope(self, name: str):
+        token = self._scope.set(name)
+        try:
+            yield
+        finally:
+            self._scope.reset(token)
+
+    def count(self, name: str, n: int = 1):
+        scope = self._scope.get() or "background"
+        with self._lock:
+            self._counts[(scope, name)] += n
+
+    def by_scope(self) -> dict:
+        out = defaultdict(dict)
+        with self._lock:
+            for (scope, name), n in self._counts.items():
+                out[scope][name] = n
+        return dict(out)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+# --- Firestore ---
+def _unavailable():
+    return gexc.ServiceUnavailable("injected Firestore failure")
+
+
+def _apply(old: Optional[dict], data: dict, merge: bool) -> dict:
+    out = copy.deepcopy(old) if (merge and old) else {}
+    for key, value in data.items():
+        if isinstance(value, transforms.Increment):
+            out[key] = (out.get(key) or 0) + value.value
+        elif value is transforms.SERVER_TIMESTAMP:
+            out[key] = dt.datetime.utcnow()
+        elif value is transforms.DELETE_FIELD:
+            out.pop(key, None)
+        elif isinstance(value, transforms.ArrayUnion):
+            current = list(out.get(key) or [])
+            current.extend(v for v in value.values if v not in current)
+            out[key] = current
+        elif isinstance(value, transforms.ArrayRemove):
+            out[key] = [v for v in out.get(key) or [] if v not in value.values]
+        else:
+            out[key] = copy.deepcopy(value)
+    return out
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.create_time = None
+        self.update_time = None
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[dict]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field: str):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+    def __init__(self, db, path: tuple):
+        self._db = db
+        self._path = path
+        self.id = path[-1]
+
+    @property
+    def path(self) -> str:
+        return "/".join(self._path)
+
+    @property
+    def parent(self):
+        return FakeCollection(self._db, self._path[:-1])
+
+    def collection(self, name: str):
+        return FakeCollection(self._db, self._path + (name,))
+
+    def collections(self):
+        n = len(self._path)
+        return [FakeCollection(self._db, p) for p in list(self._db._collections) if len(p) == n + 1 and p[:n] == self._path]
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        self._db._rpc("get", reads=1)
+        data = self._db._read(self._path)
+        if data is not None and field_paths is not None:
+            data = {k: v for k, v in data.items() if k in field_paths}
+        return FakeSnapshot(self, data)
+
+    def set(self, data: dict, merge: bool = False):
+        self._db._rpc("commit", writes=1)
+        self._db._write(self._path, data, merge)
+
+    def create(self, data: dict):
+        self._db._rpc("commit", writes=1)
+        with self._db._lock:
+            if self._db._read(self._path) is not None:
+                raise gexc.AlreadyExists(f"{self.path} already exists")
+            self._db._write(self._path, data, False)
+
+    def update(self, data: dict):
+        self._db._rpc("commit", writes=1)
+        self._db._update(self._path, data)
+
+    def delete(self):
+        self._db._rpc("commit", writes=1)
+        self._db._delete(self._path)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocument) and other._path == self._path
+
+    def __hash__(self):
+        return hash(self._path)
+
+
+class _AggregationResult:
+    def __init__(self, value: int, alias: str):
+        self.value = value
+        self.alias = alias
+
+
+class _CountQuery:
+    def __init__(self, query, alias: Optional[str]):
+        self._query = query
+        self._alias = alias or "count"
+
+    def get(self, transaction=None, **kwargs):
+        self._query._db._rpc("aggregate", reads=1)
+        return [[_AggregationResult(len(self._query._rows()), self._alias)]]
+
+
+def _matches(data: dict, field: str, op: str, value) -> bool:
+    present = field in data
+    x = data.get(field)
+    if op == "==":
+        return present and x == value
+    if op == "!=":
+        return present and x != value
+    if op == "in":
+        return present and x in value
+    if op == "not-in":
+        return present and x not in value
+    if op == "array_contains":
+        return value in (x or [])
+    if x is None:
+        return False
+    return {"<": x < value, "<=": x <= value, ">": x > value, ">=": x >= value}[op]
+
+
+class FakeQuery:
+    def __init__(self, db, path: tuple, group: bool = False, filters=(), orders=(), limit=None, after=None, fields=None):
+        self._db = db
+        self._path = path
+        self._group = group
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._after = after
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = dict(group=self._group, filters=self._filters, orders=self._orders,
+                     limit=self._limit, after=self._after, fields=self._fields)
+        state.update(changes)
+        return FakeQuery(self._db, self._path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING"):
+        return self._copy(orders=self._orders + [(field_path, str(direction).upper().endswith("DESCENDING"))])
+
+    def limit(self, count: int):
+        return self._copy(limit=count)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(after=document_fields_or_snapshot)
+
+    def count(self, alias: Optional[str] = None):
+        return _CountQuery(self, alias)
+
+    def _rows(self):
+        with self._db._lock:
+            if self._group:
+                collections = [(p, docs) for p, docs in self._db._collections.items() if p[-1] == self._path[-1]]
+            else:
+                collections = [(self._path, self._db._collections.get(self._path, {}))]
+            rows = [
+                (p + (doc_id,), data)
+                for p, docs in collections
+                for doc_id, data in docs.items()
+                if all(_matches(data, f, op, v) for f, op, v in self._filters)
+            ]
+            rows = [(p, copy.deepcopy(d)) for p, d in rows if all(f in d for f, _ in self._orders)]
+        # Firestore orders by document name last, in the direction of the last order
+        rows.sort(key=lambda r: r[0][-1], reverse=bool(self._orders) and self._orders[-1][1])
+        for field, descending in reversed(self._orders):
+            rows.sort(key=lambda r: r[1][field], reverse=descending)
+        if self._after is not None:
+            rows = rows[self._cursor_position(rows):]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return rows
+
+    def _cursor_position(self, rows) -> int:
+        after = self._after
+        values = after.to_dict() if hasattr(after, "to_dict") else after
+        cursor_id = getattr(after, "id", None)
+        for i, (path, data) in enumerate(rows):
+            for field, descending in self._orders:
+                if data[field] != values.get(field):
+                    if (data[field] < values.get(field)) == descending:
+                        return i
+                    break
+            else:
+                if cursor_id is None or path[-1] == cursor_id:
+                    continue
+                if (path[-1] < cursor_id) == (bool(self._orders) and self._orders[-1][1]):
+                    return i
+        return len(rows)
+
+    def stream(self, transaction=None, **kwargs):
+        rows = self._rows()
+        self._db._rpc("query", reads=max(len(rows), 1))
+        for path, data in rows:
+            if self._fields is not None:
+                data = {k: v for k, v in data.items() if k in self._fields}
+            yield FakeSnapshot(FakeDocument(self._db, path), data)
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream(transaction=transaction))
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path: tuple):
+        super().__init__(db, path)
+        self.id = path[-1]
+
+    @property
+    def parent(self):
+        return FakeDocument(self._db, self._path[:-1]) if len(self._path) > 1 else None
+
+    def document(self, document_id: Optional[str] = None):
+        return FakeDocument(self._db, self._path + (document_id or uuid.uuid4().hex[:20],))
+
+    def add(self, data: dict):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+    def list_documents(self):
+        self._db._rpc("query", reads=1)
+        with self._db._lock:
+            return [FakeDocument(self._db, self._path + (doc_id,)) for doc_id in self._db._collections.get(self._path, {})]
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, reference, document_data: dict, merge: bool = False):
+        self._ops.append(("set", reference, document_data, merge))
+
+    def create(self, reference, document_data: dict):
+        self._ops.append(("create", reference, document_data, False))
+
+    def update(self, reference, field_updates: dict):
+        self._ops.append(("update", reference, field_updates, True))
+
+    def delete(self, reference):
+        self._ops.append(("delete", reference, None, False))
+
+    def __len__(self):
+        return len(self._ops)
+
+    def _apply(self):
+        with self._db._lock:
+            for op, ref, data, merge in self._ops:
+                if op == "create" and self._db._read(ref._path) is not None:
+                    raise gexc.AlreadyExists(f"{ref.path} already exists")
+                if op == "update" and self._db._read(ref._path) is None:
+                    raise gexc.NotFound(f"{ref.path} not found")
+            for op, ref, data, merge in self._ops:
+                if op == "delete":
+                    self._db._delete(ref._path)
+                elif op == "update":
+                    self._db._update(ref._path, data)
+                else:
+                    self._db._write(ref._path, data, merge)
+        written, self._ops = len(self._ops), []
+        return [None] * written
+
+    def commit(self, **kwargs):
+        self._db._rpc("commit", writes=len(self._ops))
+        return self._apply()
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    Serialises transactions on the fake's lock from begin to commit, so reads
+    inside a transaction see no concurrent writes (Firestore's pessimistic
+    locking, coarsened to the whole database).
+    """
+
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    def _clean_up(self):
+        self._ops = []
+
+    def _begin(self, retry_id=None):
+        self._db._rpc("begin")
+        self._db._lock.acquire()
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self):
+        try:
+            self._db._rpc("commit", writes=len(self._ops))
+            return self._apply()
+        finally:
+            self._release()
+
+    def _rollback(self):
+        self._ops = []
+        if self._id is not None:
+            self._release()
+
+    def _release(self):
+        self._id = None
+        self._db._lock.release()
+
+
+class FakeBulkWriter:
+    def __init__(self, db):
+        self._batch = FakeWriteBatch(db)
+
+    def set(self, reference, document_data: dict, merge: bool = False):
+        self._batch.set(reference, document_data, merge)
+
+    def create(self, reference, document_data: dict):
+        self._batch.create(reference, document_data)
+
+    def update(self, reference, field_updates: dict):
+        self._batch.update(reference, field_updates)
+
+    def delete(self, reference):
+        self._batch.delete(reference)
+
+    def on_write_error(self, callback):
+        pass
+
+    def flush(self):
+        if len(self._batch):
+            self._batch.commit()
+
+    def close(self):
+        self.flush()
+
+
+class FakeFirestore:
+    """Documents in memory, grouped by collection path; one behaviour for every RPC."""
+
+    def __init__(self, behavior: Behavior, calls: CallLog):
+        self.behavior = behavior
+        self.calls = calls
+        self._lock = threading.RLock()
+        self._collections = defaultdict(dict)  # collection path -> {doc id: data}
+
+    def _rpc(self, name: str, reads: int = 0, writes: int = 0):
+        self.calls.count(f"firestore.{name}")
+        if reads:
+            self.calls.count("firestore.reads", reads)
+        if writes:
+            self.calls.count("firestore.writes", writes)
+        self.behavior.call(_unavailable)
+
+    def _read(self, path: tuple) -> Optional[dict]:
+        with self._lock:
+            data = self._collections.get(path[:-1], {}).get(path[-1])
+            return copy.deepcopy(data)
+
+    def _write(self, path: tuple, data: dict, merge: bool):
+        with self._lock:
+            docs = self._collections[path[:-1]]
+            docs[path[-1]] = _apply(docs.get(path[-1]), data, merge)
+
+    def _update(self, path: tuple, data: dict):
+        with self._lock:
+            docs = self._collections.get(path[:-1], {})
+            if path[-1] not in docs:
+                raise gexc.NotFound(f"{'/'.join(path)} not found")
+            docs[path[-1]] = _apply(docs[path[-1]], data, True)
+
+    def _delete(self, path: tuple):
+        with self._lock:
+            self._collections.get(path[:-1], {}).pop(path[-1], None)
+
+    def collection(self, name: str):
+        return FakeCollection(self, (name,))
+
+    def document(self, path: str):
+        return FakeDocument(self, tuple(path.split("/")))
+
+    def collection_group(self, collection_id: str):
+        return FakeQuery(self, (collection_id,), group=True)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def bulk_writer(self, options=None):
+        return FakeBulkWriter(self)
+
+    def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        references = list(references)
+        self._rpc("get_all", reads=len(references))
+        for ref in references:
+            data = self._read(ref._path)
+            if data is not None and field_paths is not None:
+                data = {k: v for k, v in data.items() if k in field_paths}
+            yield FakeSnapshot(ref, data)
+
+    def recursive_delete(self, reference, bulk_writer=None, chunk_size: int = 5000) -> int:
+        prefix = reference._path
+        with self._lock:
+            # Collection paths have odd length and documents even, so one prefix test covers both
+            doomed = [reference] if isinstance(reference, FakeDocument) and self._read(prefix) is not None else []
+            doomed += [
+                FakeDocument(self, p + (doc_id,))
+                for p, docs in self._collections.items()
+                if p[:len(prefix)] == prefix
+                for doc_id in docs
+            ]
+        self._rpc("query", reads=max(len(doomed), 1))
+        writer = bulk_writer or self.bulk_writer()
+        for ref in doomed:
+            writer.delete(ref)
+        writer.close()
+        return len(doomed)
+
+
+# --- Gemini ---
+PATIENT_LINES = [
+    "I've had a dull ache for about three days and it gets worse when I move.",
+    "I felt feverish last night, around 101, with some chills.",
+    "I take a daily multivitamin and I'm allergic to penicillin.",
+    "The cough is mostly dry, but I get short of breath on the stairs.",
+    "Nobody in my family has had anything like this that I know of.",
+    "It started after I got back from a work trip last week.",
+]
+
+
+def _server_error():
+    response = requests.Response()
+    response.status_code = 503
+    response.reason = "Service Unavailable"
+    response._content = json.dumps({"error": {"code": 503, "message": "injected Gemini failure", "status": "UNAVAILABLE"}}).encode()
+    return genai_errors.ServerError(503, response)
+
+
+def _quota_error():
+    response = requests.Response()
+    response.status_code = 429
+    response.reason = "Too Many Requests"
+    response._content = json.dumps({"error": {"code": 429, "message": "injected quota exhaustion", "status": "RESOURCE_EXHAUSTED"}}).encode()
+    return genai_errors.ClientError(429, response)
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Cache:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class _FakeModels:
+    def __init__(self, genai):
+        self._genai = genai
+
+    def generate_content(self, model=None, contents=None, config=None):
+        self._genai.calls.count("gemini.generate_content")
+        self._genai.behavior.call(_server_error, self._genai.refuse)
+        return FakeResponse(self._genai.reply(config))
+
+    def generate_content_stream(self, model=None, contents=None, config=None):
+        self._genai.calls.count("gemini.generate_content_stream")
+        self._genai.behavior.call(_server_error, self._genai.refuse)  # time to first token
+        words = self._genai.reply(config).split(" ")
+        for i in range(0, len(words), 4):
+            yield FakeResponse(" ".join(words[i:i + 4]) + (" " if i + 4 < len(words) else ""))
+
+
+class _FakeCaches:
+    def __init__(self, genai):
+        self._genai = genai
+
+    def create(self, model=None, config=None):
+        self._genai.calls.count("gemini.caches.create")
+        self._genai.behavior.call(_server_error, self._genai.refuse)
+        return _Cache(f"cachedContents/{uuid.uuid4().hex}")
+
+    def delete(self, name=None, config=None):
+        self._genai.calls.count("gemini.caches.delete")
+        self._genai.behavior.call(_server_error, self._genai.refuse)
+
+
+class _AsyncModels:
+    def __init__(self, models):
+        self._models = models
+
+    async def generate_content(self, **kwargs):
+        return await asyncio.to_thread(self._models.generate_content, **kwargs)
+
+
+class _AsyncCaches:
+    def __init__(self, caches):
+        self._caches = caches
+
+    async def create(self, **kwargs):
+        return await asyncio.to_thread(self._caches.create, **kwargs)
+
+    async def delete(self, **kwargs):
+        return await asyncio.to_thread(self._caches.delete, **kwargs)
+
+
+class _AsyncClient:
+    def __init__(self, genai):
+        self.models = _AsyncModels(genai.models)
+        self.caches = _AsyncCaches(genai.caches)
+
+
+class FakeGenAI:
+    """
+    Answers like the model would for each request this app makes: a patient
+    line, a summary, or JSON matching the evaluation prompt or schema.
+    """
+
+    def __init__(self, behavior: Behavior, calls: CallLog):
+        self.behavior = behavior
+        self.calls = calls
+        self._random = random.Random()
+        self.models = _FakeModels(self)
+        self.caches = _FakeCaches(self)
+        self.aio = _AsyncClient(self)
+
+    def refuse(self) -> Exception:
+        """The error for a call over the quota (see Behavior.max_concurrent)."""
+        self.calls.count("gemini.refused")
+        return _quota_error()
+
+    def _section(self) -> dict:
+        return {"score": self._random.randint(1, 5), "feedback": "Asked about onset and severity but not about red flags."}
+
+    def reply(self, config) -> str:
+        schema = getattr(config, "response_schema", None)
+        if schema is not None:
+            properties = schema.get("properties") if isinstance(schema, dict) else schema.properties
+            if "score" in (properties or {}):
+                return json.dumps(self._section())
+            return json.dumps({"overall_feedback": "A structured history with a clear plan; check allergies earlier."})
+        if getattr(config, "response_mime_type", None) == "application/json":
+            from feedback import SECTION_HINTS
+            result = {k: self._section() for k in SECTION_HINTS}
+            result["overall_score"] = self._random.randint(40, 95)
+            result["overall_feedback"] = "A structured history with a clear plan; check allergies earlier."
+            return json.dumps(result)
+        return self._random.choice(PATIENT_LINES)
+
+
+# --- ElevenLabs ---
+def _tts_error():
+    from elevenlabs.core.api_error import ApiError
+    return ApiError(status_code=503, body="injected ElevenLabs failure")
+
+
+class FakeElevenLabs:
+    """Returns a few KB of placeholder MP3 bytes per request, scaled with the text length."""
+
+    def __init__(self, behavior: Behavior, calls: CallLog):
+        self.behavior = behavior
+        self.calls = calls
+
+    def generate(self, text: str = "", voice=None, model=None, voice_settings=None, **kwargs):
+        self.calls.count("elevenlabs.generate")
+        self.behavior.call(_tts_error)
+        size = 1024 + 160 * len(text)
+        return iter([b"ID3" + b"\0" * (size // 2), b"\0" * (size - size // 2)])
+
+
+# --- Google sign-in ---
+class _CertsResponse:
+    """The google.auth transport Response interface."""
+
+    def __init__(self, status: int, headers: dict, data: bytes):
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+
+class FakeGoogleCerts:
+    """
+    Google's signing-cert endpoint, called as a google.auth transport Request,
+    plus an issuer of ID tokens signed with its key. Certs are served with
+    the same Cache-Control max-age Google uses.
+    """
+
+    def __init__(self, behavior: Behavior, calls: CallLog, max_age: int = 21600):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from google.auth import crypt
+
+        self.behavior = behavior
+        self.calls = calls
+        self.max_age = max_age
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        private_pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+        )
+        self._public_pem = key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo,
+        ).decode()
+        self._key_id = uuid.uuid4().hex
+        self._signer = crypt.RSASigner.from_string(private_pem, key_id=self._key_id)
+
+    def issue(self, email: str, audience: str) -> str:
+        from google.auth import jwt
+
+        now = int(time.time())
+        claims = {
+            "iss": "https://accounts.google.com", "aud": audience, "sub": uuid.uuid5(uuid.NAMESPACE_DNS, email).hex,
+            "email": email, "email_verified": True, "name": email.split("@")[0], "iat": now, "exp": now + 3600,
+        }
+        return jwt.encode(self._signer, claims).decode()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        self.calls.count("google.certs")
+        self.behavior.call(lambda: requests.ConnectionError("injected certs fetch failure"))
+        return _CertsResponse(
+            200,
+            {"Cache-Control": f"public, max-age={self.max_age}, must-revalidate, no-transform"},
+            json.dumps({self._key_id: self._public_pem}).encode(),
+        )
+
+
+def install(firestore_fake: Optional[FakeFirestore], genai_fake: FakeGenAI, tts_fake: FakeElevenLabs,
+            certs_fake: Optional[FakeGoogleCerts] = None):
+    """
+    Make the client constructors return the fakes. Must run before any
+    client is built (they are built on first use, see clients.py).
+    """
+    import elevenlabs.client
+    import id_tokens
+    from google import genai as google_genai
+    from google.cloud import firestore
+
+    google_genai.Client = lambda *args, **kwargs: genai_fake
+    elevenlabs.client.ElevenLabs = lambda *args, **kwargs: tts_fake
+    if certs_fake is not None:
+        id_tokens.certs_request = id_tokens.CachingRequest(transport=certs_fake)
+    if firestore_fake is not None:
+        firestore.Client = lambda *args, **kwargs: firestore_fake
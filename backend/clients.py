@@ -0,0 +1,207 @@
+"""
+Process-wide SDK clients, built on first use.
+
+Importing the app imports no cloud SDK and builds no client, so it needs no
+credentials and a cold container is ready sooner. Each registered client is
+constructed the first time something asks for it, exactly once per process
+even when several requests ask at the same time. "genai" is one client shared
+by the patient simulation, context summaries and feedback, with its Vertex
+requests going through a single pooled HTTP session.
+
+    clients.get("genai")      # the client itself
+    clients.lazy("genai")     # a stand-in that builds it on first attribute access
+    clients.warmup()          # build everything and open connections ahead of traffic
+"""
+import os
+import time
+import threading
+import contextvars
+from typing import Any, Callable, Dict, Iterable, Optional
+
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "")
+GCP_LOCATION = os.environ.get("GCP_LOCATION", "us-central1")
+ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY")
+# Connections to Vertex AI kept open per process; size it to the worker's request concurrency
+GENAI_POOL_SIZE = int(os.environ.get("GENAI_POOL_SIZE", "32"))
+
+_lock = threading.Lock()
+_factories: Dict[str, Callable[[], Any]] = {}
+_warmers: Dict[str, Callable[[Any], None]] = {}
+_build_locks: Dict[str, threading.Lock] = {}
+_instances: Dict[str, Any] = {}
+
+# Seconds a Vertex HTTP request may take, set per call by llm_calls so a call
+# given up on stops holding a connection soon after; None = no limit
+genai_timeout = contextvars.ContextVar("genai_timeout", default=None)
+
+
+def register(name: str, factory: Callable[[], Any], warm: Optional[Callable[[Any], None]] = None):
+    """Register how to build a client, and optionally how to open its connections early."""
+    with _lock:
+        _factories[name] = factory
+        _build_locks.setdefault(name, threading.Lock())
+        if warm is not None:
+            _warmers[name] = warm
+
+
+def get(name: str) -> Any:
+    try:
+        return _instances[name]
+    except KeyError:
+        pass
+    with _lock:
+        build_lock = _build_locks[name]
+    # One lock per client, so a slow Firestore start doesn't hold up Gemini
+    with build_lock:
+        if name not in _instances:
+            started = time.perf_counter()
+            _instances[name] = _factories[name]()
+            print(f"🔌 {name} client ready in {(time.perf_counter() - started) * 1000:.0f}ms")
+    return _instances[name]
+
+
+def built() -> list:
+    return sorted(_instances)
+
+
+class Lazy:
+    """Stands in for a registered client; the first attribute access builds it."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        return getattr(get(self._name), attr)
+
+
+def lazy(name: str) -> Lazy:
+    return Lazy(name)
+
+
+def warmup(names: Optional[Iterable[str]] = None):
+    """
+    Build the named clients (default: all registered) and open their
+    connections, so the first real request doesn't pay for it. Failures are
+    logged, not raised: the client is simply built again on first use.
+    """
+    for name in list(names if names is not None else _factories):
+        started = time.perf_counter()
+        try:
+            client = get(name)
+            if client is not None and name in _warmers:
+                _warmers[name](client)
+            print(f"🔥 {name} warmed up in {(time.perf_counter() - started) * 1000:.0f}ms")
+        except Exception as e:
+            print(f"⚠️ Warmup of {name} failed: {e}")
+
+
+# --- Gemini ---
+class PooledVertexTransport:
+    """
+    google-genai 0.3 opens a new AuthorizedSession, and so a new TLS
+    connection, for every Vertex call. This replaces the client's request
+    method with one that shares a single session holding up to pool_size
+    connections. It relies on ApiClient internals of the pinned SDK version
+    and leaves other clients (API key mode) untouched.
+    """
+
+    def __init__(self, api_client, pool_size: int):
+        self._api = api_client
+        self._pool_size = pool_size
+        self._lock = threading.Lock()
+        self._session = None
+
+    def session(self):
+        if self._session is not None:
+            return self._session
+        with self._lock:
+            if self._session is None:
+                import google.auth
+                import requests
+                from google.auth.transport.requests import AuthorizedSession
+
+                if not self._api._credentials:
+                    self._api._credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+                session = AuthorizedSession(self._api._credentials)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount("https://", adapter)
+                self._session = session
+        return self._session
+
+    def request(self, http_request, stream: bool = False):
+        import json
+        from google.genai import _api_client, errors
+
+        response = self.session().request(
+            http_request.method.upper(),
+            http_request.url,
+            headers=http_request.headers,
+            data=json.dumps(http_request.data, cls=_api_client.RequestJsonEncoder) if http_request.data else None,
+            stream=stream,
+            timeout=genai_timeout.get(),
+        )
+        errors.APIError.raise_for_response(response)
+        return _api_client.HttpResponse(response.headers, response if stream else [response.text])
+
+    def warm(self):
+        """Fetch an access token and open one connection."""
+        self.session().head(self._api._http_options["base_url"], timeout=10)
+
+    @classmethod
+    def install(cls, client, pool_size: int) -> Optional["PooledVertexTransport"]:
+        api = getattr(client, "_api_client", None)
+        if api is None or not getattr(api, "vertexai", False) or not hasattr(api, "_request"):
+            return None
+        transport = cls(api, pool_size)
+        api._request = transport.request
+        return transport
+
+
+def _build_genai():
+    from google import genai
+    from metrics import InstrumentedGenAI
+
+    client = genai.Client(vertexai=True, project=GCP_PROJECT_ID, location=GCP_LOCATION)
+    PooledVertexTransport.install(client, GENAI_POOL_SIZE)
+    return InstrumentedGenAI(client)
+
+
+def _warm_genai(client):
+    api = getattr(client, "_api_client", None)
+    transport = getattr(getattr(api, "_request", None), "__self__", None)
+    if isinstance(transport, PooledVertexTransport):
+        transport.warm()
+
+
+# --- Firestore ---
+def _build_firestore():
+    from google.cloud import firestore
+    return firestore.Client(project=GCP_PROJECT_ID)
+
+
+def _warm_firestore(db):
+    # One document read opens the gRPC channel and fetches an access token
+    db.collection("_warmup").document("ping").get()
+
+
+# --- ElevenLabs ---
+def _build_elevenlabs():
+    """The ElevenLabs client, or None when the SDK or API key is missing."""
+    try:
+        from elevenlabs.client import ElevenLabs
+    except ImportError:
+        print("⚠️ elevenlabs not installed. Run: pip install elevenlabs==1.7.0")
+        return None
+    if not ELEVENLABS_API_KEY:
+        print("⚠️ ElevenLabs unavailable or missing API key")
+        return None
+    try:
+        return ElevenLabs(api_key=ELEVENLABS_API_KEY)
+    except Exception as e:
+        print(f"❌ ElevenLabs initialization failed: {e}")
+        return None
+
+
+register("genai", _build_genai, _warm_genai)
+register("firestore", _build_firestore, _warm_firestore)
+register("elevenlabs", _build_elevenlabs)
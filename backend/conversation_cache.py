@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class ConversationCache:
+    """
+    Write-through, in-process LRU of thread transcripts.
+
+    Each entry is tagged with the thread's message_count at the time it was
+    filled. Callers pass the count they just read from the thread document;
+    a mismatch means another worker wrote to the thread, so the entry is
+    discarded and the transcript reloaded.
+    """
+
+    def __init__(self, max_threads: int = 1024):
+        self.max_threads = max_threads
+        self._lock = threading.Lock()
+        self._threads = OrderedDict()  # key -> (message_count, [message dicts])
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, message_count: Optional[int]) -> Optional[List[dict]]:
+        with self._lock:
+            entry = self._threads.get(key)
+            if entry is None or message_count is None or entry[0] != message_count:
+                self._threads.pop(key, None)
+                self.misses += 1
+                return None
+            self._threads.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def __contains__(self, key: str) -> bool:
+        """Whether any transcript is cached for key, current or not; doesn't count as a hit or miss."""
+        with self._lock:
+            return key in self._threads
+
+    def put(self, key: str, message_count: int, messages: List[dict]):
+        with self._lock:
+            self._threads[key] = (message_count, list(messages))
+            self._threads.move_to_end(key)
+            while len(self._threads) > self.max_threads:
+                self._threads.popitem(last=False)
+
+    def append(self, key: str, expected_count: int, messages: List[dict]):
+        """Record messages just written, if the entry is still the one they extend."""
+        with self._lock:
+            entry = self._threads.get(key)
+            if entry is None or entry[0] != expected_count:
+                self._threads.pop(key, None)
+                return
+            self._threads[key] = (expected_count + len(messages), entry[1] + list(messages))
+            self._threads.move_to_end(key)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._threads.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"threads": len(self._threads), "hits": self.hits, "misses": self.misses}
@@ -1,50 +1,69 @@
 import json
-from google.genai.types import Content, Part, GenerateContentConfig
+import hashlib
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import os
-from google import genai
+
+import clients
+import llm_calls
+from metrics import debug_sample, log
 
 # Vertex AI Configuration
-GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "")
-GCP_LOCATION = os.environ.get("GCP_LOCATION", "us-central1")
 MODEL_NAME = os.environ.get("TUNED_MODEL", "")
 
-# Initialize Gemini client
-client = genai.Client(
-    vertexai=True,
-    project=GCP_PROJECT_ID,
-    location=GCP_LOCATION,
-)
+# "single": one JSON generation for the whole rubric; "sections": one small call per section, in parallel
+FEEDBACK_MODE = os.environ.get("FEEDBACK_MODE", "single")
+FEEDBACK_SECTION_RETRIES = int(os.environ.get("FEEDBACK_SECTION_RETRIES", "2"))
+# Vertex only caches prompts above a minimum size; shorter transcripts are sent inline with each call
+FEEDBACK_CACHE_MIN_TOKENS = int(os.environ.get("FEEDBACK_CACHE_MIN_TOKENS", "4096"))
+# Per evaluation call, across its retries; a whole-rubric evaluation can take a while
+FEEDBACK_DEADLINE_SECONDS = float(os.environ.get("FEEDBACK_DEADLINE_SECONDS", "120"))
+FEEDBACK_RETRIES = int(os.environ.get("FEEDBACK_RETRIES", "2"))
+# Evaluations running at once per process (app.py admits this many); section calls get a thread each
+FEEDBACK_CONCURRENCY = int(os.environ.get("FEEDBACK_CONCURRENCY", "4"))
+
+# The process-wide Gemini client, built on first use (see clients.py), under
+# the feedback call policy (see llm_calls.py). Not hedged: evaluations are the
+# most expensive calls. Transcript caches (client.caches) go straight through.
+client = llm_calls.ResilientGenAI(clients.lazy("genai"), "feedback", FEEDBACK_DEADLINE_SECONDS, FEEDBACK_RETRIES)
 
 SECTION_HINTS = {
     "history": {
         "title": "History Taking",
-        "hint": "Consider OPQRST (onset, provocation/palliation, quality, radiation, severity, time) to structure history."
+        "hint": "Consider OPQRST (onset, provocation/palliation, quality, radiation, severity, time) to structure history.",
+        "criteria": "completeness and structure of history taking (OPQRST, pertinent positives/negatives, logical flow)"
     },
     "red_flags": {
         "title": "Red Flags",
-        "hint": "Good practice to screen for red flags early (e.g., fever, chest pain, syncope)."
+        "hint": "Good practice to screen for red flags early (e.g., fever, chest pain, syncope).",
+        "criteria": "timely screening for red flags relevant to the case"
     },
     "meds_allergies": {
         "title": "Meds & Allergies",
-        "hint": "Always clarify current meds and allergies with examples."
+        "hint": "Always clarify current meds and allergies with examples.",
+        "criteria": "medication history and allergies elicited with clarification"
     },
     "differential": {
         "title": "Differential Diagnosis",
-        "hint": "State a brief differential and how you will rule in/out possibilities."
+        "hint": "State a brief differential and how you will rule in/out possibilities.",
+        "criteria": "quality of differential diagnosis and brief rationale to rule-in/out"
     },
     "plan": {
         "title": "Plan & Counseling",
-        "hint": "Outline next steps and safety-netting (when to return, expected course)."
+        "hint": "Outline next steps and safety-netting (when to return, expected course).",
+        "criteria": "investigations and counseling/safety-netting explained appropriately"
     },
     "communication": {
         "title": "Communication",
-        "hint": "Use plain language and teach-back to confirm understanding."
+        "hint": "Use plain language and teach-back to confirm understanding.",
+        "criteria": "empathy, clarity, summaries, teach-back, patient-centered language"
     },
 }
 
 def _messages_to_contents(messages):
+    from google.genai.types import Content, Part
     out = []
-    print("Messages to contents:", messages)
     for m in messages:
         if m["role"] == "doctor":
             out.append(Content(role="user", parts=[Part.from_text(text=m["content"])]))
@@ -110,6 +129,43 @@ Return ONLY valid JSON with exactly these keys:
 """
 
 
+SECTION_TASK = """\
+You will receive the full transcript in prior turns (doctor=role:user, patient=role:model).
+
+Rate the DOCTOR on ONE metric only, {title}: {criteria}.
+
+Use an integer 0..5 (0=not attempted/very poor, 1=poor, 2=limited, 3=adequate, 4=good, 5=excellent)
+and give specific feedback (1-2 sentences) referencing what the doctor did or missed in THIS conversation.
+"""
+
+OVERALL_TASK = """\
+You will receive the full transcript in prior turns (doctor=role:user, patient=role:model).
+
+Write 3-6 sentences of overall feedback on the DOCTOR's performance, mixing strengths and improvements.
+Do not give scores.
+"""
+
+# Plain dicts so the genai types aren't imported at startup; the SDK accepts either form
+SECTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"score": {"type": "INTEGER"}, "feedback": {"type": "STRING"}},
+    "required": ["score", "feedback"],
+}
+
+OVERALL_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"overall_feedback": {"type": "STRING"}},
+    "required": ["overall_feedback"],
+}
+
+# The six sections plus the overall comment
+EVAL_PARTS = list(SECTION_HINTS) + ["overall"]
+
+# Every part of every admitted evaluation at once, so one user's sections don't queue behind another's
+section_executor = ThreadPoolExecutor(max_workers=len(EVAL_PARTS) * max(1, FEEDBACK_CONCURRENCY),
+                                      thread_name_prefix="feedback-section")
+
+
 def _fallback_sections():
     return {
         "history":       {"title": SECTION_HINTS["history"]["title"],       "score": 0, "feedback": SECTION_HINTS["history"]["hint"]},
@@ -120,21 +176,248 @@ def _fallback_sections():
         "communication": {"title": SECTION_HINTS["communication"]["title"], "score": 0, "feedback": SECTION_HINTS["communication"]["hint"]},
     }
 
-def generate_feedback_json_with_model_v2(messages) -> dict:
-    print("Generating feedback from generate_feedback_json_with_model_v2 method:", messages)
+def evaluation_key(messages) -> str:
+    """
+    Stable hash of everything that determines an evaluation: the ordered
+    transcript, the model, the evaluator mode and the prompts. Editing any
+    prompt changes every key, so stale results are never served.
+    """
+    payload = json.dumps(
+        {
+            "transcript": [[m.get("role"), m.get("content")] for m in messages],
+            "model": MODEL_NAME,
+            "mode": FEEDBACK_MODE,
+            "prompts": [EVAL_SYSTEM, EVAL_TASK, SECTION_TASK, OVERALL_TASK, SECTION_HINTS],
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_fallback(result: dict) -> bool:
+    """True if any part of result is the automatic fallback rather than a model evaluation."""
+    fallback = _fallback_sections()
+    return any(
+        section.get("score") == 0 and section.get("feedback") == fallback[k]["feedback"]
+        for k, section in result.get("sections", {}).items() if k in fallback
+    )
+
+
+def _feedback_request(messages) -> dict:
+    from google.genai.types import Content, Part, GenerateContentConfig
     contents = _messages_to_contents(messages)
     contents.append(Content(role="user", parts=[Part.from_text(text=EVAL_TASK)]))
-
-    resp = client.models.generate_content(
-        model=MODEL_NAME,
-        contents=contents,
-        config=GenerateContentConfig(
+    return {
+        "model": MODEL_NAME,
+        "contents": contents,
+        "config": GenerateContentConfig(
             system_instruction=EVAL_SYSTEM,
             temperature=0.3,  # Slightly higher for more varied feedback
             response_mime_type="application/json",
         ),
+    }
+
+
+def generate_feedback_json_with_model_v2(messages) -> dict:
+    """
+    Evaluate a transcript. A malformed answer gives the fallback evaluation
+    (see is_fallback); a model that can't be reached raises llm_calls.Unavailable.
+    """
+    debug_sample("Evaluating transcript", messages)
+    if FEEDBACK_MODE == "sections":
+        return generate_feedback_by_section(messages)
+    resp = client.models.generate_content(**_feedback_request(messages))
+    return _parse_feedback(resp)
+
+
+async def generate_feedback_json_with_model_v2_async(messages) -> dict:
+    """Same evaluation as generate_feedback_json_with_model_v2, awaited on the async client."""
+    debug_sample("Evaluating transcript", messages)
+    if FEEDBACK_MODE == "sections":
+        return await generate_feedback_by_section_async(messages)
+    resp = await client.aio.models.generate_content(**_feedback_request(messages))
+    return _parse_feedback(resp)
+
+
+# --- PER-SECTION EVALUATION ---
+def _cache_config(messages, contents):
+    """CreateCachedContentConfig for the transcript, or None if it is too short to cache."""
+    tokens = sum(len(m.get("content") or "") for m in messages) // 4
+    if tokens < FEEDBACK_CACHE_MIN_TOKENS:
+        return None
+    from google.genai.types import CreateCachedContentConfig
+    return CreateCachedContentConfig(
+        contents=contents,
+        system_instruction=EVAL_SYSTEM,
+        ttl="300s",
     )
 
+
+def _part_request(part: str, transcript, cache_name) -> dict:
+    from google.genai.types import Content, Part, GenerateContentConfig
+    if part == "overall":
+        task, schema = OVERALL_TASK, OVERALL_SCHEMA
+    else:
+        task, schema = SECTION_TASK.format(**SECTION_HINTS[part]), SECTION_SCHEMA
+    config = {
+        "temperature": 0.3,
+        "response_mime_type": "application/json",
+        "response_schema": schema,
+    }
+    if cache_name:
+        # Transcript and system instruction come from the cache
+        contents = []
+        config["cached_content"] = cache_name
+    else:
+        contents = list(transcript)
+        config["system_instruction"] = EVAL_SYSTEM
+    contents.append(Content(role="user", parts=[Part.from_text(text=task)]))
+    return {"model": MODEL_NAME, "contents": contents, "config": GenerateContentConfig(**config)}
+
+
+def _parse_part(part: str, resp) -> dict:
+    data = json.loads((resp.text or "").strip())
+    if part == "overall":
+        text = (data.get("overall_feedback") or "").strip()
+        if not text:
+            raise ValueError("empty overall_feedback")
+        return {"feedback": text}
+    if not str(data.get("feedback") or "").strip():
+        raise ValueError(f"empty feedback for {part}")
+    return {
+        "title": SECTION_HINTS[part]["title"],
+        "score": int(max(0, min(5, int(data["score"])))),
+        "feedback": data["feedback"],
+    }
+
+
+def _assemble_sections(results: dict) -> dict:
+    """Build the feedback dict from the parts that succeeded; the rest fall back individually."""
+    sections = _fallback_sections()
+    missing = [part for part in EVAL_PARTS if part not in results]
+    if missing:
+        log(f"⚠️ Feedback sections unavailable, using fallback: {missing}")
+    scored = [results[k] for k in SECTION_HINTS if k in results]
+    for k in SECTION_HINTS:
+        if k in results:
+            sections[k] = results[k]
+
+    # Equal weighting of all six sections on 0..100, as the prompt asks; a failed one counts as its fallback 0.
+    # Such a result is_fallback(), so it is neither cached nor kept by a background job that can still retry.
+    overall_score = round(sum(s["score"] for s in sections.values()) / (5 * len(SECTION_HINTS)) * 100)
+    if "overall" in results:
+        feedback_text = results["overall"]["feedback"]
+    else:
+        feedback_text = " ".join(s["feedback"] for s in scored) or "Automatic fallback feedback. (LLM JSON unavailable.)"
+
+    result = {
+        "feedback_text": feedback_text,
+        "overall_score": overall_score,
+        "sections": sections,
+    }
+    debug_sample("Generated feedback", result)
+    return result
+
+
+def _evaluate_part(part: str, transcript, cache_name) -> dict:
+    resp = client.models.generate_content(**_part_request(part, transcript, cache_name))
+    return _parse_part(part, resp)
+
+
+def generate_feedback_by_section(messages) -> dict:
+    """
+    Score each rubric section (and the overall comment) as its own small
+    structured-output call, all in parallel over one cached transcript.
+    Failed parts are retried on their own; overall_score is computed here.
+    """
+    transcript = _messages_to_contents(messages)
+    cache_name = None
+    cache_config = _cache_config(messages, transcript)
+    if cache_config:
+        try:
+            cache_name = client.caches.create(model=MODEL_NAME, config=cache_config).name
+        except Exception as e:
+            log(f"⚠️ Transcript cache unavailable, sending it inline: {e}")
+
+    results = {}
+    unavailable = None
+    try:
+        pending = list(EVAL_PARTS)
+        for attempt in range(1 + FEEDBACK_SECTION_RETRIES):
+            futures = {part: section_executor.submit(
+                # Each section call is recorded against the request it runs for
+                contextvars.copy_context().run, _evaluate_part, part, transcript, cache_name,
+            ) for part in pending}
+            for part, fut in futures.items():
+                try:
+                    results[part] = fut.result()
+                except llm_calls.Unavailable as e:
+                    unavailable = e
+                    log(f"⚠️ Feedback section {part} attempt {attempt + 1} failed: {e}")
+                except Exception as e:
+                    log(f"⚠️ Feedback section {part} attempt {attempt + 1} failed: {e}")
+            pending = [part for part in pending if part not in results]
+            if not pending:
+                break
+    finally:
+        if cache_name:
+            try:
+                client.caches.delete(name=cache_name)
+            except Exception as e:
+                log(f"⚠️ Could not delete transcript cache {cache_name}: {e}")
+    if not results and unavailable is not None:
+        raise unavailable  # the model is down, not just badly formatted: no all-fallback evaluation
+    return _assemble_sections(results)
+
+
+async def _evaluate_part_async(part: str, transcript, cache_name) -> dict:
+    resp = await client.aio.models.generate_content(**_part_request(part, transcript, cache_name))
+    return _parse_part(part, resp)
+
+
+async def generate_feedback_by_section_async(messages) -> dict:
+    """generate_feedback_by_section on the async client."""
+    transcript = _messages_to_contents(messages)
+    cache_name = None
+    cache_config = _cache_config(messages, transcript)
+    if cache_config:
+        try:
+            cache_name = (await client.aio.caches.create(model=MODEL_NAME, config=cache_config)).name
+        except Exception as e:
+            log(f"⚠️ Transcript cache unavailable, sending it inline: {e}")
+
+    results = {}
+    unavailable = None
+    try:
+        pending = list(EVAL_PARTS)
+        for attempt in range(1 + FEEDBACK_SECTION_RETRIES):
+            outcomes = await asyncio.gather(
+                *(_evaluate_part_async(part, transcript, cache_name) for part in pending),
+                return_exceptions=True,
+            )
+            for part, outcome in zip(pending, outcomes):
+                if isinstance(outcome, llm_calls.Unavailable):
+                    unavailable = outcome
+                if isinstance(outcome, Exception):
+                    log(f"⚠️ Feedback section {part} attempt {attempt + 1} failed: {outcome}")
+                else:
+                    results[part] = outcome
+            pending = [part for part in pending if part not in results]
+            if not pending:
+                break
+    finally:
+        if cache_name:
+            try:
+                await client.aio.caches.delete(name=cache_name)
+            except Exception as e:
+                log(f"⚠️ Could not delete transcript cache {cache_name}: {e}")
+    if not results and unavailable is not None:
+        raise unavailable
+    return _assemble_sections(results)
+
+
+def _parse_feedback(resp) -> dict:
     raw = (resp.text or "").strip()
     data = None
     try:
@@ -157,8 +440,8 @@ def generate_feedback_json_with_model_v2(messages) -> dict:
             data[k]["score"] = int(max(0, min(5, int(data[k]["score"]))))
             
     except Exception as e:
-        print(f"Error in generating feedback: {e}")
-        print(f"Raw response: {raw}")
+        log(f"Error in generating feedback: {e}")
+        log(f"Raw response: {raw}")
         return {
             "feedback_text": "Automatic fallback feedback. (LLM JSON unavailable.)",
             "overall_score": 0,
@@ -204,5 +487,5 @@ def generate_feedback_json_with_model_v2(messages) -> dict:
         "overall_score": data["overall_score"],
         "sections": sections,
     }
-    print("Generated feedback from generate_feedback_json_with_model_v2 method:", result)
+    debug_sample("Generated feedback", result)
     return result
\ No newline at end of file
@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+
+
+class FeedbackCache:
+    """
+    Evaluation results by transcript hash (see feedback.evaluation_key).
+
+    Results are persisted through load(key) and save(key, result), i.e. the
+    storage backend, behind a small in-process LRU. Identical evaluations
+    running at the same time in this process share one model call: the first
+    caller computes, the rest wait on its future.
+    """
+
+    def __init__(self, load: Callable[[str], Optional[dict]], save: Callable[[str, dict], None], max_entries: int = 256):
+        self._load = load
+        self._save = save
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> result
+        self._inflight = {}  # key -> Future
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    def _remember(self, key: str, result: dict):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+        result = self._load(key)
+        if result is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._remember(key, result)
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, result: dict):
+        self._save(key, result)
+        self._remember(key, result)
+
+    def claim(self, key: str) -> Tuple[Future, bool]:
+        """
+        Return (future, owner) for key. The owner must resolve the future and
+        release() it; everyone else waits on it.
+        """
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.joined += 1
+                return fut, False
+            fut = Future()
+            fut.set_running_or_notify_cancel()
+            self._inflight[key] = fut
+            return fut, True
+
+    def release(self, key: str, fut: Future):
+        with self._lock:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+    def get_or_compute(self, key: str, compute: Callable[[], dict], cacheable: Callable[[dict], bool]) -> dict:
+        """Cached result for key, else compute() once; stored only if cacheable(result)."""
+        result = self.get(key)
+        if result is not None:
+            return result
+        fut, owner = self.claim(key)
+        if not owner:
+            return fut.result()
+        try:
+            result = compute()
+            if cacheable(result):
+                self.put(key, result)
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            self.release(key, fut)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "joined": self.joined,
+            }
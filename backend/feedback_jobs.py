@@ -0,0 +1,92 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from metrics import log
+
+
+class FeedbackJobs:
+    """
+    Bounded pool that runs session evaluations off the request path.
+
+    evaluate(user_id, thread_id, job_id, attempt) does the work and raises on
+    failure; it is retried with exponential backoff up to `retries` attempts,
+    after which fail(user_id, thread_id, job_id, error) records the outcome.
+    A job id that is already queued or running in this process is not queued
+    again, and new jobs are refused once max_pending are outstanding.
+    """
+
+    def __init__(
+        self,
+        evaluate: Callable[[str, str, str, int], None],
+        fail: Callable[[str, str, str, Exception], None],
+        max_workers: int = 2,
+        max_pending: int = 32,
+        retries: int = 3,
+        backoff: float = 2.0,
+    ):
+        self._evaluate = evaluate
+        self._fail = fail
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="feedback-job")
+        self._max_pending = max_pending
+        self._retries = max(1, retries)
+        self._backoff = backoff
+        self._lock = threading.Lock()
+        self._pending = set()  # job ids queued or running here
+        self.submitted = 0
+        self.rejected = 0
+        self.retried = 0
+        self.completed = 0
+        self.failed = 0
+
+    def has_capacity(self) -> bool:
+        with self._lock:
+            return len(self._pending) < self._max_pending
+
+    def submit(self, user_id: str, thread_id: str, job_id: str) -> bool:
+        """Queue a job. Returns False if the pool is full."""
+        with self._lock:
+            if job_id in self._pending:
+                return True
+            if len(self._pending) >= self._max_pending:
+                self.rejected += 1
+                return False
+            self._pending.add(job_id)
+            self.submitted += 1
+        self._executor.submit(self._run, user_id, thread_id, job_id)
+        return True
+
+    def _run(self, user_id: str, thread_id: str, job_id: str):
+        try:
+            for attempt in range(1, self._retries + 1):
+                try:
+                    self._evaluate(user_id, thread_id, job_id, attempt)
+                    with self._lock:
+                        self.completed += 1
+                    return
+                except Exception as e:
+                    log(f"⚠️ Feedback job {job_id} attempt {attempt}/{self._retries} failed: {e}")
+                    if attempt == self._retries:
+                        with self._lock:
+                            self.failed += 1
+                        self._fail(user_id, thread_id, job_id, e)
+                        return
+                    with self._lock:
+                        self.retried += 1
+                    time.sleep(self._backoff * 2 ** (attempt - 1))
+        finally:
+            with self._lock:
+                self._pending.discard(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "max_pending": self._max_pending,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "retried": self.retried,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
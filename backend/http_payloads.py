@@ -0,0 +1,127 @@
+"""
+How API responses are encoded on the wire.
+
+JSONProvider replaces Flask's JSON provider. It serializes with orjson when
+that is installed and falls back to the stdlib json otherwise. Either way,
+datetimes come out in ISO 8601, with naive ones (all written with utcnow())
+marked as UTC, so routes can return storage rows as they are instead of
+formatting each timestamp.
+
+compress() gzip- or brotli-encodes JSON and text responses of at least
+COMPRESS_MIN_BYTES for clients whose Accept-Encoding allows it. Brotli is
+preferred when the optional brotli package is installed. Streamed
+responses (SSE, audio) are left alone.
+"""
+import os
+import gzip
+import datetime as dt
+from typing import Optional, Tuple
+
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies fit in a packet or two either way; not worth the CPU
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html", "text/csv")
+
+
+def iso(value) -> Optional[str]:
+    """ISO 8601 for a date or datetime, naive datetimes taken as UTC; other values as they are, or None."""
+    if isinstance(value, dt.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=dt.timezone.utc)
+        return value.isoformat()
+    if isinstance(value, dt.date):
+        return value.isoformat()
+    return value or None
+
+
+def _default(o):
+    if isinstance(o, dt.date):
+        # Reached for datetime subclasses such as Firestore's DatetimeWithNanoseconds
+        return iso(o)
+    return DefaultJSONProvider.default(o)
+
+
+class JSONProvider(DefaultJSONProvider):
+    default = staticmethod(_default)
+
+    def _options(self, indent: bool = False) -> int:
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=_default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=_default, option=self._options(indent))
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+
+def encode_body(body: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """body compressed for a client that sent accept_encoding, and the encoding used (None if left as is)."""
+    if len(body) < COMPRESS_MIN_BYTES or not accept_encoding:
+        return body, None
+    encoding = parse_accept_header(accept_encoding, Accept).best_match(ENCODINGS)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), "gzip"
+    return body, None
+
+
+def compress(response):
+    """after_request hook: compress the body if the response and the client allow it."""
+    from flask import request
+
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    body, encoding = encode_body(response.get_data(), request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    # The compressed bytes differ from the identity ones, so the tag is only
+    # weakly valid; If-None-Match compares weakly and still matches it
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,128 @@
+"""
+Google ID-token verification with cached signing certs.
+
+google.oauth2.id_token fetches Google's signing certs on every call, and
+grequests.Request() opens a new HTTP session each time. verify() instead
+goes through one pooled session and keeps the certs for as long as Google's
+Cache-Control header allows (several hours), so a burst of logins costs one
+fetch. Concurrent logins that find the certs expired wait for a single
+refresh.
+
+GOOGLE_CERTS_URL points verification at another cert endpoint, e.g. a local
+stand-in serving test keys.
+"""
+import os
+import re
+import time
+import threading
+import email.utils
+from typing import Dict, Optional, Tuple
+
+GOOGLE_CERTS_URL = os.environ.get("GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs")
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+_MAX_AGE = re.compile(r"max-age\s*=\s*(\d+)", re.IGNORECASE)
+
+
+def cache_lifetime(headers) -> float:
+    """Seconds a response may be reused, from Cache-Control (or Expires), less its Age."""
+    cache_control = headers.get("cache-control") or ""
+    if re.search(r"no-store|no-cache", cache_control, re.IGNORECASE):
+        return 0
+    match = _MAX_AGE.search(cache_control)
+    if match:
+        lifetime = float(match.group(1))
+    elif headers.get("expires"):
+        try:
+            expires = email.utils.parsedate_to_datetime(headers["expires"]).timestamp()
+        except (TypeError, ValueError):
+            return 0
+        lifetime = expires - time.time()
+    else:
+        return 0
+    try:
+        lifetime -= float(headers.get("age") or 0)
+    except ValueError:
+        pass
+    return max(lifetime, 0)
+
+
+class CachingRequest:
+    """
+    A google.auth transport Request over one pooled requests.Session. GET
+    responses with status 200 are reused until their cache lifetime runs out.
+    """
+
+    def __init__(self, transport=None):
+        self._transport = transport
+        self._lock = threading.Lock()
+        self._url_locks: Dict[str, threading.Lock] = {}
+        self._cache: Dict[str, Tuple[float, object]] = {}  # url -> (expires at, response)
+        self._uncacheable = set()  # urls whose last response couldn't be cached; fetched without queueing
+        self.fetches = 0
+
+    def _request(self):
+        if self._transport is None:
+            import requests
+            from google.auth.transport import requests as grequests
+            self._transport = grequests.Request(session=requests.Session())
+        return self._transport
+
+    def _cached(self, url: str):
+        entry = self._cache.get(url)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if method.upper() != "GET" or body is not None:
+            return self._request()(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+        response = self._cached(url)
+        if response is not None:
+            return response
+        if url in self._uncacheable:
+            return self._fetch(url, headers, timeout, **kwargs)
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            # Whoever held the lock may have just refreshed it
+            response = self._cached(url)
+            if response is not None:
+                return response
+            return self._fetch(url, headers, timeout, **kwargs)
+
+    def _fetch(self, url, headers, timeout, **kwargs):
+        response = self._request()(url, method="GET", headers=headers, timeout=timeout, **kwargs)
+        self.fetches += 1
+        lifetime = cache_lifetime({k.lower(): v for k, v in response.headers.items()})
+        if response.status == 200 and lifetime > 0:
+            self._cache[url] = (time.monotonic() + lifetime, response)
+            self._uncacheable.discard(url)
+        elif response.status == 200:
+            self._uncacheable.add(url)
+        return response
+
+    def clear(self):
+        self._cache.clear()
+
+
+certs_request = CachingRequest()
+
+
+def verify(token: str, audience: Optional[str], request: Optional[CachingRequest] = None) -> dict:
+    """
+    The claims of a Google-issued ID token for audience. Raises ValueError
+    or GoogleAuthError like id_token.verify_oauth2_token.
+    """
+    from google.auth import exceptions
+    from google.oauth2 import id_token
+
+    claims = id_token.verify_token(
+        token,
+        request or certs_request,
+        audience=audience,
+        certs_url=GOOGLE_CERTS_URL,
+    )
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        raise exceptions.GoogleAuthError(f"Wrong issuer. 'iss' should be one of the following: {GOOGLE_ISSUERS}")
+    return claims
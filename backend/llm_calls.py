@@ -0,0 +1,508 @@
+"""
+Deadlines, retries, hedging and circuit breaking for Gemini calls.
+
+ResilientGenAI wraps the genai client with the same interface
+(models.generate_content, models.generate_content_stream and their aio
+versions). Each instance is a policy for one kind of call, with its own
+deadline and retry budget:
+
+- Every call has a deadline, covering all its attempts. A call still
+  running at the deadline is given up on. Its Vertex request is bounded by
+  an HTTP timeout of what was left (clients.genai_timeout).
+- Retryable errors are retried with full-jitter exponential backoff, but
+  only while the deadline allows. Retryable means 408, 429, 5xx, timeouts
+  and dropped connections. Other errors (a bad request) are raised at once.
+- With hedging on, an attempt still running past the p95 of recent calls
+  under the policy gets a second, identical request. The first answer
+  wins. Hedges are capped at LLM_HEDGE_MAX_FRACTION of calls.
+- One breaker is shared by every policy, since they all reach the same
+  Vertex endpoint. After LLM_BREAKER_FAILURES outage-type failures in a
+  row (5xx, timeouts, dropped connections, but not 429 quota refusals),
+  calls fail fast for LLM_BREAKER_RESET_SECONDS. Then one probe call is
+  let through to test the endpoint.
+
+A call that fails for one of these reasons raises Unavailable, which the
+apps turn into 503 with Retry-After. Streams get the deadline and retries
+up to their first chunk. After that the text has reached the client, so
+later errors are raised as they are.
+"""
+import os
+import math
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
+from typing import Dict, List, Optional, Tuple
+
+import clients
+from metrics import LLM_BREAKER_OPEN, LLM_CALLS, log
+
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get("LLM_BREAKER_RESET_SECONDS", "30"))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_RETRY_MAX_SECONDS = float(os.environ.get("LLM_RETRY_MAX_SECONDS", "4"))
+LLM_HEDGE_MAX_FRACTION = float(os.environ.get("LLM_HEDGE_MAX_FRACTION", "0.1"))
+# Threads running sync Gemini calls, so the caller can stop waiting at the deadline or hedge
+LLM_CALL_WORKERS = int(os.environ.get("LLM_CALL_WORKERS", "64"))
+
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+# Calls observed before the p95 is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+_executor = ThreadPoolExecutor(max_workers=LLM_CALL_WORKERS, thread_name_prefix="llm-call")
+_policies: List["ResilientGenAI"] = []
+
+
+class Unavailable(Exception):
+    """A Gemini call gave up: circuit_open, deadline or error (retries used up). retry_after is in seconds."""
+
+    def __init__(self, policy: str, reason: str, retry_after: int):
+        super().__init__(f"{policy} model call failed ({reason.replace('_', ' ')}), retry in {retry_after}s")
+        self.policy = policy
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def _status(e: Exception) -> Optional[int]:
+    code = getattr(e, "code", None)  # google.genai.errors.APIError
+    return code if isinstance(code, int) else None
+
+
+def retryable(e: Exception) -> bool:
+    status = _status(e)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    try:
+        import requests
+    except ImportError:
+        return False
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+def _outage(e: Exception) -> bool:
+    """Errors that say the endpoint is down, rather than that we are over quota."""
+    return retryable(e) and _status(e) != 429
+
+
+class CircuitBreaker:
+    """Closed, open after `failures` outage errors in a row, half open (one probe) after `reset_after` seconds."""
+
+    def __init__(self, name: str, failures: int = 5, reset_after: float = 30.0):
+        self.name = name
+        self.failures = max(1, failures)
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opened = 0
+
+    def _wait(self) -> float:
+        # Caller holds self._lock
+        if self.state == "closed":
+            return 0.0
+        wait = self._opened_at + self.reset_after - time.monotonic()
+        if wait > 0:
+            return wait
+        return 1.0 if self._probing else 0.0
+
+    def peek(self) -> float:
+        """Like allow(), but claims nothing: 0 if a call could go ahead now, else the seconds until one may."""
+        with self._lock:
+            return self._wait()
+
+    def allow(self) -> Tuple[float, bool]:
+        """
+        (0, probe) if a call may go ahead, else (seconds until one may, False).
+        probe is True for the one call let through half open; its caller must
+        release_probe() once the call is over, however it ends.
+        """
+        with self._lock:
+            wait = self._wait()
+            if wait or self.state == "closed":
+                return wait, False
+            self.state = "half_open"
+            self._probing = True
+            return 0.0, True
+
+    def release_probe(self):
+        """End a probe claimed by allow(). A no-op once success() or failure() has settled the state."""
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._probing = False
+            if self.state != "closed":
+                log(f"✅ {self.name} circuit closed")
+                self.state = "closed"
+                LLM_BREAKER_OPEN.set(0, breaker=self.name)
+
+    def failure(self, e: Exception):
+        if not _outage(e):
+            with self._lock:
+                self._probing = False
+            return
+        with self._lock:
+            self._consecutive += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self._consecutive >= self.failures):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                LLM_BREAKER_OPEN.set(1, breaker=self.name)
+                log(f"🔌 {self.name} circuit open for {self.reset_after:.0f}s after {self._consecutive} failures: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self._consecutive, "opened": self.opened}
+
+
+vertex = CircuitBreaker("vertex", LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+
+
+class LatencyTracker:
+    """Recent successful call latencies, for the hedging threshold."""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class ResilientGenAI:
+    """
+    The genai client under one call policy. Attributes other than models and
+    aio (caches, files) are the wrapped client's, unprotected.
+    """
+
+    def __init__(self, client, name: str, deadline: float, retries: int = 2, hedge: bool = False,
+                 breaker: CircuitBreaker = vertex):
+        self._client = client
+        self.name = name
+        self.deadline = deadline
+        self.retries = max(0, retries)
+        self.hedge = hedge
+        self.breaker = breaker
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.models = _Models(self)
+        self.aio = _AsyncClient(self)
+        _policies.append(self)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+    def _count(self, outcome: str):
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        LLM_CALLS.inc(policy=self.name, outcome=outcome)
+
+    # --- shared decisions ---
+    def _circuit_open(self, wait: float) -> Unavailable:
+        self._count("circuit_open")
+        return Unavailable(self.name, "circuit_open", max(1, math.ceil(wait)))
+
+    def check(self):
+        """
+        Raise Unavailable now if the breaker is open, e.g. before starting a
+        response that streams. Only looks: the call itself claims the probe.
+        """
+        wait = self.breaker.peek()
+        if wait:
+            raise self._circuit_open(wait)
+
+    def _admit(self) -> bool:
+        """Let one attempt through the breaker, or raise Unavailable. True if it is the half-open probe."""
+        wait, probe = self.breaker.allow()
+        if wait:
+            raise self._circuit_open(wait)
+        return probe
+
+    def _hedge_after(self) -> Optional[float]:
+        if not self.hedge:
+            return None
+        with self._lock:
+            calls = self.counts.get("ok", 0) + self.counts.get("failed", 0)
+            hedged = self.counts.get("hedged", 0)
+        if hedged >= LLM_HEDGE_MAX_FRACTION * max(calls, HEDGE_MIN_SAMPLES):
+            return None
+        return self.latency.p95()
+
+    def _retry_in(self, e: Exception, attempt: int, deadline: float) -> Optional[float]:
+        """Seconds to back off before the next attempt, or None to give up."""
+        self.breaker.failure(e)
+        if attempt >= self.retries or not retryable(e):
+            return None
+        delay = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+        if time.monotonic() + delay >= deadline:
+            return None
+        log(f"🔁 {self.name} model call attempt {attempt + 1} failed, retrying in {delay:.1f}s: {e}")
+        self._count("retried")
+        return delay
+
+    def _give_up(self, e: Exception) -> Exception:
+        """What to raise once retries are over: Unavailable for timeouts and retryable errors, else e itself."""
+        if isinstance(e, DeadlineExceeded):
+            self._count("timeout")
+            log(f"⏱️ {self.name} model call gave up after {self.deadline:.0f}s")
+            return Unavailable(self.name, "deadline", 5)
+        self._count("failed")
+        if retryable(e):
+            log(f"⚠️ {self.name} model call failed: {e}")
+            return Unavailable(self.name, "error", 5)
+        return e
+
+    def _succeeded(self, seconds: float):
+        self.breaker.success()
+        self.latency.observe(seconds)
+        self._count("ok")
+
+    # --- sync ---
+    def _submit(self, fn, request: dict, deadline: float):
+        # The call runs under this request's context (metrics route, bench scope) with an HTTP timeout
+        ctx = contextvars.copy_context()
+        ctx.run(clients.genai_timeout.set, max(0.1, deadline - time.monotonic()))
+        started = time.monotonic()
+        fut = _executor.submit(ctx.run, fn, **request)
+        fut.started = started
+        return fut
+
+    def _attempt(self, request: dict, deadline: float):
+        """One attempt, hedged if it runs long. Returns the first response; raises the last error."""
+        fn = self._client.models.generate_content
+        pending = {self._submit(fn, request, deadline)}
+        hedge_after = self._hedge_after()
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded()
+            timeout = min(hedge_after, remaining) if hedge_after else remaining
+            done, pending = wait_futures(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done and hedge_after:
+                # Past the p95: ask again and take whichever answers first
+                hedge_after = None
+                self._count("hedged")
+                pending.add(self._submit(fn, request, deadline))
+                continue
+            for fut in done:
+                if fut.exception() is None:
+                    self._succeeded(time.monotonic() - fut.started)
+                    return fut.result()
+                error = fut.exception()
+        raise error
+
+    def generate_content(self, **request):
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            probe = self._admit()
+            try:
+                return self._attempt(request, deadline)
+            except Exception as e:
+                delay = self._retry_in(e, attempt, deadline)
+                if delay is None:
+                    raise self._give_up(e) from e
+            finally:
+                if probe:
+                    self.breaker.release_probe()
+            time.sleep(delay)
+            attempt += 1
+
+    def generate_content_stream(self, **request):
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            probe = self._admit()
+
+            def first_chunk():
+                chunks = iter(self._client.models.generate_content_stream(**request))
+                return chunks, next(chunks, None)
+
+            try:
+                fut = self._submit(first_chunk, {}, deadline)
+                done, _ = wait_futures([fut], timeout=max(0, deadline - time.monotonic()))
+                if not done:
+                    raise DeadlineExceeded()
+                chunks, first = fut.result()
+                self._succeeded(time.monotonic() - fut.started)
+                break
+            except Exception as e:
+                delay = self._retry_in(e, attempt, deadline)
+                if delay is None:
+                    raise self._give_up(e) from e
+            finally:
+                if probe:
+                    self.breaker.release_probe()
+            time.sleep(delay)
+            attempt += 1
+        if first is None:
+            return
+        yield first
+        try:
+            yield from chunks
+        except Exception as e:
+            self.breaker.failure(e)
+            raise
+
+    # --- async ---
+    async def _attempt_async(self, request: dict, deadline: float):
+        fn = self._client.aio.models.generate_content
+        timeout = max(0.1, deadline - time.monotonic())
+
+        async def call():
+            clients.genai_timeout.set(timeout)  # the task's own copy of the context
+            started = time.monotonic()
+            return await fn(**request), time.monotonic() - started
+
+        pending = {asyncio.ensure_future(call())}
+        hedge_after = self._hedge_after()
+        error = None
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded()
+                wait = min(hedge_after, remaining) if hedge_after else remaining
+                done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done and hedge_after:
+                    hedge_after = None
+                    self._count("hedged")
+                    pending.add(asyncio.ensure_future(call()))
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        response, seconds = task.result()
+                        self._succeeded(seconds)
+                        return response
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate_content_async(self, **request):
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            probe = self._admit()
+            try:
+                return await self._attempt_async(request, deadline)
+            except Exception as e:
+                delay = self._retry_in(e, attempt, deadline)
+                if delay is None:
+                    raise self._give_up(e) from e
+            finally:
+                # Also when the task is cancelled mid-call
+                if probe:
+                    self.breaker.release_probe()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def generate_content_stream_async(self, **request):
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            probe = self._admit()
+            started = time.monotonic()
+            token = clients.genai_timeout.set(max(0.1, deadline - started))
+            try:
+                chunks = self._client.aio.models.generate_content_stream(**request).__aiter__()
+                try:
+                    first = await asyncio.wait_for(chunks.__anext__(), max(0.01, deadline - started))
+                except StopAsyncIteration:
+                    first = None
+                self._succeeded(time.monotonic() - started)
+                break
+            except asyncio.TimeoutError:
+                e = DeadlineExceeded()
+            except Exception as exc:
+                e = exc
+            finally:
+                clients.genai_timeout.reset(token)
+                if probe:
+                    self.breaker.release_probe()
+            delay = self._retry_in(e, attempt, deadline)
+            if delay is None:
+                raise self._give_up(e) from e
+            await asyncio.sleep(delay)
+            attempt += 1
+        if first is None:
+            return
+        yield first
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            self.breaker.failure(e)
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        p95 = self.latency.p95()
+        return {
+            "deadline": self.deadline,
+            "retries": self.retries,
+            "hedge": self.hedge,
+            "p95_seconds": round(p95, 3) if p95 is not None else None,
+            **counts,
+        }
+
+
+class _Models:
+    def __init__(self, policy: ResilientGenAI):
+        self._policy = policy
+        self.generate_content = policy.generate_content
+        self.generate_content_stream = policy.generate_content_stream
+
+    def __getattr__(self, name: str):
+        return getattr(self._policy._client.models, name)
+
+
+class _AsyncModels:
+    def __init__(self, policy: ResilientGenAI):
+        self._policy = policy
+        self.generate_content = policy.generate_content_async
+        self.generate_content_stream = policy.generate_content_stream_async
+
+    def __getattr__(self, name: str):
+        return getattr(self._policy._client.aio.models, name)
+
+
+class _AsyncClient:
+    def __init__(self, policy: ResilientGenAI):
+        self._policy = policy
+        self.models = _AsyncModels(policy)
+
+    def __getattr__(self, name: str):
+        return getattr(self._policy._client.aio, name)
+
+
+def stats() -> dict:
+    return {"breaker": vertex.stats(), **{p.name: p.stats() for p in _policies}}
@@ -0,0 +1,357 @@
+"""
+Prometheus-style metrics and per-request tracing.
+
+Backend calls go through thin wrappers (InstrumentedStorage, InstrumentedGenAI
+and observe_tts) that time them and label them with the route of the request
+they ran for, or "background" for work on pool threads. GET /metrics renders
+everything in the Prometheus text format; each request also logs one line
+with its trace id and where its time went.
+"""
+import os
+import time
+import uuid
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from storage import Storage
+
+# Fraction of evaluations whose full transcript and result are logged
+DEBUG_LOG_SAMPLE_RATE = float(os.environ.get("DEBUG_LOG_SAMPLE_RATE", "0"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+BYTE_BUCKETS = (4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, le: Optional[str] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                bounds = ["%g" % b for b in self.buckets] + ["+Inf"]
+                for bound, n in zip(bounds, series[:-2] + [series[-1]]):
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, key, bound)} {n}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, key)} {series[-2]:g}")
+                lines.append(f"{self.name}_count{_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("medsim_request_seconds", "Request latency, including streamed bodies.", ("method", "route", "status"))
+STORAGE_SECONDS = Histogram("medsim_storage_seconds", "Latency of storage operations (Firestore or SQL).", ("op", "kind", "route"))
+LLM_SECONDS = Histogram("medsim_llm_seconds", "Latency of Gemini calls, to the last chunk for streams.", ("call", "model", "route"))
+LLM_FIRST_TOKEN_SECONDS = Histogram("medsim_llm_first_token_seconds", "Time to the first chunk of streamed Gemini calls.", ("model", "route"))
+LLM_TOKENS = Histogram("medsim_llm_tokens", "Prompt and response tokens per Gemini call, from usage metadata.", ("kind", "model", "route"), TOKEN_BUCKETS)
+TTS_SECONDS = Histogram("medsim_tts_seconds", "Latency of ElevenLabs synthesis, to the last audio byte.", ("route",))
+TTS_AUDIO_BYTES = Histogram("medsim_tts_audio_bytes", "Size of synthesized clips.", ("route",), BYTE_BUCKETS)
+BACKEND_ERRORS = Counter("medsim_backend_errors_total", "Backend calls that raised.", ("backend", "op", "route"))
+ADMISSION_IN_FLIGHT = Gauge("medsim_admission_in_flight", "Admitted upstream calls currently running.", ("upstream",))
+ADMISSION_QUEUED = Gauge("medsim_admission_queue_depth", "Upstream calls waiting for a slot.", ("upstream",))
+ADMISSION_REJECTED = Counter("medsim_admission_rejected_total", "Upstream calls turned away with 429.", ("upstream", "reason"))
+ADMISSION_WAIT_SECONDS = Histogram("medsim_admission_wait_seconds", "Time admitted upstream calls spent queued.", ("upstream",))
+SINGLEFLIGHT_CALLS = Counter("medsim_singleflight_total", "Coalesced calls, by whether they ran the work or joined one in flight.", ("route", "role"))
+LLM_CALLS = Counter("medsim_llm_calls_total", "Gemini calls through llm_calls, by policy and outcome.", ("policy", "outcome"))
+LLM_BREAKER_OPEN = Gauge("medsim_llm_breaker_open", "1 while the circuit breaker fails Gemini calls fast.", ("breaker",))
+
+REGISTRY = [
+    REQUEST_SECONDS, STORAGE_SECONDS, LLM_SECONDS, LLM_FIRST_TOKEN_SECONDS, LLM_TOKENS, TTS_SECONDS, TTS_AUDIO_BYTES, BACKEND_ERRORS,
+    ADMISSION_IN_FLIGHT, ADMISSION_QUEUED, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS, SINGLEFLIGHT_CALLS,
+    LLM_CALLS, LLM_BREAKER_OPEN,
+]
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# --- request traces ---
+class RequestTrace:
+    """Where one request's time went, per backend."""
+
+    def __init__(self, route: str, trace_id: Optional[str] = None):
+        self.route = route
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.calls = {}  # backend -> [count, seconds]
+
+    def add(self, backend: str, seconds: float):
+        with self._lock:
+            entry = self.calls.setdefault(backend, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def summary(self) -> str:
+        with self._lock:
+            return " ".join(f"{b}={n}/{s * 1000:.0f}ms" for b, (n, s) in sorted(self.calls.items()))
+
+
+_current = contextvars.ContextVar("medsim_request_trace", default=None)
+
+
+def begin_request(route: str, trace_id: Optional[str] = None) -> RequestTrace:
+    trace = RequestTrace(route, trace_id)
+    _current.set(trace)
+    return trace
+
+
+def end_request(trace: RequestTrace, method: str, status: int):
+    elapsed = time.perf_counter() - trace.started
+    REQUEST_SECONDS.observe(elapsed, method=method, route=trace.route, status=status)
+    print(f"🧭 [{trace.trace_id}] {method} {trace.route} {status} {elapsed * 1000:.0f}ms {trace.summary()}".rstrip())
+    if _current.get() is trace:
+        _current.set(None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+def current_route() -> str:
+    trace = _current.get()
+    return trace.route if trace else "background"
+
+
+def log(message: str):
+    """print(), prefixed with the trace id when called for a request."""
+    trace = _current.get()
+    print(f"[{trace.trace_id}] {message}" if trace else message)
+
+
+def debug_sample(message: str, payload) -> bool:
+    """Log payload for a DEBUG_LOG_SAMPLE_RATE fraction of calls."""
+    if DEBUG_LOG_SAMPLE_RATE <= 0 or random.random() >= DEBUG_LOG_SAMPLE_RATE:
+        return False
+    log(f"🔎 {message}: {payload}")
+    return True
+
+
+def _record(backend: str, op: str, seconds: float, failed: bool):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(backend, seconds)
+    if failed:
+        BACKEND_ERRORS.inc(backend=backend, op=op, route=current_route())
+
+
+@contextmanager
+def _timed(backend: str, op: str, histogram: Histogram, /, **labels):
+    """Observe the block's duration on histogram (plus a route label) and on the request trace."""
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, route=current_route(), **labels)
+        _record(backend, op, elapsed, failed)
+
+
+# --- storage ---
+STORAGE_WRITES = {
+    "create_user", "update_user", "create_thread", "delete_thread", "save_summary", "add_messages",
+    "store_feedback", "write_feedback_batch", "rebuild_analytics", "claim_feedback_job",
+    "update_feedback_job", "put_cached_feedback",
+}
+
+
+def observe_storage(op: str):
+    """Time one storage operation made outside InstrumentedStorage, e.g. the async routes' own Firestore calls."""
+    return _timed("storage", op, STORAGE_SECONDS, op=op, kind="write" if op in STORAGE_WRITES else "read")
+
+
+class InstrumentedStorage:
+    """
+    Times every Storage method of the wrapped store. Other attributes (db,
+    engine, conversation_cache) pass straight through. Methods are looked up
+    on the store at call time, so binding store.get_user early doesn't build
+    a lazily created store.
+    """
+
+    def __init__(self, store: Storage):
+        self._store = store
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or not callable(getattr(Storage, name, None)):
+            return getattr(self._store, name)
+
+        def timed(*args, **kwargs):
+            with observe_storage(name):
+                return getattr(self._store, name)(*args, **kwargs)
+
+        return timed
+
+
+# --- Gemini ---
+def _observe_usage(response, model: str):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    route = current_route()
+    if usage.prompt_token_count is not None:
+        LLM_TOKENS.observe(usage.prompt_token_count, kind="prompt", model=model, route=route)
+    if usage.candidates_token_count is not None:
+        LLM_TOKENS.observe(usage.candidates_token_count, kind="response", model=model, route=route)
+
+
+class _InstrumentedModels:
+    def __init__(self, models):
+        self._models = models
+
+    def generate_content(self, *, model: str, **kwargs):
+        with _timed("llm", "generate_content", LLM_SECONDS, call="generate_content", model=model):
+            response = self._models.generate_content(model=model, **kwargs)
+        _observe_usage(response, model)
+        return response
+
+    def generate_content_stream(self, *, model: str, **kwargs):
+        started = time.perf_counter()
+        last = None
+        with _timed("llm", "generate_content_stream", LLM_SECONDS, call="generate_content_stream", model=model):
+            for chunk in self._models.generate_content_stream(model=model, **kwargs):
+                if last is None:
+                    LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started, model=model, route=current_route())
+                last = chunk
+                yield chunk
+        if last is not None:
+            _observe_usage(last, model)  # usage metadata arrives with the final chunk
+
+    def __getattr__(self, name: str):
+        return getattr(self._models, name)
+
+
+class _InstrumentedAsyncModels:
+    def __init__(self, models):
+        self._models = models
+
+    async def generate_content(self, *, model: str, **kwargs):
+        with _timed("llm", "generate_content", LLM_SECONDS, call="generate_content", model=model):
+            response = await self._models.generate_content(model=model, **kwargs)
+        _observe_usage(response, model)
+        return response
+
+    async def generate_content_stream(self, *, model: str, **kwargs):
+        started = time.perf_counter()
+        last = None
+        with _timed("llm", "generate_content_stream", LLM_SECONDS, call="generate_content_stream", model=model):
+            async for chunk in self._models.generate_content_stream(model=model, **kwargs):
+                if last is None:
+                    LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started, model=model, route=current_route())
+                last = chunk
+                yield chunk
+        if last is not None:
+            _observe_usage(last, model)
+
+    def __getattr__(self, name: str):
+        return getattr(self._models, name)
+
+
+class _InstrumentedAsyncClient:
+    def __init__(self, aio):
+        self._aio = aio
+        self.models = _InstrumentedAsyncModels(aio.models)
+
+    def __getattr__(self, name: str):
+        return getattr(self._aio, name)
+
+
+class InstrumentedGenAI:
+    """A genai.Client whose generate_content calls (sync, streamed and aio) are timed."""
+
+    def __init__(self, client):
+        self._client = client
+        self.models = _InstrumentedModels(client.models)
+        self.aio = _InstrumentedAsyncClient(client.aio)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+# --- ElevenLabs ---
+@contextmanager
+def observe_tts():
+    """
+    Time one synthesis, to the last byte written. The caller sets
+    result["bytes"] to the size of the clip.
+    """
+    result = {}
+    with _timed("tts", "generate", TTS_SECONDS):
+        yield result
+    if "bytes" in result:
+        TTS_AUDIO_BYTES.observe(result["bytes"], route=current_route())
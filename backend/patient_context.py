@@ -0,0 +1,97 @@
+from typing import TYPE_CHECKING, List, Optional
+
+if TYPE_CHECKING:
+    from google.genai.types import Content
+
+SUMMARY_SYSTEM = (
+    "You maintain the case notes for a simulated patient in a clinical interview. "
+    "Record only what was actually said. Never add new facts."
+)
+
+SUMMARY_TASK = """\
+Update the patient fact sheet below with the new part of the interview.
+
+Keep every fact the PATIENT has stated (symptoms, onset, duration, severity, triggers,
+medications, allergies, past history, family/social history, things they denied),
+using the patient's own specifics (numbers, dates, names). Add one line listing the
+topics the doctor has already asked about. Drop small talk. Keep it under 200 words,
+as short bullet points.
+
+Current fact sheet:
+{summary}
+
+New part of the interview:
+{transcript}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough but model-agnostic: ~4 characters per token for English
+    return len(text or "") // 4 + 1
+
+
+def window_start(history: List[dict], max_turns: int, token_budget: int) -> int:
+    """
+    Index of the first message to send verbatim: the most recent messages that
+    fit in max_turns doctor turns and token_budget tokens, starting on a doctor
+    message so the contents alternate user/model from the top.
+    """
+    start = len(history)
+    tokens = 0
+    turns = 0
+    for i in range(len(history) - 1, -1, -1):
+        tokens += estimate_tokens(history[i].get("content"))
+        if tokens > token_budget:
+            break
+        if history[i].get("role") == "doctor":
+            turns += 1
+            start = i
+            if turns >= max_turns:
+                break
+    return start
+
+
+def build_contents(messages: List[dict], prompt: str) -> List["Content"]:
+    """Doctor turns as role user, patient turns as role model; consecutive same-role messages merged."""
+    from google.genai.types import Content, Part
+    out = []
+    for m in list(messages) + [{"role": "doctor", "content": prompt}]:
+        role = "user" if m.get("role") == "doctor" else "model"
+        text = m.get("content") or ""
+        if out and out[-1].role == role:
+            out[-1].parts.append(Part.from_text(text=text))
+        else:
+            out.append(Content(role=role, parts=[Part.from_text(text=text)]))
+    return out
+
+
+def system_instruction(base: str, summary: Optional[str]) -> str:
+    if not summary:
+        return base
+    return (
+        f"{base}\n\n"
+        "Earlier in this interview you already told the doctor the following. "
+        "Stay consistent with it and do not contradict it:\n"
+        f"{summary}"
+    )
+
+
+def summarize(client, model: str, summary: Optional[str], messages: List[dict]) -> str:
+    """Fold messages into the running summary with one small model call."""
+    from google.genai.types import Content, Part, GenerateContentConfig
+    transcript = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
+    response = client.models.generate_content(
+        model=model,
+        contents=[Content(role="user", parts=[Part.from_text(text=SUMMARY_TASK.format(
+            summary=summary or "(empty)",
+            transcript=transcript,
+        ))])],
+        config=GenerateContentConfig(
+            system_instruction=SUMMARY_SYSTEM,
+            temperature=0.0,
+        ),
+    )
+    text = (response.text or "").strip() if response else ""
+    if not text:
+        raise ValueError("empty summary")
+    return text
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, List, Optional, Tuple
+
+
+class RateLimiter:
+    """Spaces calls evenly so at most per_minute start in any minute, across threads."""
+
+    def __init__(self, per_minute: float):
+        self._interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def load_checkpoint(path: Optional[str]) -> set:
+    """(user_id, thread_id) pairs already re-scored by an earlier, interrupted run."""
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {tuple(json.loads(line)["thread"]) for line in f if line.strip()}
+
+
+def rescore(
+    store,
+    threads: Iterable[Tuple[str, str]],
+    evaluate: Callable[[List[dict]], dict],
+    accept: Callable[[dict], bool] = lambda result: True,
+    workers: int = 4,
+    per_minute: float = 60,
+    batch_size: int = 200,
+    checkpoint: Optional[str] = None,
+) -> dict:
+    """
+    Re-evaluate (user_id, thread_id) threads on a pool of `workers`, starting
+    at most `per_minute` evaluations a minute. Accepted results are written
+    with store.write_feedback_batch every batch_size threads; each batch is
+    then appended to the checkpoint file so a rerun skips those threads.
+    Returns counters, elapsed seconds and the ids of the users touched.
+    """
+    done = load_checkpoint(checkpoint)
+    limiter = RateLimiter(per_minute)
+    stats = {"evaluated": 0, "written": 0, "skipped": 0, "rejected": 0, "errors": 0}
+    users = set()
+    staged = []  # (user_id, thread_id, result)
+    started = time.monotonic()
+
+    def work(user_id, thread_id):
+        thread = store.get_thread(user_id, thread_id) or {}
+        messages, _ = store.load_messages(user_id, thread_id, thread)
+        limiter.wait()
+        return evaluate([{"role": m.get("role"), "content": m.get("content")} for m in messages])
+
+    def flush():
+        nonlocal staged
+        if not staged:
+            return
+        store.write_feedback_batch(staged)
+        if checkpoint:
+            with open(checkpoint, "a") as f:
+                for user_id, thread_id, _ in staged:
+                    f.write(json.dumps({"thread": [user_id, thread_id]}) + "\n")
+        stats["written"] += len(staged)
+        rate = stats["evaluated"] / max(time.monotonic() - started, 1e-9) * 60
+        print(f"💾 {stats['written']} written, {stats['errors']} errors, {rate:.1f} threads/min")
+        staged = []
+
+    def collect(futures):
+        for fut in futures:
+            user_id, thread_id = inflight.pop(fut)
+            try:
+                result = fut.result()
+            except Exception as e:
+                stats["errors"] += 1
+                print(f"❌ {user_id}/{thread_id}: {e}")
+                continue
+            stats["evaluated"] += 1
+            if not accept(result):
+                stats["rejected"] += 1
+                print(f"⚠️ {user_id}/{thread_id}: fallback result, previous feedback kept")
+                continue
+            staged.append((user_id, thread_id, result))
+            users.add(user_id)
+            if len(staged) >= batch_size:
+                flush()
+
+    inflight = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rescore") as pool:
+        for user_id, thread_id in threads:
+            if (user_id, thread_id) in done:
+                stats["skipped"] += 1
+                continue
+            inflight[pool.submit(work, user_id, thread_id)] = (user_id, thread_id)
+            # Keep the queue short so threads are streamed, not loaded up front
+            if len(inflight) >= workers * 2:
+                finished, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+                collect(finished)
+        collect(list(inflight))
+    flush()
+
+    elapsed = time.monotonic() - started
+    stats["elapsed_seconds"] = round(elapsed, 1)
+    stats["threads_per_minute"] = round(stats["evaluated"] / max(elapsed, 1e-9) * 60, 1)
+    stats["users"] = sorted(users)
+    return stats
@@ -0,0 +1,202 @@
+"""
+Request coalescing for expensive routes.
+
+Identical requests arriving together, such as a double-clicked play button,
+a React strict-mode double effect, or the dashboard refetching analytics,
+should cost one computation. SingleFlight keys work by (user, route,
+resource). The first caller with a key runs it, and callers arriving while
+it runs wait for that result instead of starting their own:
+
+    result = flights.do((user_id, "speech", msg_id), lambda: build())
+    result = await flights.do_async((user_id, "speech", msg_id), build_async)
+
+Coalescing within a process needs nothing else. Several workers can
+coordinate as well through FileLocks: the process that runs a key holds a
+lock file for it, and leaders in other processes wait for that lock before
+running their own copy. The functions passed in are written to find the
+first worker's result in the shared caches (audio cache, stored
+evaluations) when that happens, so the second run is cheap. The lock is
+advisory: a leader that can't get it within lock_wait seconds runs anyway.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: coalescing stays in-process
+    fcntl = None
+
+from metrics import SINGLEFLIGHT_CALLS, log
+
+# Lock files are reused across keys, so the directory stays this size however many keys pass through
+LOCK_STRIPES = 256
+
+
+class FileLocks:
+    """
+    Advisory locks shared by the processes on one host, as flock()ed files
+    under directory. Keys hash onto LOCK_STRIPES files. Two keys that land on
+    the same file only run one after the other, and neither waits long.
+    """
+
+    def __init__(self, directory: str):
+        if fcntl is None:
+            raise RuntimeError("FileLocks needs fcntl (POSIX)")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        stripe = int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % LOCK_STRIPES
+        return os.path.join(self.directory, f"{stripe:03d}.lock")
+
+    def try_acquire(self, key: str) -> Optional[Callable[[], None]]:
+        """Lock key without blocking. Returns the function that unlocks it, or None if another holder has it."""
+        fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+
+        def release():
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+        return release
+
+
+class SingleFlight:
+    """
+    In-flight computations by key. Results are handed to every caller that
+    joined and are not kept afterwards. Caching is the job of the function.
+    Exceptions reach every caller too, so a 429 from admission control is a
+    429 for all of them.
+    """
+
+    def __init__(self, locks: Optional[FileLocks] = None, lock_wait: float = 60.0):
+        self._locks = locks
+        self.lock_wait = lock_wait
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+        self.led = 0
+        self.joined = 0
+        self.lock_waits = 0
+
+    def claim(self, key: Tuple) -> Tuple[Future, bool]:
+        """
+        Return (future, owner) for key. The owner must resolve the future and
+        release() it; everyone else waits on it.
+        """
+        route = key[1] if len(key) > 1 else ""
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.joined += 1
+                SINGLEFLIGHT_CALLS.inc(route=route, role="joined")
+                return fut, False
+            fut = Future()
+            fut.set_running_or_notify_cancel()
+            self._inflight[key] = fut
+            self.led += 1
+        SINGLEFLIGHT_CALLS.inc(route=route, role="led")
+        return fut, True
+
+    def release(self, key: Tuple, fut: Future):
+        with self._lock:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+    def _lock_name(self, key: Tuple) -> str:
+        return "\x1f".join(str(part) for part in key)
+
+    def _shared_lock(self, key: Tuple) -> Optional[Callable[[], None]]:
+        """Wait up to lock_wait for the cross-process lock. Returns its release, or None to run unlocked."""
+        if self._locks is None:
+            return None
+        name = self._lock_name(key)
+        release = self._locks.try_acquire(name)
+        if release is not None:
+            return release
+        self.lock_waits += 1
+        deadline = time.monotonic() + self.lock_wait
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            release = self._locks.try_acquire(name)
+            if release is not None:
+                return release
+        log(f"⚠️ Shared lock for {key[1:]} still held after {self.lock_wait:.0f}s, running anyway")
+        return None
+
+    async def _shared_lock_async(self, key: Tuple) -> Optional[Callable[[], None]]:
+        if self._locks is None:
+            return None
+        name = self._lock_name(key)
+        release = self._locks.try_acquire(name)
+        if release is not None:
+            return release
+        self.lock_waits += 1
+        deadline = time.monotonic() + self.lock_wait
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            release = self._locks.try_acquire(name)
+            if release is not None:
+                return release
+        log(f"⚠️ Shared lock for {key[1:]} still held after {self.lock_wait:.0f}s, running anyway")
+        return None
+
+    def do(self, key: Tuple, fn: Callable[[], object]):
+        """fn()'s result, computed once for all callers that ask for key at the same time."""
+        fut, owner = self.claim(key)
+        if not owner:
+            return fut.result()
+        try:
+            unlock = self._shared_lock(key)
+            try:
+                result = fn()
+            finally:
+                if unlock:
+                    unlock()
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            self.release(key, fut)
+
+    async def do_async(self, key: Tuple, fn: Callable[[], Awaitable]):
+        """do() for coroutines. Joins flights started by the Flask routes too, since they share the table."""
+        fut, owner = self.claim(key)
+        if not owner:
+            return await asyncio.shield(asyncio.wrap_future(fut))
+        try:
+            unlock = await self._shared_lock_async(key)
+            try:
+                result = await fn()
+            finally:
+                if unlock:
+                    unlock()
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            self.release(key, fut)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._inflight),
+                "led": self.led,
+                "joined": self.joined,
+                "lock_waits": self.lock_waits,
+                "shared_locks": self._locks.directory if self._locks else None,
+            }
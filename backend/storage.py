@@ -0,0 +1,174 @@
+import json
+import base64
+import datetime as dt
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+# What the sidebar shows; list_threads returns only these (plus "id")
+THREAD_LIST_FIELDS = ("title", "status", "created_at", "updated_at", "ended_at")
+
+
+class Storage:
+    """
+    Persistence for users, threads, messages, feedback and the records built
+    on them (analytics rollups, feedback jobs, cached evaluations).
+
+    Ids are strings. Threads and messages are plain dicts carrying their "id"
+    plus their stored fields; datetimes are returned as datetime objects.
+    Messages also carry "seq", their 1-based position in the thread.
+    Implementations: storage_firestore.FirestoreStorage and
+    storage_sql.SQLStorage, picked with STORAGE_BACKEND.
+    """
+
+    # --- users ---
+    def find_user(self, email: str) -> Optional[str]:
+        """Keyed lookup by email; runs on every login."""
+        raise NotImplementedError
+
+    def create_user(self, fields: dict) -> str:
+        """If a user with this email was created concurrently, their id is returned instead."""
+        raise NotImplementedError
+
+    def update_user(self, user_id: str, fields: dict):
+        raise NotImplementedError
+
+    def user_ids(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    # --- threads ---
+    def list_threads(self, user_id: str, status: Optional[str] = None, limit: Optional[int] = None,
+                     start_after: Optional[Tuple[dt.datetime, str]] = None) -> List[dict]:
+        """
+        Newest first, with only THREAD_LIST_FIELDS. start_after is the
+        (created_at, id) of the last thread of the previous page (see
+        decode_cursor).
+        """
+        raise NotImplementedError
+
+    def create_thread(self, user_id: str, title: Optional[str]) -> dict:
+        """Untitled threads are named "Patient <n>", n from a count that doesn't read every thread."""
+        raise NotImplementedError
+
+    def get_thread(self, user_id: str, thread_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def delete_thread(self, user_id: str, thread_id: str, messages: List[dict]):
+        """Delete a thread with its messages and feedback."""
+        raise NotImplementedError
+
+    def closed_threads(self, user_ids: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, str]]:
+        """Stream (user_id, thread_id) for every closed thread."""
+        raise NotImplementedError
+
+    def save_summary(self, user_id: str, thread_id: str, expected_upto: int, summary: str, new_upto: int):
+        """Store the rolling context summary unless another writer already moved summary_upto on."""
+        raise NotImplementedError
+
+    # --- messages ---
+    def load_messages(self, user_id: str, thread_id: str, thread: dict) -> Tuple[List[dict], int]:
+        """The thread's messages in seq order, plus the message count they correspond to."""
+        raise NotImplementedError
+
+    def load_messages_after(self, user_id: str, thread_id: str, thread: dict, after_seq: int) -> List[dict]:
+        """Only the messages with seq > after_seq, without reading the earlier ones where possible."""
+        raise NotImplementedError
+
+    def add_messages(self, user_id: str, thread_id: str, thread: dict, count: int, messages: List[dict]) -> List[dict]:
+        """
+        Write a turn atomically, numbered from count + 1. Returns the messages
+        with their new ids and seq.
+        """
+        raise NotImplementedError
+
+    def find_message(self, user_id: str, msg_id: str, thread_id: Optional[str] = None) -> Optional[dict]:
+        """A message of the user's, looked up by id alone when thread_id is not known."""
+        raise NotImplementedError
+
+    def load_session(self, user_id: str, thread_id: str) -> Optional[Tuple[dict, List[dict], Optional[dict]]]:
+        """
+        (thread, messages in seq order, feedback or None) for opening a
+        session, with the reads issued together. None if there is no such thread.
+        """
+        raise NotImplementedError
+
+    # --- feedback ---
+    def get_feedback(self, user_id: str, thread_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def store_feedback(self, user_id: str, thread_id: str, title: str, fb_dict: dict):
+        """Close the thread, replace its feedback and update the user's analytics, atomically."""
+        raise NotImplementedError
+
+    def write_feedback_batch(self, items: List[Tuple[str, str, dict]]):
+        """Replace the feedback of many (user_id, thread_id, fb_dict) at once; analytics are not touched."""
+        raise NotImplementedError
+
+    def analytics_rollup(self, user_id: str) -> dict:
+        """The user's analytics.add_session rollup."""
+        raise NotImplementedError
+
+    def rebuild_analytics(self, user_id: str) -> dict:
+        raise NotImplementedError
+
+    # --- feedback jobs ---
+    def claim_feedback_job(self, user_id: str, thread_id: str, is_live: Callable[[dict], bool]) -> Optional[Tuple[dict, bool]]:
+        """
+        Return (job, created), or None if the user has no such thread. The
+        thread's current job is reused if it is for the same message count and
+        is_live(job); otherwise the thread is closed and a new queued job
+        recorded.
+        """
+        raise NotImplementedError
+
+    def get_feedback_job(self, user_id: str, job_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def update_feedback_job(self, user_id: str, job_id: str, fields: dict):
+        raise NotImplementedError
+
+    # --- evaluation cache ---
+    def get_cached_feedback(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put_cached_feedback(self, key: str, result: dict):
+        raise NotImplementedError
+
+
+def encode_cursor(thread: dict) -> str:
+    """Opaque page cursor pointing just past thread."""
+    created_at = thread["created_at"]
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    raw = json.dumps([created_at.isoformat(), thread["id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[dt.datetime, str]:
+    """(created_at as naive UTC, thread id); ValueError if cursor wasn't made by encode_cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, thread_id = json.loads(raw)
+        return dt.datetime.fromisoformat(created_at), str(thread_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid cursor: {cursor!r}") from e
+
+
+def feedback_fields(fb_dict: dict, now) -> dict:
+    """How a generated evaluation is stored."""
+    return {
+        "feedback_text": fb_dict["feedback_text"],
+        "overall_score": fb_dict["overall_score"],
+        "rubric_json": fb_dict["sections"],
+        "created_at": now,
+    }
+
+
+def new_job(thread_id: str, message_count: Optional[int], now) -> dict:
+    return {
+        "thread_id": thread_id,
+        "status": "queued",
+        "message_count": message_count,
+        "attempts": 0,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
@@ -0,0 +1,443 @@
+import contextvars
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from urllib.parse import quote
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
+
+import analytics
+from conversation_cache import ConversationCache
+from storage import THREAD_LIST_FIELDS, Storage, feedback_fields, new_job
+
+
+def message_index_ref(user_ref, msg_id: str):
+    # msg_id -> thread_id, so speech lookup doesn't have to scan every thread
+    return user_ref.collection("message_index").document(msg_id)
+
+
+def email_index_ref(db, email: str):
+    # user_emails/<email> -> {"uid"}: login finds the user with one keyed read instead of a query
+    return db.collection("user_emails").document(quote(email, safe="@+"))
+
+
+def _message_count_update(thread: dict, count: int, added: int):
+    # Threads created before message_count existed get it seeded instead of incremented
+    if thread.get("message_count") is None:
+        return count + added
+    return firestore.Increment(added)
+
+
+def messages_query(thread_ref, thread: dict):
+    """The thread's messages in order (sync or async reference)."""
+    # Threads from before seq existed have unnumbered messages, which ordering by seq would leave out
+    return thread_ref.collection("messages").order_by("seq" if thread.get("sequenced") else "created_at")
+
+
+def number_messages(messages: List[dict]) -> List[dict]:
+    """Give messages read in order their position as seq where they were stored without one."""
+    for position, msg in enumerate(messages, 1):
+        if msg.get("seq") is None:
+            msg["seq"] = position
+    return messages
+
+
+def add_turn_to_batch(batch, thread_ref, thread: dict, count: int, messages: List[dict]) -> List[dict]:
+    """
+    Stage a turn's messages, their speech index entries and the thread update
+    on batch (a batch or transaction, sync or async). Messages are numbered
+    from count + 1. Returns the messages with their new ids and seq.
+    """
+    written = []
+    for seq, msg in enumerate(messages, count + 1):
+        msg = {**msg, "seq": seq}
+        msg_ref = thread_ref.collection("messages").document()
+        batch.set(msg_ref, msg)
+        if msg["role"] == "patient":
+            batch.set(message_index_ref(thread_ref.parent.parent, msg_ref.id), {"thread_id": thread_ref.id})
+        written.append({"id": msg_ref.id, **msg})
+    batch.update(thread_ref, {
+        "updated_at": dt.datetime.utcnow(),
+        "message_count": _message_count_update(thread, count, len(written)),
+    })
+    return written
+
+
+def stage_turn(transaction, thread_ref, thread_snap, count: int, messages: List[dict]) -> Tuple[int, List[dict]]:
+    """
+    add_turn_to_batch numbered from the message_count read in transaction,
+    so two turns posted together can't be given the same seq (a conflicting
+    commit retries the transaction, which reads the new count). count, as
+    loaded by the caller, only numbers threads from before message_count.
+    Returns (the count the turn follows, the written messages).
+    """
+    thread = thread_snap.to_dict() or {}
+    if thread.get("message_count") is not None:
+        count = thread["message_count"]
+    return count, add_turn_to_batch(transaction, thread_ref, thread, count, messages)
+
+
+@firestore.transactional
+def _add_turn_txn(transaction, thread_ref, count: int, messages: List[dict]) -> Tuple[int, List[dict]]:
+    return stage_turn(transaction, thread_ref, thread_ref.get(transaction=transaction), count, messages)
+
+
+def write_feedback(transaction, thread_ref, stats_snap, prev_snap, title: str, fb_dict: dict):
+    """
+    Stage the feedback writes on transaction (sync or async): close the thread,
+    replace feedback/latest and fold the scores into the analytics rollup.
+    stats_snap and prev_snap are the rollup and previous feedback read in it.
+    """
+    thread_id = thread_ref.id
+    fb_ref = thread_ref.collection("feedback").document("latest")
+    now = dt.datetime.utcnow()
+    transaction.update(thread_ref, {
+        "status": "closed",
+        "ended_at": now,
+        "updated_at": now
+    })
+    transaction.set(fb_ref, feedback_fields(fb_dict, now))
+
+    # No rollup yet means an existing user: GET /api/analytics rebuilds it from scratch
+    if stats_snap.exists:
+        previous = None
+        if prev_snap.exists:
+            prev = prev_snap.to_dict() or {}
+            previous = analytics.session_entry(thread_id, title, None, prev.get("overall_score", 0), prev.get("rubric_json", {}))
+        entry = analytics.session_entry(thread_id, title, now, fb_dict["overall_score"], fb_dict["sections"])
+        transaction.set(stats_snap.reference, analytics.add_session(stats_snap.to_dict(), entry, previous))
+
+
+@firestore.transactional
+def _store_feedback_txn(transaction, thread_ref, title: str, fb_dict: dict):
+    # Reads must precede writes inside a transaction
+    stats_snap = thread_ref.parent.parent.collection("stats").document("analytics").get(transaction=transaction)
+    prev_snap = thread_ref.collection("feedback").document("latest").get(transaction=transaction)
+    write_feedback(transaction, thread_ref, stats_snap, prev_snap, title, fb_dict)
+
+
+@firestore.transactional
+def _create_thread_txn(transaction, user_ref, title: Optional[str]) -> dict:
+    threads_ref = user_ref.collection("threads")
+    count = (user_ref.get(transaction=transaction).to_dict() or {}).get("thread_count")
+    if count is None:
+        # Users from before the counter: one aggregation query, then the counter takes over
+        count = threads_ref.count().get()[0][0].value
+    thread_ref = threads_ref.document()
+    now = dt.datetime.utcnow()
+    thread = {
+        "title": title or f"Patient {count + 1}",
+        "status": "open",
+        "created_at": now,
+        "updated_at": now,
+        "message_count": 0,
+        "sequenced": True,  # every message has a seq, so deltas can be queried by it
+    }
+    transaction.set(thread_ref, thread)
+    transaction.set(user_ref, {"thread_count": count + 1}, merge=True)
+    return {"id": thread_ref.id, **thread}
+
+
+@firestore.transactional
+def _save_summary_txn(transaction, thread_ref, expected_upto: int, summary: str, new_upto: int):
+    snap = thread_ref.get(transaction=transaction)
+    # Another worker already moved the summary on: keep theirs
+    if not snap.exists or ((snap.to_dict() or {}).get("summary_upto") or 0) != expected_upto:
+        return
+    transaction.update(thread_ref, {"context_summary": summary, "summary_upto": new_upto})
+
+
+@firestore.transactional
+def _claim_feedback_job_txn(transaction, thread_ref, is_live: Callable[[dict], bool]) -> Optional[Tuple[dict, bool]]:
+    jobs_ref = thread_ref.parent.parent.collection("feedback_jobs")
+    snap = thread_ref.get(transaction=transaction)
+    if not snap.exists:
+        return None
+    thread = snap.to_dict() or {}
+    job_id = thread.get("feedback_job_id")
+    if job_id:
+        job_snap = jobs_ref.document(job_id).get(transaction=transaction)
+        job = job_snap.to_dict() if job_snap.exists else None
+        if job and job.get("message_count") == thread.get("message_count") and is_live(job):
+            return {"id": job_id, **job}, False
+
+    now = dt.datetime.utcnow()
+    job_ref = jobs_ref.document()
+    job = new_job(thread_ref.id, thread.get("message_count"), now)
+    transaction.set(job_ref, job)
+    transaction.update(thread_ref, {
+        "status": "closed",
+        "ended_at": now,
+        "updated_at": now,
+        "feedback_job_id": job_ref.id,
+    })
+    return {"id": job_ref.id, **job}, True
+
+
+class FirestoreStorage(Storage):
+    """
+    users/<uid> with threads/<tid>/{messages,feedback} subcollections, plus
+    per-user message_index, stats/analytics (the rollup) and feedback_jobs,
+    and top-level user_emails (email -> uid) and feedback_cache collections.
+    The user document keeps thread_count for naming untitled threads.
+
+    Transcripts are served from a ConversationCache keyed by thread path and
+    validated against the thread's message_count.
+    """
+
+    def __init__(self, db: firestore.Client, conversation_cache: ConversationCache, delete_ops_per_second: int = 500,
+                 read_workers: int = 8):
+        self.db = db
+        self.conversation_cache = conversation_cache
+        self.delete_ops_per_second = delete_ops_per_second
+        # Issues the independent reads of load_session side by side
+        self._reads = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="firestore-read")
+
+    def user_ref(self, user_id: str):
+        return self.db.collection("users").document(user_id)
+
+    def thread_ref(self, user_id: str, thread_id: str):
+        return self.user_ref(user_id).collection("threads").document(thread_id)
+
+    def _analytics_ref(self, user_id: str):
+        return self.user_ref(user_id).collection("stats").document("analytics")
+
+    # --- users ---
+    def find_user(self, email: str) -> Optional[str]:
+        index_ref = email_index_ref(self.db, email)
+        entry = index_ref.get()
+        if entry.exists:
+            return entry.to_dict()["uid"]
+        # Users created before the index existed: query once, then index them
+        user_doc = next(self.db.collection("users").where("email", "==", email).limit(1).stream(), None)
+        if user_doc is None:
+            return None
+        index_ref.set({"uid": user_doc.id})
+        return user_doc.id
+
+    def create_user(self, fields: dict) -> str:
+        """
+        The user and their email index entry are written together. If a
+        concurrent login already created the user, that user's id is
+        returned instead of a duplicate.
+        """
+        new_doc = self.db.collection("users").document()
+        batch = self.db.batch()
+        if fields.get("email"):
+            batch.create(email_index_ref(self.db, fields["email"]), {"uid": new_doc.id})
+        # New users' messages are all indexed as they are written
+        batch.set(new_doc, {**fields, "message_index_complete": True})
+        try:
+            batch.commit()
+        except AlreadyExists:
+            return email_index_ref(self.db, fields["email"]).get().to_dict()["uid"]
+        return new_doc.id
+
+    def update_user(self, user_id: str, fields: dict):
+        self.user_ref(user_id).update(fields)
+
+    def user_ids(self) -> Iterable[str]:
+        return (u.id for u in self.db.collection("users").stream())
+
+    # --- threads ---
+    def list_threads(self, user_id: str, status: Optional[str] = None, limit: Optional[int] = None,
+                     start_after: Optional[Tuple[dt.datetime, str]] = None) -> List[dict]:
+        q = self.user_ref(user_id).collection("threads").order_by("created_at", direction="DESCENDING")
+        if status:
+            q = q.where("status", "==", status)
+        if start_after:
+            # A snapshot built from the cursor, so ties on created_at break on the id without reading the thread
+            created_at, thread_id = start_after
+            q = q.start_after(DocumentSnapshot(
+                self.thread_ref(user_id, thread_id), {"created_at": created_at}, True, None, None, None,
+            ))
+        if limit:
+            q = q.limit(limit)
+        q = q.select(list(THREAD_LIST_FIELDS))
+        return [{"id": t.id, **t.to_dict()} for t in q.stream()]
+
+    def create_thread(self, user_id: str, title: Optional[str]) -> dict:
+        return _create_thread_txn(self.db.transaction(), self.user_ref(user_id), title)
+
+    def get_thread(self, user_id: str, thread_id: str) -> Optional[dict]:
+        snap = self.thread_ref(user_id, thread_id).get()
+        return {"id": thread_id, **(snap.to_dict() or {})} if snap.exists else None
+
+    def delete_thread(self, user_id: str, thread_id: str, messages: List[dict]):
+        """Delete a thread with its subcollections and speech index entries through a rate-limited bulk writer."""
+        thread_ref = self.thread_ref(user_id, thread_id)
+        bulk_writer = self.db.bulk_writer(BulkWriterOptions(
+            initial_ops_per_second=self.delete_ops_per_second,
+            max_ops_per_second=self.delete_ops_per_second,
+            mode=SendMode.parallel,
+        ))
+        for msg in messages:
+            if msg.get("role") == "patient":
+                bulk_writer.delete(message_index_ref(self.user_ref(user_id), msg["id"]))
+        self.db.recursive_delete(thread_ref, bulk_writer=bulk_writer)  # flushes and closes the writer
+        self.conversation_cache.invalidate(thread_ref.path)
+        user_ref = self.user_ref(user_id)
+        if (user_ref.get(["thread_count"]).to_dict() or {}).get("thread_count") is not None:
+            user_ref.update({"thread_count": firestore.Increment(-1)})
+
+    def closed_threads(self, user_ids: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, str]]:
+        for uid in (user_ids if user_ids is not None else self.user_ids()):
+            query = self.user_ref(uid).collection("threads").where("status", "==", "closed")
+            for snap in query.stream():
+                yield uid, snap.id
+
+    def save_summary(self, user_id: str, thread_id: str, expected_upto: int, summary: str, new_upto: int):
+        _save_summary_txn(self.db.transaction(), self.thread_ref(user_id, thread_id), expected_upto, summary, new_upto)
+
+    # --- messages ---
+    def load_messages(self, user_id: str, thread_id: str, thread: dict) -> Tuple[List[dict], int]:
+        """Served from the conversation cache when the cached copy matches the thread's message_count."""
+        thread_ref = self.thread_ref(user_id, thread_id)
+        count = thread.get("message_count")
+        cached = self.conversation_cache.get(thread_ref.path, count)
+        if cached is not None:
+            return cached, count
+        messages = number_messages([{"id": m.id, **m.to_dict()} for m in messages_query(thread_ref, thread).stream()])
+        if count is None:
+            count = len(messages)
+        self.conversation_cache.put(thread_ref.path, count, messages)
+        return messages, count
+
+    def load_messages_after(self, user_id: str, thread_id: str, thread: dict, after_seq: int) -> List[dict]:
+        thread_ref = self.thread_ref(user_id, thread_id)
+        cached = self.conversation_cache.get(thread_ref.path, thread.get("message_count"))
+        if cached is None and thread.get("sequenced"):
+            query = messages_query(thread_ref, thread).where("seq", ">", after_seq)
+            return [{"id": m.id, **m.to_dict()} for m in query.stream()]
+        # Older threads number their messages by position, so read them all
+        messages = cached if cached is not None else self.load_messages(user_id, thread_id, thread)[0]
+        return [m for m in messages if m["seq"] > after_seq]
+
+    def add_messages(self, user_id: str, thread_id: str, thread: dict, count: int, messages: List[dict]) -> List[dict]:
+        """One transaction, so a doctor question is never stored without its answer or numbered like another turn."""
+        thread_ref = self.thread_ref(user_id, thread_id)
+        count, written = _add_turn_txn(self.db.transaction(), thread_ref, count, messages)
+        self.conversation_cache.append(thread_ref.path, count, written)
+        return written
+
+    def _index_messages(self, user_ref):
+        """Index the patient messages of every thread written before the index existed, once per user."""
+        threads_ref = user_ref.collection("threads")
+        bulk_writer = self.db.bulk_writer()
+        for thread_snap in threads_ref.select([]).stream():
+            query = threads_ref.document(thread_snap.id).collection("messages").where("role", "==", "patient").select([])
+            for msg_snap in query.stream():
+                bulk_writer.set(message_index_ref(user_ref, msg_snap.id), {"thread_id": thread_snap.id})
+        bulk_writer.close()
+        user_ref.set({"message_index_complete": True}, merge=True)
+
+    def find_message(self, user_id: str, msg_id: str, thread_id: Optional[str] = None) -> Optional[dict]:
+        """
+        Patient messages are indexed in users/<uid>/message_index when written,
+        so a lookup by id alone is two reads. The first miss for a user from
+        before the index existed indexes all their threads and marks the user
+        message_index_complete. After that a miss, such as an unknown or
+        doctor-message id, is None after one more read instead of a scan.
+        """
+        user_ref = self.user_ref(user_id)
+        threads_ref = user_ref.collection("threads")
+        if thread_id is None:
+            index_ref = message_index_ref(user_ref, msg_id)
+            index_snap = index_ref.get()
+            if not index_snap.exists:
+                if (user_ref.get(["message_index_complete"]).to_dict() or {}).get("message_index_complete"):
+                    return None
+                self._index_messages(user_ref)
+                index_snap = index_ref.get()
+                if not index_snap.exists:
+                    return None
+            thread_id = (index_snap.to_dict() or {}).get("thread_id")
+        msg_snap = threads_ref.document(thread_id).collection("messages").document(msg_id).get()
+        return {"id": msg_id, **(msg_snap.to_dict() or {})} if msg_snap.exists else None
+
+    def load_session(self, user_id: str, thread_id: str) -> Optional[Tuple[dict, List[dict], Optional[dict]]]:
+        """
+        The thread and its feedback come from one get_all. When this worker
+        has the transcript cached, that is the only round trip. Otherwise the
+        messages query runs alongside it, ordered by created_at because the
+        thread (and so whether it is sequenced) isn't known yet, and is put
+        in seq order afterwards.
+        """
+        thread_ref = self.thread_ref(user_id, thread_id)
+        fb_ref = thread_ref.collection("feedback").document("latest")
+        query = None
+        if thread_ref.path not in self.conversation_cache:
+            # In the caller's context, so the read is timed against its request
+            query = self._reads.submit(contextvars.copy_context().run, lambda: [
+                {"id": m.id, **m.to_dict()} for m in thread_ref.collection("messages").order_by("created_at").stream()
+            ])
+        snaps = {snap.reference.path: snap for snap in self.db.get_all([thread_ref, fb_ref])}
+        thread_snap, fb_snap = snaps[thread_ref.path], snaps[fb_ref.path]
+        if not thread_snap.exists:
+            if query is not None:
+                query.cancel()
+            return None
+        thread = {"id": thread_id, **(thread_snap.to_dict() or {})}
+        feedback = fb_snap.to_dict() if fb_snap.exists else None
+
+        if query is None:
+            messages, _ = self.load_messages(user_id, thread_id, thread)
+            return thread, messages, feedback
+        messages = query.result()
+        if thread.get("sequenced"):
+            messages.sort(key=lambda m: m["seq"])
+        number_messages(messages)
+        count = thread.get("message_count")
+        # The two reads aren't one snapshot: a turn committed between them leaves the list and the
+        # count disagreeing, and caching that list under the count would hide the turn for good
+        if count is None or len(messages) == count:
+            self.conversation_cache.put(thread_ref.path, len(messages) if count is None else count, messages)
+        return thread, messages, feedback
+
+    # --- feedback ---
+    def get_feedback(self, user_id: str, thread_id: str) -> Optional[dict]:
+        fb = self.thread_ref(user_id, thread_id).collection("feedback").document("latest").get()
+        return fb.to_dict() if fb.exists else None
+
+    def store_feedback(self, user_id: str, thread_id: str, title: str, fb_dict: dict):
+        _store_feedback_txn(self.db.transaction(), self.thread_ref(user_id, thread_id), title, fb_dict)
+
+    def write_feedback_batch(self, items: List[Tuple[str, str, dict]]):
+        batch = self.db.batch()
+        for user_id, thread_id, fb_dict in items:
+            fb_ref = self.thread_ref(user_id, thread_id).collection("feedback").document("latest")
+            batch.set(fb_ref, feedback_fields(fb_dict, dt.datetime.utcnow()))
+        batch.commit()
+
+    def analytics_rollup(self, user_id: str) -> dict:
+        # One read: the rollup is kept up to date by store_feedback
+        snap = self._analytics_ref(user_id).get()
+        return snap.to_dict() if snap.exists else self.rebuild_analytics(user_id)
+
+    def rebuild_analytics(self, user_id: str) -> dict:
+        rollup = analytics.rebuild_rollup(self.user_ref(user_id))
+        self._analytics_ref(user_id).set(rollup)
+        return rollup
+
+    # --- feedback jobs ---
+    def claim_feedback_job(self, user_id: str, thread_id: str, is_live: Callable[[dict], bool]) -> Optional[Tuple[dict, bool]]:
+        return _claim_feedback_job_txn(self.db.transaction(), self.thread_ref(user_id, thread_id), is_live)
+
+    def get_feedback_job(self, user_id: str, job_id: str) -> Optional[dict]:
+        snap = self.user_ref(user_id).collection("feedback_jobs").document(job_id).get()
+        return {"id": job_id, **(snap.to_dict() or {})} if snap.exists else None
+
+    def update_feedback_job(self, user_id: str, job_id: str, fields: dict):
+        self.user_ref(user_id).collection("feedback_jobs").document(job_id).update(fields)
+
+    # --- evaluation cache ---
+    def get_cached_feedback(self, key: str) -> Optional[dict]:
+        snap = self.db.collection("feedback_cache").document(key).get()
+        return (snap.to_dict() or {}).get("result") if snap.exists else None
+
+    def put_cached_feedback(self, key: str, result: dict):
+        self.db.collection("feedback_cache").document(key).set({"result": result, "created_at": dt.datetime.utcnow()})
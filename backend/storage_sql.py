@@ -0,0 +1,443 @@
+import json
+import datetime as dt
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import (
+    Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, Text,
+    and_, create_engine, delete, event, func, insert, inspect, or_, select, update,
+)
+from sqlalchemy.exc import IntegrityError
+
+import analytics
+from storage import THREAD_LIST_FIELDS, Storage, feedback_fields, new_job
+
+metadata = MetaData()
+
+# Same tables and columns as the medsim.db that ships in backend/, plus the
+# columns and tables added since (see _migrate)
+users = Table(
+    "users", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("email", String, nullable=False, unique=True, index=True),
+    Column("name", String, nullable=False),
+    Column("picture", String),
+    Column("hospital", String),
+    Column("created_at", DateTime),
+    Column("last_login", DateTime),
+)
+
+threads = Table(
+    "threads", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("title", String, nullable=False),
+    Column("status", String, nullable=False),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("ended_at", DateTime),
+    Column("context_summary", Text),
+    Column("summary_upto", Integer),
+    Column("feedback_job_id", Integer),
+    Index("ix_threads_user_created", "user_id", "created_at"),
+)
+
+messages = Table(
+    "messages", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("thread_id", Integer, ForeignKey("threads.id"), nullable=False),
+    Column("role", String, nullable=False),
+    Column("content", Text, nullable=False),
+    Column("created_at", DateTime),
+    Column("seq", Integer),  # 1-based position in the thread
+    Index("ix_messages_thread_created", "thread_id", "created_at"),
+    Index("ux_messages_thread_seq", "thread_id", "seq", unique=True),
+)
+
+feedback = Table(
+    "feedback", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("thread_id", Integer, ForeignKey("threads.id"), nullable=False, unique=True),
+    Column("overall_score", Integer, nullable=False),
+    Column("rubric_json", Text, nullable=False),
+    Column("created_at", DateTime),
+    Column("feedback_text", Text),
+)
+
+feedback_jobs = Table(
+    "feedback_jobs", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("thread_id", Integer, ForeignKey("threads.id"), nullable=False),
+    Column("status", String, nullable=False),
+    Column("message_count", Integer),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("error", Text),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+)
+
+feedback_cache = Table(
+    "feedback_cache", metadata,
+    Column("key", String, primary_key=True),
+    Column("result", Text, nullable=False),
+    Column("created_at", DateTime),
+)
+
+
+def _id(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _thread_dict(row) -> dict:
+    data = dict(row._mapping)
+    data["id"] = str(data["id"])
+    data.pop("user_id", None)
+    if data.get("feedback_job_id") is not None:
+        data["feedback_job_id"] = str(data["feedback_job_id"])
+    return data
+
+
+def _message_dict(row) -> dict:
+    return {"id": str(row.id), "role": row.role, "content": row.content, "created_at": row.created_at, "seq": row.seq}
+
+
+def _feedback_dict(row) -> dict:
+    return {
+        "feedback_text": row.feedback_text,
+        "overall_score": row.overall_score,
+        "rubric_json": json.loads(row.rubric_json),
+        "created_at": row.created_at,
+    }
+
+
+def _job_dict(row) -> dict:
+    data = dict(row._mapping)
+    data["id"] = str(data["id"])
+    data["thread_id"] = str(data["thread_id"])
+    data.pop("user_id", None)
+    return data
+
+
+class SQLStorage(Storage):
+    """
+    SQLAlchemy storage, meant for SQLite (medsim.db) in WAL mode. Every
+    thread lookup is scoped by user_id, so one user can never address
+    another's rows.
+    """
+
+    def __init__(self, url: str):
+        self.engine = create_engine(url, connect_args={"timeout": 30} if url.startswith("sqlite") else {})
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", _sqlite_connect)
+            event.listen(self.engine, "begin", _sqlite_begin)
+        self._migrate()
+
+    def _migrate(self):
+        """Create missing tables, columns and indexes; existing data is kept."""
+        metadata.create_all(self.engine)
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in (threads, messages, feedback):
+                existing = {c["name"] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing:
+                        conn.exec_driver_sql(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(self.engine.dialect)}"
+                        )
+            # Number messages stored before seq existed by their old order
+            conn.exec_driver_sql(
+                "UPDATE messages SET seq = (SELECT COUNT(*) FROM messages AS m WHERE m.thread_id = messages.thread_id"
+                " AND (m.created_at < messages.created_at OR (m.created_at = messages.created_at AND m.id <= messages.id)))"
+                " WHERE seq IS NULL"
+            )
+        for table in (threads, messages):
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+
+    def _thread_row(self, conn, user_id: str, thread_id: str):
+        return conn.execute(
+            select(threads).where(threads.c.id == _id(thread_id), threads.c.user_id == _id(user_id))
+        ).first()
+
+    # --- users ---
+    def find_user(self, email: str) -> Optional[str]:
+        with self.engine.connect() as conn:
+            uid = conn.execute(select(users.c.id).where(users.c.email == email)).scalar()
+        return str(uid) if uid is not None else None
+
+    def create_user(self, fields: dict) -> str:
+        try:
+            with self.engine.begin() as conn:
+                return str(conn.execute(insert(users).values(**fields)).inserted_primary_key[0])
+        except IntegrityError:
+            # email is unique: a concurrent login created this user first
+            uid = self.find_user(fields["email"])
+            if uid is None:
+                raise
+            return uid
+
+    def update_user(self, user_id: str, fields: dict):
+        with self.engine.begin() as conn:
+            conn.execute(update(users).where(users.c.id == _id(user_id)).values(**fields))
+
+    def user_ids(self) -> Iterable[str]:
+        with self.engine.connect() as conn:
+            return [str(uid) for uid in conn.execute(select(users.c.id)).scalars()]
+
+    # --- threads ---
+    def list_threads(self, user_id: str, status: Optional[str] = None, limit: Optional[int] = None,
+                     start_after: Optional[Tuple[dt.datetime, str]] = None) -> List[dict]:
+        columns = [threads.c.id] + [threads.c[f] for f in THREAD_LIST_FIELDS]
+        q = select(*columns).where(threads.c.user_id == _id(user_id))
+        if status:
+            q = q.where(threads.c.status == status)
+        if start_after:
+            created_at, thread_id = start_after
+            q = q.where(or_(
+                threads.c.created_at < created_at,
+                and_(threads.c.created_at == created_at, threads.c.id < _id(thread_id)),
+            ))
+        q = q.order_by(threads.c.created_at.desc(), threads.c.id.desc())
+        if limit:
+            q = q.limit(limit)
+        with self.engine.connect() as conn:
+            return [_thread_dict(r) for r in conn.execute(q)]
+
+    def create_thread(self, user_id: str, title: Optional[str]) -> dict:
+        now = dt.datetime.utcnow()
+        with self.engine.begin() as conn:
+            if not title:
+                count = conn.execute(select(func.count()).where(threads.c.user_id == _id(user_id))).scalar()
+                title = f"Patient {count + 1}"
+            thread = {"title": title, "status": "open", "created_at": now, "updated_at": now}
+            thread_id = conn.execute(insert(threads).values(user_id=_id(user_id), **thread)).inserted_primary_key[0]
+        return {"id": str(thread_id), **thread}
+
+    def get_thread(self, user_id: str, thread_id: str) -> Optional[dict]:
+        with self.engine.connect() as conn:
+            row = self._thread_row(conn, user_id, thread_id)
+            if row is None:
+                return None
+            thread = _thread_dict(row)
+            thread["message_count"] = conn.execute(
+                select(func.count()).where(messages.c.thread_id == row.id)
+            ).scalar()
+        return thread
+
+    def delete_thread(self, user_id: str, thread_id: str, messages_: List[dict]):
+        with self.engine.begin() as conn:
+            row = self._thread_row(conn, user_id, thread_id)
+            if row is None:
+                return
+            conn.execute(delete(messages).where(messages.c.thread_id == row.id))
+            conn.execute(delete(feedback).where(feedback.c.thread_id == row.id))
+            conn.execute(delete(feedback_jobs).where(feedback_jobs.c.thread_id == row.id))
+            conn.execute(delete(threads).where(threads.c.id == row.id))
+
+    def closed_threads(self, user_ids: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, str]]:
+        q = select(threads.c.user_id, threads.c.id).where(threads.c.status == "closed")
+        if user_ids is not None:
+            q = q.where(threads.c.user_id.in_([_id(u) for u in user_ids]))
+        with self.engine.connect() as conn:
+            rows = conn.execute(q.order_by(threads.c.user_id, threads.c.id)).all()
+        for uid, tid in rows:
+            yield str(uid), str(tid)
+
+    def save_summary(self, user_id: str, thread_id: str, expected_upto: int, summary: str, new_upto: int):
+        with self.engine.begin() as conn:
+            # Another writer already moved the summary on: keep theirs
+            conn.execute(
+                update(threads)
+                .where(
+                    threads.c.id == _id(thread_id),
+                    threads.c.user_id == _id(user_id),
+                    func.coalesce(threads.c.summary_upto, 0) == expected_upto,
+                )
+                .values(context_summary=summary, summary_upto=new_upto)
+            )
+
+    # --- messages ---
+    def load_messages(self, user_id: str, thread_id: str, thread: dict) -> Tuple[List[dict], int]:
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(messages)
+                .join(threads, threads.c.id == messages.c.thread_id)
+                .where(messages.c.thread_id == _id(thread_id), threads.c.user_id == _id(user_id))
+                .order_by(messages.c.seq)
+            ).all()
+        return [_message_dict(r) for r in rows], len(rows)
+
+    def load_messages_after(self, user_id: str, thread_id: str, thread: dict, after_seq: int) -> List[dict]:
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(messages)
+                .join(threads, threads.c.id == messages.c.thread_id)
+                .where(messages.c.thread_id == _id(thread_id), threads.c.user_id == _id(user_id), messages.c.seq > after_seq)
+                .order_by(messages.c.seq)
+            ).all()
+        return [_message_dict(r) for r in rows]
+
+    def add_messages(self, user_id: str, thread_id: str, thread: dict, count: int, messages_: List[dict]) -> List[dict]:
+        """
+        Numbered after the thread's highest seq, read under the write lock, so
+        concurrent turns can't share one. Nothing is written to a thread the
+        user doesn't own.
+        """
+        written = []
+        with self.engine.connect().execution_options(sqlite_begin="BEGIN IMMEDIATE") as conn, conn.begin():
+            row = self._thread_row(conn, user_id, thread_id)
+            if row is None:
+                return written
+            last = conn.execute(select(func.max(messages.c.seq)).where(messages.c.thread_id == row.id)).scalar() or 0
+            for seq, msg in enumerate(messages_, last + 1):
+                msg = {**msg, "seq": seq}
+                msg_id = conn.execute(insert(messages).values(thread_id=row.id, **msg)).inserted_primary_key[0]
+                written.append({"id": str(msg_id), **msg})
+            conn.execute(update(threads).where(threads.c.id == row.id).values(updated_at=dt.datetime.utcnow()))
+        return written
+
+    def find_message(self, user_id: str, msg_id: str, thread_id: Optional[str] = None) -> Optional[dict]:
+        # One indexed join whether or not the thread is known
+        q = (
+            select(messages)
+            .join(threads, threads.c.id == messages.c.thread_id)
+            .where(messages.c.id == _id(msg_id), threads.c.user_id == _id(user_id))
+        )
+        if thread_id is not None:
+            q = q.where(threads.c.id == _id(thread_id))
+        with self.engine.connect() as conn:
+            row = conn.execute(q).first()
+        return _message_dict(row) if row else None
+
+    def load_session(self, user_id: str, thread_id: str) -> Optional[Tuple[dict, List[dict], Optional[dict]]]:
+        # Local queries on one connection; nothing to gain from running them side by side
+        with self.engine.connect() as conn:
+            row = self._thread_row(conn, user_id, thread_id)
+            if row is None:
+                return None
+            thread = _thread_dict(row)
+            rows = conn.execute(select(messages).where(messages.c.thread_id == row.id).order_by(messages.c.seq)).all()
+            thread["message_count"] = len(rows)
+            fb_row = conn.execute(select(feedback).where(feedback.c.thread_id == row.id)).first()
+        return thread, [_message_dict(r) for r in rows], _feedback_dict(fb_row) if fb_row else None
+
+    # --- feedback ---
+    def get_feedback(self, user_id: str, thread_id: str) -> Optional[dict]:
+        q = (
+            select(feedback)
+            .join(threads, threads.c.id == feedback.c.thread_id)
+            .where(threads.c.id == _id(thread_id), threads.c.user_id == _id(user_id))
+        )
+        with self.engine.connect() as conn:
+            row = conn.execute(q).first()
+        return _feedback_dict(row) if row else None
+
+    def _upsert_feedback(self, conn, thread_id: int, fb_dict: dict, now: dt.datetime):
+        fields = feedback_fields(fb_dict, now)
+        fields["rubric_json"] = json.dumps(fields["rubric_json"])
+        if conn.execute(update(feedback).where(feedback.c.thread_id == thread_id).values(**fields)).rowcount == 0:
+            conn.execute(insert(feedback).values(thread_id=thread_id, **fields))
+
+    def store_feedback(self, user_id: str, thread_id: str, title: str, fb_dict: dict):
+        now = dt.datetime.utcnow()
+        with self.engine.begin() as conn:
+            closed = conn.execute(
+                update(threads)
+                .where(threads.c.id == _id(thread_id), threads.c.user_id == _id(user_id))
+                .values(status="closed", ended_at=now, updated_at=now)
+            ).rowcount
+            if closed:
+                self._upsert_feedback(conn, _id(thread_id), fb_dict, now)
+
+    def write_feedback_batch(self, items: List[Tuple[str, str, dict]]):
+        now = dt.datetime.utcnow()
+        with self.engine.begin() as conn:
+            for user_id, thread_id, fb_dict in items:
+                self._upsert_feedback(conn, _id(thread_id), fb_dict, now)
+
+    def analytics_rollup(self, user_id: str) -> dict:
+        """Built from one join of the user's closed threads with their feedback; nothing is materialized."""
+        q = (
+            select(threads.c.id, threads.c.title, threads.c.ended_at, feedback.c.overall_score, feedback.c.rubric_json)
+            .join(feedback, feedback.c.thread_id == threads.c.id)
+            .where(threads.c.user_id == _id(user_id), threads.c.status == "closed")
+        )
+        rollup = analytics.empty_rollup()
+        with self.engine.connect() as conn:
+            for row in conn.execute(q):
+                analytics.add_session(rollup, analytics.session_entry(
+                    str(row.id), row.title or "Untitled", row.ended_at, row.overall_score, row.rubric_json,
+                ))
+        return rollup
+
+    def rebuild_analytics(self, user_id: str) -> dict:
+        return self.analytics_rollup(user_id)
+
+    # --- feedback jobs ---
+    def claim_feedback_job(self, user_id: str, thread_id: str, is_live: Callable[[dict], bool]) -> Optional[Tuple[dict, bool]]:
+        # BEGIN IMMEDIATE: two End clicks cannot both see "no job" and create one
+        with self.engine.connect().execution_options(sqlite_begin="BEGIN IMMEDIATE") as conn, conn.begin():
+            row = self._thread_row(conn, user_id, thread_id)
+            if row is None:
+                return None
+            count = conn.execute(select(func.count()).where(messages.c.thread_id == row.id)).scalar()
+            if row.feedback_job_id is not None:
+                job_row = conn.execute(select(feedback_jobs).where(feedback_jobs.c.id == row.feedback_job_id)).first()
+                if job_row is not None:
+                    job = _job_dict(job_row)
+                    if job.get("message_count") == count and is_live(job):
+                        return job, False
+
+            now = dt.datetime.utcnow()
+            job = new_job(thread_id, count, now)
+            job_id = conn.execute(insert(feedback_jobs).values(user_id=_id(user_id), **{**job, "thread_id": row.id})).inserted_primary_key[0]
+            conn.execute(
+                update(threads)
+                .where(threads.c.id == row.id)
+                .values(status="closed", ended_at=now, updated_at=now, feedback_job_id=job_id)
+            )
+        return {"id": str(job_id), **job}, True
+
+    def get_feedback_job(self, user_id: str, job_id: str) -> Optional[dict]:
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(feedback_jobs).where(feedback_jobs.c.id == _id(job_id), feedback_jobs.c.user_id == _id(user_id))
+            ).first()
+        return _job_dict(row) if row else None
+
+    def update_feedback_job(self, user_id: str, job_id: str, fields: dict):
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(feedback_jobs)
+                .where(feedback_jobs.c.id == _id(job_id), feedback_jobs.c.user_id == _id(user_id))
+                .values(**fields)
+            )
+
+    # --- evaluation cache ---
+    def get_cached_feedback(self, key: str) -> Optional[dict]:
+        with self.engine.connect() as conn:
+            result = conn.execute(select(feedback_cache.c.result).where(feedback_cache.c.key == key)).scalar()
+        return json.loads(result) if result else None
+
+    def put_cached_feedback(self, key: str, result: dict):
+        with self.engine.begin() as conn:
+            conn.execute(delete(feedback_cache).where(feedback_cache.c.key == key))
+            conn.execute(insert(feedback_cache).values(key=key, result=json.dumps(result), created_at=dt.datetime.utcnow()))
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer; the driver's own
+    # transaction handling is switched off so _sqlite_begin decides how to BEGIN
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def _sqlite_begin(conn):
+    conn.exec_driver_sql(conn.get_execution_options().get("sqlite_begin", "BEGIN"))
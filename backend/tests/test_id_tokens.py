@@ -0,0 +1,98 @@
+import time
+import email.utils
+import threading
+
+from bench_fakes import _CertsResponse
+from id_tokens import CachingRequest, cache_lifetime
+
+CERTS_URL = "https://certs.example/oauth2/v1/certs"
+
+
+class CountingTransport:
+    """A google.auth transport Request answering every call with the given headers, slowly enough to overlap."""
+
+    def __init__(self, headers: dict, status: int = 200, delay: float = 0.0):
+        self.headers = headers
+        self.status = status
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        with self._lock:
+            self.calls.append((method, url))
+        time.sleep(self.delay)
+        return _CertsResponse(self.status, dict(self.headers), b"{}")
+
+
+def test_cache_lifetime_from_max_age_less_age():
+    assert cache_lifetime({"cache-control": "public, max-age=21600, must-revalidate"}) == 21600
+    assert cache_lifetime({"cache-control": "max-age=100", "age": "40"}) == 60
+    assert cache_lifetime({"cache-control": "max-age=100", "age": "400"}) == 0
+    assert cache_lifetime({"cache-control": "max-age=100", "age": "soon"}) == 100
+
+
+def test_cache_lifetime_no_store_wins():
+    assert cache_lifetime({"cache-control": "no-store, max-age=600"}) == 0
+    assert cache_lifetime({"cache-control": "No-Cache"}) == 0
+
+
+def test_cache_lifetime_from_expires():
+    expires = email.utils.formatdate(time.time() + 300, usegmt=True)
+    assert 290 < cache_lifetime({"expires": expires}) <= 300
+    assert cache_lifetime({"expires": "not a date"}) == 0
+    assert cache_lifetime({}) == 0
+
+
+def test_caches_certs_for_their_lifetime():
+    transport = CountingTransport({"Cache-Control": "public, max-age=1"})
+    request = CachingRequest(transport)
+    first = request(CERTS_URL)
+    assert request(CERTS_URL) is first
+    assert request.fetches == 1
+    request._cache[CERTS_URL] = (time.monotonic() - 1, first)  # expired
+    request(CERTS_URL)
+    assert request.fetches == 2
+
+
+def test_concurrent_misses_share_one_fetch():
+    transport = CountingTransport({"Cache-Control": "max-age=3600"}, delay=0.1)
+    request = CachingRequest(transport)
+    threads = [threading.Thread(target=request, args=(CERTS_URL,)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(transport.calls) == 1
+
+
+def test_uncacheable_responses_are_fetched_each_time_without_queueing():
+    transport = CountingTransport({"Cache-Control": "no-store"}, delay=0.1)
+    request = CachingRequest(transport)
+    request(CERTS_URL)
+    started = time.monotonic()
+    threads = [threading.Thread(target=request, args=(CERTS_URL,)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(transport.calls) == 5
+    assert time.monotonic() - started < 0.3
+
+
+def test_errors_and_non_get_requests_are_not_cached():
+    transport = CountingTransport({"Cache-Control": "max-age=3600"}, status=503)
+    request = CachingRequest(transport)
+    request(CERTS_URL)
+    request(CERTS_URL)
+    request(CERTS_URL, method="POST", body=b"x")
+    assert transport.calls == [("GET", CERTS_URL), ("GET", CERTS_URL), ("POST", CERTS_URL)]
+
+
+def test_clear_forces_a_refetch():
+    transport = CountingTransport({"Cache-Control": "max-age=3600"})
+    request = CachingRequest(transport)
+    request(CERTS_URL)
+    request.clear()
+    request(CERTS_URL)
+    assert request.fetches == 2
@@ -0,0 +1,225 @@
+import json
+import time
+import asyncio
+import threading
+
+import pytest
+import requests
+from google.genai import errors as genai_errors
+
+import llm_calls
+from bench_fakes import FakeResponse, _quota_error, _server_error
+from llm_calls import CircuitBreaker, ResilientGenAI, Unavailable
+
+
+def _bad_request():
+    response = requests.Response()
+    response.status_code = 400
+    response.reason = "Bad Request"
+    response._content = json.dumps({"error": {"code": 400, "message": "bad request", "status": "INVALID_ARGUMENT"}}).encode()
+    return genai_errors.ClientError(400, response)
+
+
+class ScriptedGenAI:
+    """
+    A genai client that answers from a script, one entry per call: an
+    exception to raise, or seconds to take before answering "ok". Calls past
+    the end of the script answer at once.
+    """
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.models = self
+        self.aio = _ScriptedAio(self)
+
+    def _next(self):
+        with self._lock:
+            self.calls += 1
+            return self.script.pop(0) if self.script else 0.0
+
+    def generate_content(self, **request):
+        step = self._next()
+        if isinstance(step, Exception):
+            raise step
+        time.sleep(step)
+        return FakeResponse("ok")
+
+    def generate_content_stream(self, **request):
+        step = self._next()
+        if isinstance(step, Exception):
+            raise step
+        time.sleep(step)
+        yield FakeResponse("o")
+        yield FakeResponse("k")
+
+
+class _ScriptedAio:
+    def __init__(self, genai: ScriptedGenAI):
+        self._genai = genai
+        self.models = self
+
+    async def generate_content(self, **request):
+        step = self._genai._next()
+        if isinstance(step, Exception):
+            raise step
+        await asyncio.sleep(step)
+        return FakeResponse("ok")
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_calls, "LLM_RETRY_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(llm_calls, "LLM_RETRY_MAX_SECONDS", 0.02)
+
+
+def policy(client, deadline=5.0, retries=0, hedge=False, failures=3, reset_after=0.05):
+    return ResilientGenAI(client, "test", deadline, retries, hedge, CircuitBreaker("test", failures, reset_after))
+
+
+def trip(p: ResilientGenAI):
+    for _ in range(p.breaker.failures):
+        p.breaker.failure(_server_error())
+    assert p.breaker.state == "open"
+
+
+def test_breaker_opens_after_consecutive_outages():
+    client = ScriptedGenAI(*[_server_error() for _ in range(3)])
+    p = policy(client)
+    for _ in range(3):
+        with pytest.raises(Unavailable) as e:
+            p.models.generate_content(model="m", contents="hi")
+        assert e.value.reason == "error"
+    with pytest.raises(Unavailable) as e:
+        p.models.generate_content(model="m", contents="hi")
+    assert e.value.reason == "circuit_open"
+    assert e.value.retry_after >= 1
+    assert client.calls == 3
+
+
+def test_quota_refusals_do_not_open_the_breaker():
+    p = policy(ScriptedGenAI(*[_quota_error() for _ in range(5)]))
+    for _ in range(5):
+        with pytest.raises(Unavailable):
+            p.models.generate_content(model="m", contents="hi")
+    assert p.breaker.state == "closed"
+
+
+def test_check_does_not_claim_the_probe():
+    p = policy(ScriptedGenAI())
+    trip(p)
+    with pytest.raises(Unavailable):
+        p.check()
+    time.sleep(0.06)
+    # The stream routes check first, then the stream itself must still get the probe
+    p.check()
+    p.check()
+    assert [c.text for c in p.models.generate_content_stream(model="m", contents="hi")] == ["o", "k"]
+    assert p.breaker.state == "closed"
+
+
+def test_one_probe_at_a_time_and_failed_probe_reopens():
+    p = policy(ScriptedGenAI(_server_error()))
+    trip(p)
+    time.sleep(0.06)
+    assert p.breaker.allow() == (0.0, True)
+    assert p.breaker.allow()[0] > 0
+    p.breaker.release_probe()
+    with pytest.raises(Unavailable):
+        p.models.generate_content(model="m", contents="hi")
+    assert p.breaker.state == "open"
+
+
+def test_probe_released_when_not_used():
+    # e.g. admission control refusing the request between check() and the call
+    p = policy(ScriptedGenAI())
+    trip(p)
+    time.sleep(0.06)
+    stream = p.models.generate_content_stream(model="m", contents="hi")
+    stream.close()  # never started, so never claimed
+    p.check()
+    assert p.models.generate_content(model="m", contents="hi").text == "ok"
+    assert p.breaker.state == "closed"
+
+
+def test_probe_released_when_task_cancelled():
+    p = policy(ScriptedGenAI(5.0))
+    trip(p)
+    time.sleep(0.06)
+
+    async def run():
+        task = asyncio.ensure_future(p.aio.models.generate_content(model="m", contents="hi"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await p.aio.models.generate_content(model="m", contents="hi")
+
+    assert asyncio.run(run()).text == "ok"
+    assert p.breaker.state == "closed"
+
+
+def test_retries_server_errors_within_budget():
+    client = ScriptedGenAI(_server_error(), _server_error())
+    p = policy(client, retries=2)
+    assert p.models.generate_content(model="m", contents="hi").text == "ok"
+    assert client.calls == 3
+    assert p.counts["retried"] == 2
+    assert p.breaker.state == "closed"
+
+
+def test_gives_up_when_retries_run_out():
+    client = ScriptedGenAI(_server_error(), _server_error(), _server_error())
+    p = policy(client, retries=1, failures=10)
+    with pytest.raises(Unavailable) as e:
+        p.models.generate_content(model="m", contents="hi")
+    assert e.value.reason == "error"
+    assert client.calls == 2
+
+
+def test_bad_request_is_raised_without_retry():
+    client = ScriptedGenAI(_bad_request())
+    p = policy(client, retries=2)
+    with pytest.raises(genai_errors.ClientError):
+        p.models.generate_content(model="m", contents="hi")
+    assert client.calls == 1
+    assert p.breaker.state == "closed"
+
+
+def test_deadline_covers_all_attempts():
+    p = policy(ScriptedGenAI(1.0), deadline=0.1, retries=2)
+    started = time.monotonic()
+    with pytest.raises(Unavailable) as e:
+        p.models.generate_content(model="m", contents="hi")
+    assert e.value.reason == "deadline"
+    assert time.monotonic() - started < 0.5
+
+
+def test_async_retries_and_deadline():
+    client = ScriptedGenAI(_server_error(), 1.0)
+    p = policy(client, deadline=0.2, retries=2)
+    with pytest.raises(Unavailable) as e:
+        asyncio.run(p.aio.models.generate_content(model="m", contents="hi"))
+    assert e.value.reason == "deadline"
+    assert client.calls == 2
+
+
+def test_hedge_answers_a_slow_call_from_the_second_request():
+    client = ScriptedGenAI(2.0)
+    p = policy(client, hedge=True)
+    for _ in range(llm_calls.HEDGE_MIN_SAMPLES):
+        p.latency.observe(0.01)
+    started = time.monotonic()
+    assert p.models.generate_content(model="m", contents="hi").text == "ok"
+    assert time.monotonic() - started < 1.0
+    assert p.counts["hedged"] == 1
+    assert client.calls == 2
+
+
+def test_no_hedge_without_enough_samples():
+    client = ScriptedGenAI(0.2)
+    p = policy(client, hedge=True)
+    p.models.generate_content(model="m", contents="hi")
+    assert "hedged" not in p.counts
+    assert client.calls == 1
@@ -0,0 +1,94 @@
+import json
+import threading
+
+import pytest
+
+from rescore import load_checkpoint, rescore
+
+THREADS = [(f"user{i % 3}", f"thread{i}") for i in range(10)]
+
+
+class FakeStore:
+    """The slice of Storage rescore() uses, recording each feedback batch written."""
+
+    def __init__(self, fail_on_batch: int = 0):
+        self.batches = []
+        self.fail_on_batch = fail_on_batch
+        self._lock = threading.Lock()
+
+    def get_thread(self, user_id, thread_id):
+        return {"id": thread_id}
+
+    def load_messages(self, user_id, thread_id, thread):
+        return [{"role": "user", "content": f"hello from {thread_id}", "seq": 1}], None
+
+    def write_feedback_batch(self, items):
+        with self._lock:
+            if self.fail_on_batch and len(self.batches) + 1 == self.fail_on_batch:
+                raise RuntimeError("Firestore unavailable")
+            self.batches.append(list(items))
+
+    def written(self) -> set:
+        return {(user_id, thread_id) for batch in self.batches for user_id, thread_id, _ in batch}
+
+
+def evaluate(messages):
+    return {"overall_score": 80, "transcript": messages[0]["content"]}
+
+
+def test_writes_every_thread_in_batches_and_checkpoints(tmp_path):
+    checkpoint = str(tmp_path / "rescore.jsonl")
+    store = FakeStore()
+    stats = rescore(store, THREADS, evaluate, workers=3, per_minute=0, batch_size=4, checkpoint=checkpoint)
+    assert stats["evaluated"] == stats["written"] == 10
+    assert [len(b) for b in store.batches] == [4, 4, 2]
+    assert store.written() == set(THREADS)
+    assert load_checkpoint(checkpoint) == set(THREADS)
+    assert stats["users"] == ["user0", "user1", "user2"]
+
+
+def test_resume_skips_checkpointed_threads(tmp_path):
+    checkpoint = str(tmp_path / "rescore.jsonl")
+    store = FakeStore(fail_on_batch=2)
+    with pytest.raises(RuntimeError):
+        rescore(store, THREADS, evaluate, workers=1, per_minute=0, batch_size=4, checkpoint=checkpoint)
+    saved = load_checkpoint(checkpoint)
+    assert saved == store.written() and len(saved) == 4
+
+    resumed = FakeStore()
+    stats = rescore(resumed, THREADS, evaluate, workers=2, per_minute=0, batch_size=4, checkpoint=checkpoint)
+    assert stats["skipped"] == 4
+    assert stats["written"] == 6
+    assert resumed.written() == set(THREADS) - saved
+    assert load_checkpoint(checkpoint) == set(THREADS)
+
+
+def test_errors_and_rejected_results_are_left_for_the_next_run(tmp_path):
+    checkpoint = str(tmp_path / "rescore.jsonl")
+
+    def flaky(messages):
+        if messages[0]["content"].endswith("thread3"):
+            raise TimeoutError("model call timed out")
+        result = evaluate(messages)
+        if messages[0]["content"].endswith("thread7"):
+            result["overall_score"] = 0
+        return result
+
+    store = FakeStore()
+    stats = rescore(store, THREADS, flaky, accept=lambda r: r["overall_score"] > 0,
+                    workers=4, per_minute=0, batch_size=3, checkpoint=checkpoint)
+    assert stats["errors"] == 1
+    assert stats["rejected"] == 1
+    assert stats["written"] == 8
+    left = set(THREADS) - load_checkpoint(checkpoint)
+    assert left == {("user0", "thread3"), ("user1", "thread7")}
+
+    stats = rescore(FakeStore(), THREADS, evaluate, workers=2, per_minute=0, checkpoint=checkpoint)
+    assert stats["skipped"] == 8 and stats["written"] == 2
+
+
+def test_checkpoint_lines_are_json(tmp_path):
+    checkpoint = tmp_path / "rescore.jsonl"
+    rescore(FakeStore(), THREADS[:2], evaluate, per_minute=0, checkpoint=str(checkpoint))
+    lines = [json.loads(line) for line in checkpoint.read_text().splitlines()]
+    assert sorted(tuple(line["thread"]) for line in lines) == sorted(THREADS[:2])
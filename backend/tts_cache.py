@@ -0,0 +1,154 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import AsyncIterable, Iterable, Optional
+
+
+def cache_key(text: str, voice_id: str, model: str, voice_settings: dict) -> str:
+    """Content address for a synthesized clip: same inputs, same audio."""
+    payload = json.dumps(
+        {"text": text, "voice": voice_id, "model": model, "settings": voice_settings},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """
+    Disk-backed MP3 cache with least-recently-used eviction under a byte budget.
+
+    Files live in one directory named <key>.mp3, so several worker processes
+    can share it: each keeps its own LRU index, and a file another process
+    wrote (or evicted) is picked up (or dropped) the next time it is asked for.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, oldest first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mp3"):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            files.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._bytes += size
+        with self._lock:
+            self._evict()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached file for key (and mark it recently used), or None."""
+        path = self.path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                if key in self._entries:
+                    self._bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            if key not in self._entries:
+                self._entries[key] = size
+                self._bytes += size
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(path)  # keep mtime in LRU order across restarts
+        except OSError:
+            pass
+        return path
+
+    def peek(self, key: str) -> Optional[str]:
+        """Like get, but without touching LRU order or the counters."""
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def put(self, key: str, chunks: Iterable[bytes]) -> str:
+        """Write chunks to the cache as they arrive and return the final path."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+        except BaseException:
+            self._discard(tmp)
+            raise
+        return self._commit(key, tmp)
+
+    async def put_async(self, key: str, chunks: AsyncIterable[bytes]) -> str:
+        """put() for an async chunk source, e.g. the async ElevenLabs client."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+        except BaseException:
+            self._discard(tmp)
+            raise
+        return self._commit(key, tmp)
+
+    def _discard(self, tmp: str):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+    def _commit(self, key: str, tmp: str) -> str:
+        try:
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            self._discard(tmp)
+            raise
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)
+            self._entries[key] = size
+            self._bytes += size
+            self._evict(keep=key)
+        return self.path(key)
+
+    def _evict(self, keep: Optional[str] = None):
+        # Caller holds the lock
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+from metrics import log
+
+
+class SpeechPrefetcher:
+    """
+    Bounded pool that synthesizes patient audio ahead of the play request.
+
+    Every synthesis, speculative or on-demand, is registered by cache key while
+    it runs, so a speech request for a clip that is already being produced
+    waits for it instead of calling ElevenLabs a second time. Speculative jobs
+    are dropped rather than queued once max_pending jobs are outstanding.
+    """
+
+    def __init__(self, synthesize: Callable[[str, str], str], max_workers: int = 2, max_pending: int = 16):
+        self._synthesize = synthesize
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-prefetch")
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> Future
+        self.submitted = 0
+        self.dropped = 0
+        self.joined = 0
+        self.failed = 0
+
+    def _forget(self, key: str, fut: Future):
+        with self._lock:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+    def submit(self, key: str, text: str) -> bool:
+        """Queue a speculative synthesis. Returns False if it was dropped."""
+        with self._lock:
+            if key in self._inflight:
+                return True
+            if len(self._inflight) >= self._max_pending:
+                self.dropped += 1
+                return False
+            fut = self._executor.submit(self._run, key, text)
+            self._inflight[key] = fut
+            self.submitted += 1
+        fut.add_done_callback(lambda f: self._forget(key, f))
+        return True
+
+    def _run(self, key: str, text: str) -> str:
+        try:
+            return self._synthesize(key, text)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            log(f"⚠️ Speculative TTS failed: {e}")
+            raise
+
+    def claim(self, key: str) -> Tuple[Future, bool]:
+        """
+        Return (future, owner) for key. The owner must resolve the future and
+        release() it; everyone else waits on it.
+        """
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.joined += 1
+                return fut, False
+            fut = Future()
+            fut.set_running_or_notify_cancel()
+            self._inflight[key] = fut
+            return fut, True
+
+    def release(self, key: str, fut: Future):
+        self._forget(key, fut)
+
+    def get_or_synthesize(self, key: str, text: str, timeout: Optional[float] = None) -> str:
+        """Join an in-flight synthesis of key, or run one here while others can join it."""
+        fut, owner = self.claim(key)
+        if not owner:
+            try:
+                return fut.result(timeout=timeout)
+            except Exception:
+                # Speculative job failed or is stuck; synthesize on the request path
+                return self._synthesize(key, text)
+
+        try:
+            path = self._synthesize(key, text)
+            fut.set_result(path)
+            return path
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            self.release(key, fut)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._inflight),
+                "max_pending": self._max_pending,
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "joined": self.joined,
+                "failed": self.failed,
+            }
@@ -11,6 +11,7 @@ export default function ChatLayout() {
   const navigate = useNavigate()
   const { threadId } = useParams() // Get threadId from URL
   const [threads, setThreads] = useState([])
+  const [nextCursor, setNextCursor] = useState(null)
   const [activeMeta, setActiveMeta] = useState(null)
 
   useEffect(() => {
@@ -39,11 +40,24 @@ export default function ChatLayout() {
     try {
       const res = await api.get('/threads')
       setThreads(res.data)
+      setNextCursor(res.headers['x-next-cursor'] || null)
     } catch (err) {
       console.error('Failed to fetch threads:', err)
     }
   }
 
+  // Threads come a page at a time, newest first
+  async function loadMoreThreads() {
+    if (!nextCursor) return
+    try {
+      const res = await api.get('/threads', { params: { start_after: nextCursor } })
+      setThreads(prev => [...prev, ...res.data.filter(t => !prev.some(p => p.id === t.id))])
+      setNextCursor(res.headers['x-next-cursor'] || null)
+    } catch (err) {
+      console.error('Failed to fetch more threads:', err)
+    }
+  }
+
   async function newChat() {
     try {
       const res = await api.post('/threads', { title: 'New Patient Session' })
@@ -68,6 +82,8 @@ export default function ChatLayout() {
         threads={threads}
         activeId={threadId} // Use threadId from URL
         onNewChat={newChat}
+        hasMore={!!nextCursor}
+        onLoadMore={loadMoreThreads}
       />
       <ChatArea
         key={threadId || 'empty'}
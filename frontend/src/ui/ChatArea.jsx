@@ -127,12 +127,15 @@ export default function ChatArea({ threadId, meta, onEnded, onThreadEmptyNew })
 
   async function fetchMetaAndMessages() {
     try {
-      const t = await api.get(`/threads/${threadId}`)
-      setTitle(t.data.title)
-      setStatus(t.data.status)
-      const res = await api.get(`/threads/${threadId}/messages`)
-      setMessages(res.data)
-      if (t.data.status === 'closed') loadFeedback()
+      const res = await api.get(`/threads/${threadId}/bootstrap`)
+      const { thread, messages, feedback } = res.data
+      setTitle(thread.title)
+      setStatus(thread.status)
+      setMessages(messages)
+      if (thread.status === 'closed') {
+        if (feedback) setFeedback(feedback)
+        else loadFeedback()
+      }
     } catch (err) {
       console.error('❌ Load error:', err)
     }
@@ -167,6 +170,8 @@ export default function ChatArea({ threadId, meta, onEnded, onThreadEmptyNew })
       created_at: new Date().toISOString()
     }
 
+    // Only messages after the last one we hold come back
+    const lastSeq = messages.reduce((max, m) => (m.seq > max ? m.seq : max), 0)
     setMessages(prev => [...prev, optimisticMsg, typingMsg])
     setInput('')
 
@@ -174,12 +179,17 @@ export default function ChatArea({ threadId, meta, onEnded, onThreadEmptyNew })
       const res = await api.post(`/threads/${threadId}/messages`, {
         role: 'doctor',
         content
-      })
-      setMessages(res.data)
+      }, { params: { after_seq: lastSeq } })
+      setMessages(prev => [
+        ...prev.filter(m => m.id !== optimisticId && m.id !== 'typing' && !(m.seq > lastSeq)),
+        ...res.data
+      ])
     } catch (err) {
       console.error('❌ Send failed:', err)
       setMessages(prev => prev.filter(m => m.id !== optimisticId && m.id !== 'typing'))
-      await error('Send Failed', 'Failed to send message: ' + err.message)
+      // Nothing was saved, so give the question back to resend
+      setInput(prev => prev || content)
+      await error('Send Failed', 'Failed to send message: ' + (err.response?.data?.message || err.message))
     }
   }
 
@@ -5,7 +5,7 @@ import { useAuth } from '../auth/AuthContext.jsx'
 import { useNavigate } from 'react-router-dom'
 import defaultProfile from '../images/default-profile.webp'
 
-export default function Sidebar({ user, threads, activeId }) {
+export default function Sidebar({ user, threads, activeId, hasMore, onLoadMore }) {
   const { logout } = useAuth()
   const navigate = useNavigate()
   const open = threads.filter(t => t.status === 'open')
@@ -54,7 +54,12 @@ export default function Sidebar({ user, threads, activeId }) {
         {closed.map((t) => (
           <ThreadItem key={t.id} t={t} active={activeId === t.id} onClick={() => navigate(`/${t.id}`)} closed />
         ))}
-        {closed.length === 0 && <Empty text="No closed sessions" />}
+        {closed.length === 0 && !hasMore && <Empty text="No closed sessions" />}
+        {hasMore && (
+          <button onClick={onLoadMore} className="w-full text-[11px] text-slate-500 py-1 rounded-xl hover:bg-slate-50">
+            Load older sessions
+          </button>
+        )}
       </Section>
 
       <div className="text-[10px] text-slate-500 text-center">